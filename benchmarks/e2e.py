@@ -0,0 +1,456 @@
+# e2e.py - End-to-end benchmark against a simulated controller
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+#
+# Usage (from the repository root):
+#   python -m benchmarks.e2e [--samples 20] [--subscribers 4] [--output file.json]
+
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from threading import Thread, Event, Lock
+
+import zmq
+
+from src.core.config import Config
+from src.interface.dmx_sim import DMXSimulator
+
+def free_port():
+    """Returns a free TCP port on localhost"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def summarize(samples):
+    """Latency summary, in milliseconds, of a list of seconds"""
+    if not samples:
+        return {"n": 0}
+    ms = sorted(x * 1000 for x in samples)
+    def pct(p):
+        return round(ms[min(len(ms) - 1, int(round(p / 100 * (len(ms) - 1))))], 3)
+    return {
+        "n": len(ms),
+        "min": round(ms[0], 3),
+        "mean": round(statistics.fmean(ms), 3),
+        "p50": pct(50),
+        "p90": pct(90),
+        "p99": pct(99),
+        "max": round(ms[-1], 3),
+    }
+
+class Subscriber(Thread):
+    """SUB socket collecting (receive time, message) pairs"""
+    def __init__(self, context, endpoint):
+        super().__init__(daemon=True)
+        self.socket = context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.RCVTIMEO, 100)
+        self.socket.setsockopt_string(zmq.SUBSCRIBE, '')
+        self.socket.connect(endpoint)
+        self.messages = []
+        self.lock = Lock()
+        self.stop_event = Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                frames = self.socket.recv_multipart()
+            except zmq.Again:
+                continue
+            t = time.monotonic()
+            with self.lock:
+                self.messages.append((t, json.loads(frames[-1])))
+        self.socket.close(0)
+
+    def clear(self):
+        with self.lock:
+            self.messages = []
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.messages)
+
+class Bench():
+    """Starts the simulator and a headless ``App`` and drives them through ZMQ"""
+    def __init__(self, n_subscribers=4, latency=0.0, max_sessions=None):
+        self.sim = DMXSimulator(latency=latency, max_sessions=max_sessions).start()
+        Config.ip_address = '127.0.0.1'
+        for device in Config.devices:
+            device.device_ip = self.sim.host
+            device.device_port = self.sim.port
+        Config.port_pub = free_port()
+        Config.port_rep = free_port()
+
+        logger = logging.getLogger('benchmark')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        logger.setLevel(Config.log_level)
+
+        from src.core.app import App
+        self.app = App(logger)
+
+        # Loop interval instrumentation: update_status runs once per
+        # iteration of the device loop
+        self.loop_marks = []
+        worker = self.app.default
+        update_status = worker.update_status
+        def timed_update_status():
+            self.loop_marks.append(time.perf_counter())
+            update_status()
+        worker.update_status = timed_update_status
+
+        self.run_thread = Thread(target=self.app.run, daemon=True)
+        self.run_thread.start()
+
+        self.context = zmq.Context()
+        self.req = None
+        self.reset_req()
+        endpoint = f"tcp://127.0.0.1:{Config.port_pub}"
+        self.subscribers = [Subscriber(self.context, endpoint) for _ in range(n_subscribers)]
+        for sub in self.subscribers:
+            sub.start()
+        self.transaction = 0
+        time.sleep(1)
+
+    def reset_req(self):
+        """(Re)creates the REQ socket, so a lost reply does not lock it"""
+        if self.req:
+            self.req.close(0)
+        self.req = self.context.socket(zmq.REQ)
+        self.req.setsockopt(zmq.LINGER, 0)
+        self.req.connect(f"tcp://127.0.0.1:{Config.port_rep}")
+
+    def request(self, action, timeout=5000):
+        """Sends one request and returns (reply, elapsed seconds)"""
+        self.transaction += 1
+        msg = {
+            "clientId": 4242,
+            "clientTransactionId": self.transaction,
+            "clientName": "Benchmark",
+            "action": action
+        }
+        t0 = time.perf_counter()
+        self.req.send_string(json.dumps(msg))
+        if self.req.poll(timeout):
+            reply = self.req.recv_string()
+            return reply, time.perf_counter() - t0
+        self.reset_req()
+        return None, time.perf_counter() - t0
+
+    def wait_idle(self, timeout=30):
+        """Waits until the simulated axis stops and the server published it"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.sim.moving and not self.app.status["isMoving"]:
+                return True
+            time.sleep(.02)
+        return False
+
+    def close(self):
+        for sub in self.subscribers:
+            sub.stop_event.set()
+        for sub in self.subscribers:
+            sub.join()
+        self.req.close(0)
+        self.context.term()
+        self.app.disconnect()
+        self.run_thread.join(5)
+        self.sim.stop()
+
+    # --------------
+    # Scenarios
+    # --------------
+    def bench_requests(self, samples):
+        """REQ -> reply latency for STATUS, MOVE and HALT"""
+        results = {"STATUS": [], "MOVE": [], "HALT": [], "timeouts": 0}
+        for _ in range(samples):
+            reply, dt = self.request("STATUS")
+            if reply is None:
+                results["timeouts"] += 1
+            else:
+                results["STATUS"].append(dt)
+        target = 1000
+        for i in range(samples):
+            self.wait_idle()
+            target = 1000 + (i % 2) * 500
+            reply, dt = self.request(f"MOVE={target}")
+            if reply is None:
+                results["timeouts"] += 1
+                continue
+            results["MOVE"].append(dt)
+            reply, dt = self.request("HALT")
+            if reply is None:
+                results["timeouts"] += 1
+            else:
+                results["HALT"].append(dt)
+        self.wait_idle()
+        return {
+            "status": summarize(results["STATUS"]),
+            "move": summarize(results["MOVE"]),
+            "halt": summarize(results["HALT"]),
+            "timeouts": results["timeouts"],
+        }
+
+    def bench_halt(self, samples):
+        """HALT sent while moving: time until the stop command (V42=1)
+        reaches the controller, and until the reply"""
+        wire, replies, misses = [], [], 0
+        for i in range(samples):
+            self.wait_idle()
+            self.request(f"MOVE={20000 + (i % 2) * 500}")
+            # Let the device loop get busy polling the motion
+            time.sleep(.3 + (i % 5) * .05)
+            self.sim.history.clear()
+            self.sim.record_history = True
+            t0 = time.monotonic()
+            reply, dt = self.request("HALT")
+            deadline = time.monotonic() + 2
+            sent = None
+            while sent is None and time.monotonic() < deadline:
+                sent = next((t for cmd, t in list(self.sim.history) if cmd == 'V42=1'), None)
+                time.sleep(.001)
+            self.sim.record_history = False
+            if reply is None or sent is None:
+                misses += 1
+                continue
+            wire.append(sent - t0)
+            replies.append(dt)
+        self.wait_idle()
+        return {"to_wire": summarize(wire), "reply": summarize(replies), "misses": misses}
+
+    def bench_publish(self, duration):
+        """PUB throughput and fan-out skew to every subscriber.
+
+        The device status is published from here, straight into the broker
+        XSUB as the worker does, as fast as possible: the worker loop
+        publishes at most once per iteration, after a position read paced
+        by the driver (200 ms), which is what would be measured otherwise.
+        Each message carries a ``benchSeq`` to match it across subscribers.
+        """
+        worker = self.app.default
+        pub = self.app.context.socket(zmq.PUB)
+        pub.setsockopt(zmq.LINGER, 0)
+        pub.connect(self.app.status_endpoint)
+        # The broker subscription reaches the new publisher
+        time.sleep(.3)
+        for sub in self.subscribers:
+            sub.clear()
+        status = dict(worker.status)
+        sent = 0
+        t0 = time.monotonic()
+        while time.monotonic() - t0 < duration:
+            status["benchSeq"] = sent
+            payload = json.dumps(status).encode()
+            pub.send_multipart([worker.topic, payload] if worker.topic else [payload])
+            sent += 1
+        elapsed = time.monotonic() - t0
+        time.sleep(.5)
+        pub.close()
+        # Only the messages published here, not the worker periodic ones
+        received = [{data["benchSeq"]: t for t, data in sub.snapshot() if "benchSeq" in data}
+                    for sub in self.subscribers]
+        counts = [len(r) for r in received]
+        # Fan-out skew: spread of arrival times of the same message at the
+        # subscribers that got it
+        skew = []
+        if received:
+            for seq in set.intersection(*(set(r) for r in received)):
+                times = [r[seq] for r in received]
+                skew.append(max(times) - min(times))
+        return {
+            "duration_s": round(elapsed, 3),
+            "subscribers": len(received),
+            "sent": sent,
+            "sent_msg_s": round(sent / elapsed, 2),
+            "messages_per_subscriber": counts,
+            "throughput_msg_s": round(statistics.fmean(counts) / elapsed, 2) if counts else 0,
+            "dropped": sent - min(counts) if counts else 0,
+            "fanout_skew": summarize(skew),
+        }
+
+    def bench_registers(self, samples):
+        """MOVE reply latency and register writes with new and repeated
+        targets: a MOVE to the target the controller already holds in V20
+        skips the write (and its pacing sleep) through the register cache"""
+        device = self.app.default.device
+        before = device.register_stats
+        latency = {"new": [], "same": []}
+        target, timeouts = 0, 0
+        for i in range(samples):
+            self.wait_idle()
+            repeated = i % 2 == 1
+            if not repeated:
+                target = 700 + (i // 2 % 2) * 100
+            reply, dt = self.request(f"MOVE={target}")
+            if reply is None:
+                timeouts += 1
+                continue
+            latency["same" if repeated else "new"].append(dt)
+        self.wait_idle()
+        after = device.register_stats
+        return {
+            "sent": after["sent"] - before["sent"],
+            "saved": after["saved"] - before["saved"],
+            "move_new_target": summarize(latency["new"]),
+            "move_same_target": summarize(latency["same"]),
+            "timeouts": timeouts,
+        }
+
+    def bench_flood(self, duration):
+        """One client flooding STATUS, and what a well behaved client (10
+        STATUS/s) and the subscribers see meanwhile"""
+        stop = Event()
+        flood = {"sent": 0, "nak": 0}
+        def flooder():
+            req = self.context.socket(zmq.REQ)
+            req.setsockopt(zmq.LINGER, 0)
+            req.connect(f"tcp://127.0.0.1:{Config.port_rep}")
+            msg = {"clientId": 9999, "clientTransactionId": 0, "clientName": "Flood", "action": "STATUS"}
+            while not stop.is_set():
+                req.send_string(json.dumps(msg))
+                if not req.poll(1000):
+                    break
+                flood["sent"] += 1
+                if req.recv().startswith(b'NAK'):
+                    flood["nak"] += 1
+            req.close(0)
+        thread = Thread(target=flooder, daemon=True)
+        sub = self.subscribers[0] if self.subscribers else None
+        if sub:
+            sub.clear()
+        t0 = time.monotonic()
+        thread.start()
+        latency, naks = [], 0
+        while time.monotonic() - t0 < duration:
+            reply, dt = self.request("STATUS", timeout=1000)
+            if reply is None or reply.startswith('NAK'):
+                naks += 1
+            else:
+                latency.append(dt)
+            time.sleep(.1)
+        elapsed = time.monotonic() - t0
+        stop.set()
+        thread.join(2)
+        return {
+            "flood_requests_s": round(flood["sent"] / elapsed, 1),
+            "flood_limited": flood["nak"],
+            "client_status": summarize(latency),
+            "client_naks": naks,
+            "pub_msg_s": round(len(sub.snapshot()) / elapsed, 2) if sub else None,
+        }
+
+    def bench_loop(self, duration):
+        """Distribution of the main loop interval while idle and while moving"""
+        self.wait_idle()
+        self.loop_marks.clear()
+        time.sleep(duration)
+        idle = [b - a for a, b in zip(self.loop_marks, self.loop_marks[1:])]
+
+        self.request("MOVE=20000")
+        self.loop_marks.clear()
+        time.sleep(duration)
+        moving = [b - a for a, b in zip(self.loop_marks, self.loop_marks[1:])]
+        self.request("HALT")
+        self.wait_idle()
+        return {"idle": summarize(idle), "moving": summarize(moving)}
+
+    def bench_end_of_motion(self, samples):
+        """Time between the simulated motion end and the first PUB with isMoving false"""
+        sub = self.subscribers[0]
+        delays = []
+        misses = 0
+        for i in range(samples):
+            self.wait_idle()
+            target = 500 + (i % 2) * 20
+            sub.clear()
+            reply, _ = self.request(f"MOVE={target}")
+            replied = time.monotonic()
+            if reply is None:
+                misses += 1
+                continue
+            # Short moves may end before the server ever publishes
+            # isMoving=true, so look for the first idle state at the target
+            deadline = time.monotonic() + 30
+            detected = None
+            while time.monotonic() < deadline and detected is None:
+                for t, data in sub.snapshot():
+                    if t > replied and not data["isMoving"] and data["position"] == target:
+                        detected = t
+                        break
+                time.sleep(.01)
+            if detected is None:
+                misses += 1
+                continue
+            delays.append(detected - self.sim.motion_end)
+        return {"detect_delay": summarize(delays), "misses": misses}
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return ''
+
+def main():
+    parser = argparse.ArgumentParser(description='Focuser160 end-to-end benchmark')
+    parser.add_argument('--samples', type=int, default=10, help='samples per latency scenario')
+    parser.add_argument('--subscribers', type=int, default=4, help='number of SUB clients')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds per throughput/loop scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated controller reply latency (s)')
+    parser.add_argument('--max-sessions', type=int, default=None,
+                        help='sessions accepted by the simulated controller (1: polling shares the command session)')
+    parser.add_argument('--output', default=None, help='JSON output file (default benchmarks/results/<utc>.json)')
+    args = parser.parse_args()
+
+    bench = Bench(args.subscribers, args.latency, args.max_sessions)
+    # Startup times (ms) are measured by the App itself: time to the first
+    # published status and to the first status with the device connected
+    try:
+        results = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "samples": args.samples,
+                "subscribers": args.subscribers,
+                "sim_latency_s": args.latency,
+                "sim_max_sessions": args.max_sessions,
+            },
+            "requests": bench.bench_requests(args.samples),
+            "halt": bench.bench_halt(args.samples),
+            "publish": bench.bench_publish(args.duration),
+            "registers": bench.bench_registers(args.samples),
+            "flood": bench.bench_flood(args.duration),
+            "loop_interval": bench.bench_loop(args.duration),
+            "end_of_motion": bench.bench_end_of_motion(args.samples),
+            "startup": {key: round(value * 1000, 3) if value is not None else None
+                        for key, value in bench.app.startup.items()},
+            "register_writes": bench.app.default.device.register_stats,
+            "poll_connection": bench.app.default.device.poll_socket is not None,
+        }
+    finally:
+        bench.close()
+
+    output = args.output
+    if output is None:
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        output = os.path.join('benchmarks', 'results', f'e2e-{stamp}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    json.dump(results, sys.stdout, indent=2)
+    print(f"\nResults written to {output}")
+
+if __name__ == "__main__":
+    main()
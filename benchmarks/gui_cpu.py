@@ -0,0 +1,99 @@
+# gui_cpu.py - CPU used by the Qt GUI thread
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+#
+# Usage (from the repository root, no display needed):
+#   python -m benchmarks.gui_cpu [--duration 10] [--output file.json]
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import zmq
+from PyQt5 import QtWidgets
+
+from benchmarks.e2e import free_port, git_revision
+from src.core.config import Config
+from src.interface.dmx_sim import DMXSimulator
+
+def pump(app, seconds):
+    """Runs the Qt event loop for ``seconds``, returns the CPU time (s)
+    used by this (the GUI) thread meanwhile"""
+    cpu = time.thread_time()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        app.processEvents()
+        time.sleep(.005)
+    return time.thread_time() - cpu
+
+def main():
+    parser = argparse.ArgumentParser(description="GUI thread CPU usage, idle and while moving")
+    parser.add_argument("--duration", type=float, default=10, help="seconds measured per phase")
+    parser.add_argument("--output", default=None, help="JSON output file")
+    args = parser.parse_args()
+
+    sim = DMXSimulator().start()
+    Config.ip_address = '127.0.0.1'
+    for device in Config.devices:
+        device.device_ip = sim.host
+        device.device_port = sim.port
+    Config.port_pub = free_port()
+    Config.port_rep = free_port()
+    Config.startup = True
+
+    import main as gui
+    gui.logger = logging.getLogger('benchmark')
+    gui.logger.addHandler(logging.NullHandler())
+    gui.logger.propagate = False
+
+    app = QtWidgets.QApplication([])
+    window = gui.FocuserOPD()
+    window.show()
+    pump(app, 3)  # device reached
+
+    context = zmq.Context()
+    req = context.socket(zmq.REQ)
+    req.setsockopt(zmq.LINGER, 0)
+    req.connect(f"tcp://127.0.0.1:{Config.port_rep}")
+    def request(action):
+        req.send_string(json.dumps({"clientId": 4242, "clientTransactionId": 1,
+                                    "clientName": "Benchmark", "action": action}))
+        req.poll(5000) and req.recv()
+
+    idle = pump(app, args.duration)
+    request("MOVE=40000")
+    moving = pump(app, args.duration)
+    request("HALT")
+    shown = window.lblPos.text()
+
+    results = {
+        "meta": {"revision": git_revision(), "duration_s": args.duration},
+        "position_shown": shown,
+        "gui_cpu_percent": {
+            "idle": round(100 * idle / args.duration, 2),
+            "moving": round(100 * moving / args.duration, 2),
+        },
+    }
+    req.close()
+    context.term()
+    if hasattr(window, 'feed'):
+        window.feed.stop()
+    window.stop()
+    sim.stop()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
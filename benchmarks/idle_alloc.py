@@ -0,0 +1,139 @@
+# idle_alloc.py - Memory allocations of the idle control loop
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+#
+# Usage (from the repository root):
+#   python -m benchmarks.idle_alloc [--iterations 200] [--max-blocks 0.05] [--max-peak 512] [--output file.json]
+#
+# Exits with status 1 when an idle iteration allocates more than --max-peak
+# bytes at once (99th percentile) or the idle loop retains more than
+# --max-blocks memory blocks per iteration, so it can guard against
+# regressions.
+
+import argparse
+from array import array
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from benchmarks.e2e import Bench, git_revision
+from src.core.config import Config
+
+def main():
+    parser = argparse.ArgumentParser(description="Allocations per iteration of the idle device loop")
+    parser.add_argument("--iterations", type=int, default=200, help="idle iterations measured")
+    parser.add_argument("--max-blocks", type=float, default=0.05,
+                        help="blocks retained per iteration above which the run fails")
+    parser.add_argument("--max-peak", type=int, default=512,
+                        help="bytes allocated at once by an iteration (p99) above which the run fails")
+    parser.add_argument("--output", default=None, help="JSON output file")
+    args = parser.parse_args()
+
+    # Only the idle iterations: no periodic publication (and device read)
+    # during the measurement, no clients
+    Config.pub_interval = 3600
+    Config.state_dir = ''
+    bench = Bench(n_subscribers=0)
+    worker = bench.app.default
+    deadline = time.monotonic() + 10
+    while not worker.status["connected"] and time.monotonic() < deadline:
+        time.sleep(.1)
+    # Not part of the loop: the config watcher stats the file every second
+    # and tracemalloc counts every thread
+    if bench.app.watcher is not None:
+        bench.app.watcher.stop()
+        bench.app.watcher.join(2)
+    time.sleep(1)
+
+    # Peak of the traced memory above its level at the start of each
+    # iteration, i.e. the most an iteration holds allocated at once
+    # (includes the few bytes of this hook). Preallocated: the hook must
+    # not allocate itself
+    peaks = array('q', bytes(8 * args.iterations))
+    count = [0]
+    base = [0]
+    update_status = worker.update_status
+    def measured_update_status():
+        if count[0] < args.iterations:
+            peaks[count[0]] = tracemalloc.get_traced_memory()[1] - base[0]
+            count[0] += 1
+            tracemalloc.reset_peak()
+            base[0] = tracemalloc.get_traced_memory()[0]
+        update_status()
+
+    # Allocations made by the server code only (the benchmark counts the
+    # iterations in benchmarks/e2e.py)
+    only_src = [tracemalloc.Filter(True, '*/src/*')]
+    tracemalloc.start()
+    # A few traced iterations first: the objects an iteration holds at
+    # any time (its locals) are then traced in both snapshots
+    time.sleep(1)
+    gc.collect()
+    collections = sum(stat["collections"] for stat in gc.get_stats())
+    before = tracemalloc.take_snapshot().filter_traces(only_src)
+    tracemalloc.reset_peak()
+    base[0] = tracemalloc.get_traced_memory()[0]
+    cpu = time.process_time()
+    start = time.monotonic()
+    worker.update_status = measured_update_status
+
+    # A fixed number of iterations, not a duration: the retained blocks
+    # per iteration do not depend on how fast the loop ran
+    deadline = start + 10 + args.iterations
+    while count[0] < args.iterations and time.monotonic() < deadline:
+        time.sleep(.05)
+
+    worker.update_status = update_status
+    cpu = time.process_time() - cpu
+    duration = time.monotonic() - start
+    after = tracemalloc.take_snapshot().filter_traces(only_src)
+    collections = sum(stat["collections"] for stat in gc.get_stats()) - collections
+    tracemalloc.stop()
+
+    diff = after.compare_to(before, 'lineno')
+    blocks = sum(stat.count_diff for stat in diff)
+    size = sum(stat.size_diff for stat in diff)
+    iterations = max(count[0], 1)
+    # The first window starts before the hook was installed
+    measured = sorted(peaks[1:iterations]) or [0]
+    results = {
+        "meta": {"revision": git_revision(), "duration_s": round(duration, 3)},
+        "iterations": count[0],
+        "retained_blocks_per_iteration": round(blocks / iterations, 4),
+        "retained_bytes_per_iteration": round(size / iterations, 2),
+        "peak_bytes_per_iteration": {
+            "p50": measured[len(measured) // 2],
+            "p99": measured[int(len(measured) * .99)],
+            "max": measured[-1],
+        },
+        "gc_collections": collections,
+        "cpu_us_per_iteration": round(cpu / iterations * 1e6, 1),
+        "top": [str(stat) for stat in diff[:5] if stat.count_diff],
+    }
+    bench.close()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    failed = False
+    if count[0] < args.iterations:
+        print(f'FAIL: only {count[0]} of {args.iterations} idle iterations ran')
+        failed = True
+    if results["retained_blocks_per_iteration"] > args.max_blocks:
+        print(f'FAIL: more than {args.max_blocks} blocks retained per idle iteration')
+        failed = True
+    if results["peak_bytes_per_iteration"]["p99"] > args.max_peak:
+        print(f'FAIL: idle iterations allocate more than {args.max_peak} bytes at once')
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+# loadgen.py - Load generator for a running Focuser160 server
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+#
+# Usage (from the repository root):
+#   python -m benchmarks.loadgen --host 192.168.0.10 --clients 1,2,4,8,16 --subscribers 4
+#   python -m benchmarks.loadgen --sim --clients 1,4,16   # local simulator and server
+
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from threading import Thread, Event
+
+import zmq
+
+from benchmarks.e2e import summarize, git_revision
+from src.client.focuser_client import FocuserClient
+from src.core.config import Config
+
+DEFAULT_MIX = "STATUS=80,MOVE=10,HALT=5,FOCUSIN=5"
+
+def parse_mix(mix: str) -> list:
+    """``STATUS=80,MOVE=10`` -> [(action, cumulative weight), ...]"""
+    table, total = [], 0
+    for item in mix.split(','):
+        action, _, weight = item.partition('=')
+        total += float(weight or 1)
+        table.append((action.strip().upper(), total))
+    return [(action, weight / total) for action, weight in table]
+
+class LoadClient(Thread):
+    """Simulated console or script sending the request mix"""
+    def __init__(self, index, args, mix, stop):
+        super().__init__(daemon=True)
+        self.client = FocuserClient(args.host, args.port_rep, args.port_pub, args.device,
+                                    client_id=10000 + index, client_name=f'Load{index}',
+                                    timeout=args.timeout, retries=1, subscribe=False)
+        self.rate = args.rate
+        self.mix = mix
+        self.stop = stop
+        self.random = random.Random(index)
+        self.latency = {action: [] for action, _ in mix}
+        self.naks = 0
+        self.timeouts = 0
+
+    def pick(self):
+        r = self.random.random()
+        for action, weight in self.mix:
+            if r <= weight:
+                return action
+        return self.mix[-1][0]
+
+    def run(self):
+        period = 1 / self.rate if self.rate > 0 else 0
+        next_time = time.monotonic()
+        while not self.stop.is_set():
+            action = self.pick()
+            if action == 'MOVE':
+                cmd = f'MOVE={self.random.randint(1000, 3000)}'
+            elif action in ('FOCUSIN', 'FOCUSOUT'):
+                cmd = f'{action}=200'
+            else:
+                cmd = action
+            t0 = time.perf_counter()
+            try:
+                reply = self.client.request(cmd)
+                self.latency[action].append(time.perf_counter() - t0)
+                if reply.startswith('NAK'):
+                    self.naks += 1
+            except TimeoutError:
+                self.timeouts += 1
+            if period:
+                next_time += period
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    self.stop.wait(delay)
+                else:
+                    next_time = time.monotonic()
+        self.client.close()
+
+class LagSubscriber(Thread):
+    """PUB consumer measuring the lag between a status timestamp and its arrival"""
+    def __init__(self, context, endpoint, stop):
+        super().__init__(daemon=True)
+        self.socket = context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt_string(zmq.SUBSCRIBE, '')
+        self.socket.connect(endpoint)
+        self.stop = stop
+        self.lag = []
+        self.messages = 0
+
+    def run(self):
+        while not self.stop.is_set():
+            if not self.socket.poll(100):
+                continue
+            frames = self.socket.recv_multipart()
+            now = time.time()
+            self.messages += 1
+            try:
+                stamp = datetime.fromisoformat(json.loads(frames[-1])["timestamp"]).timestamp()
+                self.lag.append(max(0.0, now - stamp))
+            except (ValueError, KeyError):
+                pass
+        self.socket.close()
+
+def run_step(args, n_clients, mix, context):
+    """Runs ``n_clients`` clients and the subscribers for ``args.duration``"""
+    stop = Event()
+    subscribers = [LagSubscriber(context, f"tcp://{args.host}:{args.port_pub}", stop)
+                   for _ in range(args.subscribers)]
+    clients = [LoadClient(i, args, mix, stop) for i in range(n_clients)]
+    for thread in subscribers + clients:
+        thread.start()
+    t0 = time.monotonic()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in clients + subscribers:
+        thread.join(args.timeout * 2 + 1)
+    elapsed = time.monotonic() - t0
+
+    latency = {action: [] for action, _ in mix}
+    for client in clients:
+        for action, samples in client.latency.items():
+            latency[action] += samples
+    replies = sum(len(samples) for samples in latency.values())
+    timeouts = sum(client.timeouts for client in clients)
+    naks = sum(client.naks for client in clients)
+    sent = replies + timeouts
+    lag = [x for sub in subscribers for x in sub.lag]
+    return {
+        "clients": n_clients,
+        "duration_s": round(elapsed, 3),
+        "requests_s": round(replies / elapsed, 1),
+        "nak_rate": round(naks / sent, 4) if sent else 0,
+        "timeout_rate": round(timeouts / sent, 4) if sent else 0,
+        "latency": {action.lower(): summarize(samples) for action, samples in latency.items()},
+        "all": summarize([x for samples in latency.values() for x in samples]),
+        "subscriber_lag": summarize(lag),
+        "pub_msg_s": round(sum(sub.messages for sub in subscribers) / len(subscribers) / elapsed, 2)
+                     if subscribers else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Focuser160 load generator')
+    parser.add_argument('--host', default='127.0.0.1', help='server address')
+    parser.add_argument('--port-rep', type=int, default=Config.port_rep)
+    parser.add_argument('--port-pub', type=int, default=Config.port_pub)
+    parser.add_argument('--device', default=None, help='device addressed (multi device servers)')
+    parser.add_argument('--clients', default='1,2,4,8', help='comma separated client counts, one step each')
+    parser.add_argument('--subscribers', type=int, default=4, help='number of SUB consumers')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'request mix (default {DEFAULT_MIX})')
+    parser.add_argument('--rate', type=float, default=5.0, help='requests/s per client, 0 as fast as possible')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per step')
+    parser.add_argument('--timeout', type=float, default=2.0, help='reply timeout (s)')
+    parser.add_argument('--p99-limit', type=float, default=250.0,
+                        help='p99 latency (ms) above which the server is considered saturated')
+    parser.add_argument('--sim', action='store_true',
+                        help='start a simulator and a headless server in this process '
+                             '(shares the interpreter with the load, prefer a separate server)')
+    parser.add_argument('--output', default=None, help='JSON output file')
+    args = parser.parse_args()
+
+    bench = None
+    if args.sim:
+        from benchmarks.e2e import Bench
+        bench = Bench(n_subscribers=0)
+        args.host, args.port_rep, args.port_pub = '127.0.0.1', Config.port_rep, Config.port_pub
+
+    mix = parse_mix(args.mix)
+    context = zmq.Context.instance()
+    steps, saturation = [], None
+    try:
+        for n in (int(x) for x in args.clients.split(',')):
+            step = run_step(args, n, mix, context)
+            steps.append(step)
+            print(f"{n:4d} clients: {step['requests_s']:8.1f} req/s  p99 {step['all'].get('p99')} ms  "
+                  f"NAK {step['nak_rate']:.2%}  timeouts {step['timeout_rate']:.2%}  "
+                  f"lag p99 {step['subscriber_lag'].get('p99')} ms", file=sys.stderr)
+            if saturation is None and (step['timeout_rate'] > 0 or step['all'].get('p99', 0) > args.p99_limit):
+                saturation = n
+    finally:
+        if bench:
+            bench.close()
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            "revision": git_revision(),
+            "host": args.host,
+            "mix": args.mix,
+            "rate_per_client": args.rate,
+            "subscribers": args.subscribers,
+            "p99_limit_ms": args.p99_limit,
+        },
+        "steps": steps,
+        # First client count with timeouts or p99 above the limit
+        "saturation_clients": saturation,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
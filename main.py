@@ -12,6 +12,7 @@ from PyQt5.QtWidgets import QMessageBox, QMenu, QSystemTrayIcon, QAction
 
 import sys
 import os
+import multiprocessing
 from threading import Thread
 from src.core.log import init_logging
 import time
@@ -26,6 +27,8 @@ except Exception as e:
 
 if CONFIG_FILE:
     from src.core.app import App
+    from src.gui.log_viewer import LogViewer
+    from src.gui.status_feed import StatusFeed
     
     from misc.client_sample import ClientSimulator
 
@@ -67,10 +70,9 @@ class FocuserOPD(QtWidgets.QMainWindow):
         self.lblPort.setText(f"PUB {self.control.port_pub}, REPLY {self.control.port_rep}")
 
         # LOG FILE
-        self.log_text_edit = QtWidgets.QTextEdit()  # Widget to display log
+        self.log_viewer = LogViewer(self.log_file)  # Follows the end of the log
         self.log_dock_widget = QtWidgets.QDockWidget("Log", self)
-        self.log_dock_widget.setWidget(self.log_text_edit)
-        self.log_text_edit.setStyleSheet("color: lightgrey")
+        self.log_dock_widget.setWidget(self.log_viewer)
         self.boxLog.stateChanged.connect(self.toggle_log_view)     
         self.addDockWidget(Qt.BottomDockWidgetArea, self.log_dock_widget)
         self.log_dock_widget.setMinimumSize(600, 500)   
@@ -122,11 +124,18 @@ class FocuserOPD(QtWidgets.QMainWindow):
 
         self.tray_icon.show()
 
+        # Widgets are updated when a status is published, and only those
+        # whose value changed; the timer refreshes the server state
+        self._shown = {}
+        self.reachable = False
+        topic = self.control.default.name if len(self.control.workers) > 1 else ''
+        self.feed = StatusFeed(self.control.ip_address, self.control.port_pub, topic, self)
+        self.feed.status.connect(self.on_status)
+        self.feed.start()
+
         self.update_timer = QTimer(self)
         self.update_timer.timeout.connect(self.update)
-        self.update_timer.start(100)
-
-        self.reachable = False
+        self.update_timer.start(1000)
 
         self.run_thread = None
         self.statusBar().showMessage("Ready")
@@ -194,79 +203,95 @@ class FocuserOPD(QtWidgets.QMainWindow):
         if state == Qt.Checked:
             
             if self.log_file:
-                self.read_log_file(self.log_file)
+                self.log_viewer.start()
                 self.log_dock_widget.show()
         else:
+            self.log_viewer.stop()
             self.log_dock_widget.hide()
-
-    def read_log_file(self, file_path):
-        """Open LOG file"""
-        with open(file_path, "r") as file:
-            log_content = file.read()
-            self.log_text_edit.setPlainText(log_content)
            
+    def set_text(self, widget, text):
+        """Sets the text of a widget if it changed"""
+        if self._shown.get((widget, 'text')) != text:
+            self._shown[(widget, 'text')] = text
+            widget.setText(text)
+
+    def set_style(self, widget, style):
+        """Sets the style sheet of a widget if it changed"""
+        if self._shown.get((widget, 'style')) != style:
+            self._shown[(widget, 'style')] = style
+            widget.setStyleSheet(style)
+
+    def set_message(self, message):
+        """Shows a status bar message if it changed"""
+        if self._shown.get('message') != message:
+            self._shown['message'] = message
+            self.statusBar().showMessage(message)
+
     def ping(self):
         """Checks if device is reachable"""
         self.cooldown = time.time()
         if self.control.reachable:
-            self.lblPing.setText("Device is Reachable")
+            self.set_text(self.lblPing, "Device is Reachable")
             self.reachable = True
-            self.statMotor.setStyleSheet("background-color: green; border-radius: 10px;")
-            self.statRouter.setStyleSheet("background-color: green; border-radius: 10px;")
-            self.lineSR.setStyleSheet("background-color: green; border-radius: 10px;")
-            self.lineRM.setStyleSheet("background-color: green; border-radius: 10px;")
+            self.set_style(self.statMotor, "background-color: green; border-radius: 10px;")
+            self.set_style(self.statRouter, "background-color: green; border-radius: 10px;")
+            self.set_style(self.lineSR, "background-color: green; border-radius: 10px;")
+            self.set_style(self.lineRM, "background-color: green; border-radius: 10px;")
         else:
-            self.statMotor.setStyleSheet("background-color: indianred; border-radius: 10px;")
-            self.lineRM.setStyleSheet("background-color: indianred; border-radius: 10px;")
+            self.set_style(self.statMotor, "background-color: indianred; border-radius: 10px;")
+            self.set_style(self.lineRM, "background-color: indianred; border-radius: 10px;")
             self.reachable = False
             if not self.control.router:
-                self.lblPing.setText("Router is NOT Reachable")
-                self.statRouter.setStyleSheet("background-color: indianred; border-radius: 10px;")
-                self.lineSR.setStyleSheet("background-color: indianred; border-radius: 10px;")
+                self.set_text(self.lblPing, "Router is NOT Reachable")
+                self.set_style(self.statRouter, "background-color: indianred; border-radius: 10px;")
+                self.set_style(self.lineSR, "background-color: indianred; border-radius: 10px;")
             else:
-                self.statRouter.setStyleSheet("background-color: green; border-radius: 10px;")
-                self.lineSR.setStyleSheet("background-color: green; border-radius: 10px;")
-                self.lblPing.setText("Device is NOT Reachable")
-        
-    def update(self):   
-        """Main loop and UI manager"""     
-        status = self.control.status
+                self.set_style(self.statRouter, "background-color: green; border-radius: 10px;")
+                self.set_style(self.lineSR, "background-color: green; border-radius: 10px;")
+                self.set_text(self.lblPing, "Device is NOT Reachable")
+
+    def on_status(self, status):
+        """Shows a status published by the server"""
         con = status["connected"]
-        
-        if self.run_thread and self.run_thread.is_alive():
-            self.statusBar().setStyleSheet("background-color: green")
-            self.statServer.setStyleSheet("background-color: green; border-radius: 10px;")
-        else:
-            self.statusBar().setStyleSheet("background-color: indianred")
-            self.statServer.setStyleSheet("background-color: indianred; border-radius: 10px;")
         if con:
-            self.statusBar().showMessage("Device Socket Connected")
+            self.set_message("Device Socket Connected")
             if not self.reachable:
-                self.lblPing.setText("Device is Reachable")
+                self.set_text(self.lblPing, "Device is Reachable")
                 self.reachable = True
         else:
             if self.reachable:
-                self.lblPing.setText("Device is NOT Reachable")
+                self.set_text(self.lblPing, "Device is NOT Reachable")
                 self.reachable = False
-            self.statusBar().showMessage("Device Socket Disconnected")
-        self.lblPos.setText(str(status["position"]))
-        self.lblEnc.setText(str(self.control.encoder))
-        self.txtClientID.setText(str(self.control.busy_id))
-        self.lblCommSpeed.setText(str(self.control.connection_speed))
+            self.set_message("Device Socket Disconnected")
+        self.set_text(self.lblPos, str(status["position"]))
+        self.set_text(self.lblEnc, str(self.control.device.calibration.to_counts(status["position"])))
+        self.set_text(self.txtClientID, str(status["cmd"]["clientId"]))
         if len(status["error"]) > 1:
-            self.lblErr.setToolTip(status["error"])
-            self.lblErr.setStyleSheet("background-color: indianred; border-radius: 10px;")
+            if self._shown.get('error') != status["error"]:
+                self._shown['error'] = status["error"]
+                self.lblErr.setToolTip(status["error"])
+            self.set_style(self.lblErr, "background-color: indianred; border-radius: 10px;")
         else:
-            self.lblErr.setStyleSheet("background-color: rgb(119, 118, 123); border-radius: 10px;")
+            self.set_style(self.lblErr, "background-color: rgb(119, 118, 123); border-radius: 10px;")
         if status["isMoving"]:
-            self.lblMov.setStyleSheet("background-color: green; border-radius: 10px;")
+            self.set_style(self.lblMov, "background-color: green; border-radius: 10px;")
         else:
-            self.lblMov.setStyleSheet("background-color: rgb(119, 118, 123); border-radius: 10px;")
-        
+            self.set_style(self.lblMov, "background-color: rgb(119, 118, 123); border-radius: 10px;")
+
+    def update(self):
+        """Server state, the device state comes from ``on_status``"""
+        if self.run_thread and self.run_thread.is_alive():
+            self.set_style(self.statusBar(), "background-color: green")
+            self.set_style(self.statServer, "background-color: green; border-radius: 10px;")
+        else:
+            self.set_style(self.statusBar(), "background-color: indianred")
+            self.set_style(self.statServer, "background-color: indianred; border-radius: 10px;")
+        self.set_text(self.lblCommSpeed, str(self.control.connection_speed))
+
         #updates UI Stats every 15sec
         if int(time.time() - self.cooldown) > 10:
             self.ping()
-    
+
     def closeEvent(self, event):
         """Close application"""
         close = QMessageBox()
@@ -275,12 +300,15 @@ class FocuserOPD(QtWidgets.QMainWindow):
         close = close.exec()
 
         if close == QMessageBox.Yes:   
+            self.log_viewer.stop()
+            self.feed.stop()
             self.stop()  
             event.accept()
         else:
             event.ignore()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
 
     logger = init_logging() 
     app = QtWidgets.QApplication([])       
@@ -1,10 +1,15 @@
 from src.core.log import init_logging
 from src.core.app import App
 from threading import Thread
+import multiprocessing
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     logger = init_logging()
     control = App(logger)
+    control.install_signal_handlers()
     run_thread = Thread(target = control.run)
     run_thread.start()
-
+    # Keep the main thread responsive to the profiling signals
+    while run_thread.is_alive():
+        run_thread.join(1)
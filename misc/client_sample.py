@@ -3,8 +3,8 @@ from PyQt5.QtCore import QTimer
 from PyQt5.QtGui import *
 
 from src.core.config import Config
+from src.client.focuser_client import FocuserClient
 
-import zmq
 import sys
 import json
 import time
@@ -32,8 +32,6 @@ class ClientSimulator(QtWidgets.QMainWindow):
         self.btnUp.clicked.connect(self.move_out)
         self.btnDown.clicked.connect(self.move_in)
 
-        self.context = zmq.Context()       
-
         self.BarFocuser.setStyleSheet("QProgressBar::chunk { background-color: rgb(26, 26, 26) } QProgressBar { color: indianred; }")
         self.BarFocuser.setTextDirection(0) 
 
@@ -46,13 +44,7 @@ class ClientSimulator(QtWidgets.QMainWindow):
         self.position = 0
 
         self._client_id = 666
-
-        self._msg_json = {
-            "clientId": self._client_id,
-            "clientTransactionId": 0,
-            "clientName": "Simulator",
-            "action": "STATUS"
-        }
+        self._shown_updates = 0
 
         self.start_client()
         self.txtStatus.setText(f"{Config.ip_address}")
@@ -71,37 +63,19 @@ class ClientSimulator(QtWidgets.QMainWindow):
             return False
 
     def start_client(self):
-        self.subscriber = self.context.socket(zmq.SUB)
-        self.subscriber.connect(f"tcp://localhost:{Config.port_pub}")
-        topics_to_subscribe = ''
-
-        self.subscriber.setsockopt_string(zmq.SUBSCRIBE, topics_to_subscribe)
+        # A single attempt per click, the socket is reset if it times out
+        self.client = FocuserClient("localhost", self.port_req, self.port_pub,
+                                    client_id=self._client_id, client_name="Simulator",
+                                    retries=1)
 
-        self.poller = zmq.Poller()
-        self.poller.register(self.subscriber, zmq.POLLIN)
-
-        self.req = self.context.socket(zmq.REQ)
-        self.req.connect(f"tcp://localhost:{Config.port_rep}")
-    
     def send_request(self, action, timeout=1000):
-        self._msg_json["action"] = action
-        self.req.send_string(json.dumps(self._msg_json))
-
-        poller = zmq.Poller()
-        poller.register(self.req, zmq.POLLIN)
-
-        socks = dict(poller.poll(timeout))  # Timeout in milliseconds
-        if socks.get(self.req) == zmq.POLLIN:
-            try:
-                response = self.req.recv_string()
-                return response
-            except Exception as e:
-                print(f"Error receiving response: {e}")
-                return None
-        else:
-            print(f"No response received within {timeout} milliseconds.")
+        self.client.timeout = timeout / 1000
+        try:
+            return self.client.request(action)
+        except TimeoutError as e:
+            print(e)
             return None
-    
+
     def connect(self):
         response = self.send_request("CONNECT")
         if response:
@@ -149,43 +123,44 @@ class ClientSimulator(QtWidgets.QMainWindow):
     def update(self):
         if round(time.time() % 35) == 0:
             self.get_status()
-        self.socks = dict(self.poller.poll(100))
-        if self.socks.get(self.subscriber) == zmq.POLLIN:
-            message = self.subscriber.recv_string()
-            self.txtStatus.setText(message)
-            data = json.loads(message)
-            try: 
-                self.position = int(data["position"])                    
-                self.BarFocuser.setValue(int(self.position))
-                if (data["cmd"]["clientId"]) > 0:
-                    self.statBusy.setStyleSheet("background-color: lightgreen")
-                    self.statBusy.setText(str(data["cmd"]["clientId"]))
-                else:
-                    self.statBusy.setText('')
-                    self.statBusy.setStyleSheet("background-color: indianred")
-                if data["homing"]:
-                    self.homing = True
-                    self.statInit.setStyleSheet("background-color: lightgreen")
-                else:
-                    self.homing = False
-                    self.statInit.setStyleSheet("background-color: indianred") 
-                if data["isMoving"]:
-                    self.is_moving = True
-                    self.statMov.setStyleSheet("background-color: lightgreen")
-                else:
-                    self.is_moving = False
-                    self.statMov.setStyleSheet("background-color: indianred") 
-                if data["connected"]:
-                    self.connected = True
-                    self.statConn.setStyleSheet("background-color: lightgreen")
-                else:
-                    self.connected = False
-                    self.statConn.setStyleSheet("background-color: indianred")               
-            except Exception as e:
-                print(e)
-                self.BarFocuser.setValue(0)
+        if self.client.updates == self._shown_updates:
+            return
+        self._shown_updates = self.client.updates
+        data = self.client.state
+        self.txtStatus.setText(json.dumps(data))
+        try: 
+            self.position = int(data["position"])                    
+            self.BarFocuser.setValue(int(self.position))
+            if (data["cmd"]["clientId"]) > 0:
+                self.statBusy.setStyleSheet("background-color: lightgreen")
+                self.statBusy.setText(str(data["cmd"]["clientId"]))
+            else:
+                self.statBusy.setText('')
+                self.statBusy.setStyleSheet("background-color: indianred")
+            if data["homing"]:
+                self.homing = True
+                self.statInit.setStyleSheet("background-color: lightgreen")
+            else:
+                self.homing = False
+                self.statInit.setStyleSheet("background-color: indianred") 
+            if data["isMoving"]:
+                self.is_moving = True
+                self.statMov.setStyleSheet("background-color: lightgreen")
+            else:
+                self.is_moving = False
+                self.statMov.setStyleSheet("background-color: indianred") 
+            if data["connected"]:
+                self.connected = True
+                self.statConn.setStyleSheet("background-color: lightgreen")
+            else:
+                self.connected = False
+                self.statConn.setStyleSheet("background-color: indianred")               
+        except Exception as e:
+            print(e)
+            self.BarFocuser.setValue(0)
     
     def closeEvent(self, event):
         """Close application"""
         self.disconnect()
+        self.client.close()
         event.accept()
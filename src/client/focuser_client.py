@@ -0,0 +1,384 @@
+# focuser_client.py - Client library for the Focuser160 server
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+import asyncio
+import itertools
+import json
+import random
+import time
+from threading import Thread, Lock, Condition, Event
+
+import zmq
+import zmq.asyncio
+
+class ServerError(RuntimeError):
+    """Request refused (``NAK=<code>``) or failed on the server
+    Args:
+        message (str): Error description.
+        code (int): Server error code (``errorCode``), 0 if unknown.
+    """
+    def __init__(self, message: str, code: int = 0):
+        super().__init__(message)
+        self.code = code
+
+class ClientBase():
+    """Request building and status handling shared by the sync and asyncio
+    clients.
+
+    Args:
+        host (str): Server address.
+        port_rep (int): Server REQ/REP port.
+        port_pub (int): Server PUB port.
+        device (str): Device addressed, required when the server drives
+            more than one focuser.
+        client_id (int): Client id, a random one by default.
+        client_name (str): Name sent with every request.
+        timeout (float): Seconds to wait for each reply.
+        retries (int): Attempts before giving up a request that is safe
+            to repeat (``REPEATABLE``), other requests are sent once.
+    """
+    # Sent again when the reply is lost: repeating them changes nothing.
+    # A motion command may already run when its reply is late, sent again
+    # it would be refused (BUSY) or start a second move
+    REPEATABLE = frozenset({'STATUS', 'HALT'})
+
+    def __init__(self, host: str, port_rep: int, port_pub: int, device: str = None,
+                 client_id: int = None, client_name: str = 'FocuserClient',
+                 timeout: float = 5.0, retries: int = 3):
+        self.rep_endpoint = f"tcp://{host}:{port_rep}"
+        self.pub_endpoint = f"tcp://{host}:{port_pub}"
+        self.device = device
+        self.client_id = client_id or random.randint(1, 65535)
+        self.client_name = client_name
+        self.timeout = timeout
+        self.retries = retries
+        self._transactions = itertools.count(1)
+        self.req = None
+
+        # Local mirror of the device status, updated by the subscriber
+        self.state = {}
+        self.updates = 0
+
+    def message(self, action: str, **fields) -> tuple[int, bytes]:
+        """Builds a request, returns (transaction id, payload)"""
+        transaction = next(self._transactions)
+        msg = {
+            "clientId": self.client_id,
+            "clientTransactionId": transaction,
+            "clientName": self.client_name,
+            "action": action,
+        }
+        if self.device:
+            msg["device"] = self.device
+        msg.update(fields)
+        return transaction, json.dumps(msg).encode()
+
+    def attempts(self, action: str) -> int:
+        """Times ``action`` may be sent before giving up"""
+        return self.retries if action.partition('=')[0] in self.REPEATABLE else 1
+
+    def accept(self, frames: list) -> bool:
+        """Updates the mirror with a published status, False if it belongs
+        to another device"""
+        if self.device and len(frames) > 1 and frames[0].decode() != self.device:
+            return False
+        try:
+            self.state = json.loads(frames[-1])
+        except ValueError:
+            return False
+        self.updates += 1
+        return True
+
+    def parse_status(self, reply: str) -> dict:
+        """Status dict of a STATUS reply (the mirror if the server only ACKs)"""
+        if reply.startswith('{'):
+            self.state = json.loads(reply)
+            self.updates += 1
+        return self.state
+
+    @staticmethod
+    def settled(state: dict, target: int, tolerance: int, transaction: int) -> bool:
+        """True when ``state`` shows the move to ``target`` finished
+        Raises:
+            ServerError if the server reported an error for ``transaction``
+        """
+        if state.get("error") and state.get("cmd", {}).get("clientTransactionId") == transaction:
+            raise ServerError(state["error"], state.get("errorCode", 0))
+        return (state.get("connected") and not state.get("isMoving")
+                and abs(state.get("position", 0) - target) <= tolerance)
+
+    @staticmethod
+    def check(action: str, reply: str):
+        """Raises ServerError if ``reply`` is a NAK"""
+        if reply.startswith('NAK'):
+            code = int(reply[4:]) if reply[4:].isdigit() else 0
+            raise ServerError(f'{action} refused by the server (error {code:#x})', code)
+
+class FocuserClient(ClientBase):
+    """Blocking client, safe to share between threads.
+
+    Requests use the lazy pirate pattern: a request without reply within
+    ``timeout`` closes and reopens the REQ socket, so a lost reply never
+    leaves the socket stuck, and STATUS/HALT are sent again, up to
+    ``retries`` times. Motion commands are not repeated: their timeout
+    raises ``TimeoutError`` and the status tells whether they ran. With
+    ``subscribe`` a background thread keeps ``state`` updated from the PUB
+    stream, ``on_status`` (if given) is called there with every status.
+
+    Example:
+        with FocuserClient('192.168.0.10', 7002, 7001) as focuser:
+            focuser.move_and_wait(12000)
+    """
+    def __init__(self, host: str, port_rep: int, port_pub: int, device: str = None,
+                 client_id: int = None, client_name: str = 'FocuserClient',
+                 timeout: float = 5.0, retries: int = 3, subscribe: bool = True,
+                 on_status=None, context: zmq.Context = None):
+        super().__init__(host, port_rep, port_pub, device, client_id, client_name, timeout, retries)
+        self.context = context or zmq.Context.instance()
+        self.on_status = on_status
+        self._lock = Lock()
+        self._changed = Condition()
+        self._stop = Event()
+        self._subscriber = None
+        if subscribe:
+            self._subscriber = Thread(target=self._subscribe, name='focuser-client-sub', daemon=True)
+            self._subscriber.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _reset(self):
+        """(Re)creates the REQ socket"""
+        if self.req is not None:
+            self.req.close(0)
+        self.req = self.context.socket(zmq.REQ)
+        self.req.setsockopt(zmq.LINGER, 0)
+        self.req.connect(self.rep_endpoint)
+
+    def _subscribe(self):
+        sub = self.context.socket(zmq.SUB)
+        sub.setsockopt(zmq.LINGER, 0)
+        sub.setsockopt_string(zmq.SUBSCRIBE, self.device or '')
+        sub.connect(self.pub_endpoint)
+        try:
+            while not self._stop.is_set():
+                if not sub.poll(100):
+                    continue
+                frames = sub.recv_multipart()
+                with self._changed:
+                    if not self.accept(frames):
+                        continue
+                    self._changed.notify_all()
+                if self.on_status:
+                    self.on_status(self.state)
+        finally:
+            sub.close()
+
+    def transact(self, action: str, **fields) -> tuple[int, str]:
+        """Sends a request, returns (transaction id, reply)
+        Raises:
+            TimeoutError if no reply came after ``attempts(action)`` attempts
+        """
+        transaction, payload = self.message(action, **fields)
+        with self._lock:
+            for _ in range(self.attempts(action)):
+                if self.req is None:
+                    self._reset()
+                self.req.send(payload)
+                if self.req.poll(self.timeout * 1000):
+                    return transaction, self.req.recv().decode()
+                self._reset()
+        raise TimeoutError(f'{action}: no reply from {self.rep_endpoint}')
+
+    def request(self, action: str, **fields) -> str:
+        """Sends a request and returns the reply ('ACK', 'NAK=<code>' or a status JSON)"""
+        return self.transact(action, **fields)[1]
+
+    def status(self) -> dict:
+        """Current status of the device"""
+        return self.parse_status(self.request('STATUS'))
+
+    def move(self, position: int):
+        self.check('MOVE', self.request(f'MOVE={int(position)}'))
+
+    def halt(self):
+        self.check('HALT', self.request('HALT'))
+
+    def home(self):
+        self.check('HOME', self.request('HOME'))
+
+    def focus_in(self, speed: int):
+        self.check('FOCUSIN', self.request(f'FOCUSIN={int(speed)}'))
+
+    def focus_out(self, speed: int):
+        self.check('FOCUSOUT', self.request(f'FOCUSOUT={int(speed)}'))
+
+    def wait_for(self, predicate, timeout: float = None) -> dict:
+        """Waits until ``predicate(state)`` is true for a published status
+        Raises:
+            TimeoutError if it did not happen within ``timeout`` seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            while not (self.state and predicate(self.state)):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError('Timeout waiting for the focuser status')
+                self._changed.wait(remaining)
+            return self.state
+
+    def move_and_wait(self, position: int, timeout: float = 60.0, tolerance: int = 0) -> dict:
+        """Moves to ``position`` and waits for the move to finish
+        Returns:
+            The status showing the focuser stopped at the target
+        Raises:
+            ServerError if the move was refused or failed
+            TimeoutError if it did not finish within ``timeout`` seconds
+        """
+        if self._subscriber is None:
+            raise RuntimeError('move_and_wait needs subscribe=True')
+        # Statuses published before the request may still show the focuser
+        # idle at the target, wait for one published after it
+        start = self.updates
+        transaction, reply = self.transact(f'MOVE={int(position)}')
+        self.check('MOVE', reply)
+        return self.wait_for(lambda s: self.updates > start
+                             and self.settled(s, int(position), tolerance, transaction), timeout)
+
+    def close(self):
+        """Stops the subscriber and closes the sockets"""
+        self._stop.set()
+        if self._subscriber is not None:
+            self._subscriber.join(1)
+        with self._lock:
+            if self.req is not None:
+                self.req.close(0)
+                self.req = None
+
+class AsyncFocuserClient(ClientBase):
+    """asyncio client, same requests as ``FocuserClient`` as coroutines.
+
+    ``start`` launches the subscriber task that keeps ``state`` updated.
+
+    Example:
+        async with AsyncFocuserClient('192.168.0.10', 7002, 7001) as focuser:
+            await focuser.move_and_wait(12000)
+    """
+    def __init__(self, host: str, port_rep: int, port_pub: int, device: str = None,
+                 client_id: int = None, client_name: str = 'FocuserClient',
+                 timeout: float = 5.0, retries: int = 3, context: zmq.asyncio.Context = None):
+        super().__init__(host, port_rep, port_pub, device, client_id, client_name, timeout, retries)
+        self.context = context or zmq.asyncio.Context.instance()
+        self._lock = asyncio.Lock()
+        self._changed = asyncio.Condition()
+        self._task = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def start(self):
+        """Starts the subscriber task"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._subscribe())
+
+    async def _subscribe(self):
+        sub = self.context.socket(zmq.SUB)
+        sub.setsockopt(zmq.LINGER, 0)
+        sub.setsockopt_string(zmq.SUBSCRIBE, self.device or '')
+        sub.connect(self.pub_endpoint)
+        try:
+            while True:
+                frames = await sub.recv_multipart()
+                async with self._changed:
+                    if self.accept(frames):
+                        self._changed.notify_all()
+        finally:
+            sub.close()
+
+    def _reset(self):
+        if self.req is not None:
+            self.req.close(0)
+        self.req = self.context.socket(zmq.REQ)
+        self.req.setsockopt(zmq.LINGER, 0)
+        self.req.connect(self.rep_endpoint)
+
+    async def transact(self, action: str, **fields) -> tuple[int, str]:
+        """Sends a request, returns (transaction id, reply), see
+        ``FocuserClient.transact``"""
+        transaction, payload = self.message(action, **fields)
+        async with self._lock:
+            for _ in range(self.attempts(action)):
+                if self.req is None:
+                    self._reset()
+                await self.req.send(payload)
+                if await self.req.poll(self.timeout * 1000):
+                    return transaction, (await self.req.recv()).decode()
+                self._reset()
+        raise TimeoutError(f'{action}: no reply from {self.rep_endpoint}')
+
+    async def request(self, action: str, **fields) -> str:
+        """Sends a request and returns the reply, see ``FocuserClient.request``"""
+        return (await self.transact(action, **fields))[1]
+
+    async def status(self) -> dict:
+        return self.parse_status(await self.request('STATUS'))
+
+    async def move(self, position: int):
+        self.check('MOVE', await self.request(f'MOVE={int(position)}'))
+
+    async def halt(self):
+        self.check('HALT', await self.request('HALT'))
+
+    async def home(self):
+        self.check('HOME', await self.request('HOME'))
+
+    async def focus_in(self, speed: int):
+        self.check('FOCUSIN', await self.request(f'FOCUSIN={int(speed)}'))
+
+    async def focus_out(self, speed: int):
+        self.check('FOCUSOUT', await self.request(f'FOCUSOUT={int(speed)}'))
+
+    async def wait_for(self, predicate, timeout: float = None) -> dict:
+        """Waits until ``predicate(state)`` is true for a published status"""
+        async def wait():
+            async with self._changed:
+                await self._changed.wait_for(lambda: self.state and predicate(self.state))
+                return self.state
+        try:
+            return await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Timeout waiting for the focuser status') from None
+
+    async def move_and_wait(self, position: int, timeout: float = 60.0, tolerance: int = 0) -> dict:
+        """Moves to ``position`` and waits for the move to finish, see
+        ``FocuserClient.move_and_wait``"""
+        self.start()
+        start = self.updates
+        transaction, reply = await self.transact(f'MOVE={int(position)}')
+        self.check('MOVE', reply)
+        return await self.wait_for(lambda s: self.updates > start
+                                   and self.settled(s, int(position), tolerance, transaction), timeout)
+
+    async def close(self):
+        """Cancels the subscriber task and closes the REQ socket"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.req is not None:
+            self.req.close(0)
+            self.req = None
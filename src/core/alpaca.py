@@ -0,0 +1,361 @@
+# alpaca.py - ASCOM Alpaca Focuser API
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+#
+# Usage, standalone (another machine, or a server started without it):
+#   python -m src.core.alpaca [--server 192.168.0.10] [--port 11111] [--no-discovery]
+
+from logging import Logger
+
+import argparse
+import itertools
+import json
+import logging
+import socket
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event
+from urllib.parse import urlsplit, parse_qs
+
+from src.core.config import Config, DeviceConfig, local_address
+from src.core.exceptions import (FocuserException, ActionNotImplementedException, DriverException,
+                                 InvalidValueException, NotConnectedException, NotImplementedException)
+from src.client.focuser_client import FocuserClient, ServerError
+
+DISCOVERY_PORT = 32227
+DISCOVERY_MESSAGE = b'alpacadiscovery1'
+
+class BadRequest(Exception):
+    """Missing or malformed parameter, answered with HTTP 400"""
+
+class AlpacaFocuser():
+    """One focuser of the server as an Alpaca ``IFocuserV3`` device.
+
+    Properties are answered from the status mirror of a ``FocuserClient``
+    (the last published status), so reading them never reaches the
+    controller. Methods are sent as regular requests, with the Alpaca
+    ``ClientID`` as ``clientId`` (busy owner).
+
+    Positions are in microns, as in the rest of the server (StepSize 1).
+
+    Args:
+        number (int): Alpaca device number.
+        device (DeviceConfig): Device settings.
+        client (FocuserClient): Client subscribed to the device status.
+        unique_id (str): Alpaca UniqueID.
+    """
+    def __init__(self, number: int, device: DeviceConfig, client: FocuserClient, unique_id: str):
+        self.number = number
+        self.name = device.device_name
+        self.client = client
+        self.unique_id = unique_id
+        # Alpaca Connected, the server keeps the device connected anyway
+        self.connected = False
+        # Mirror updates count when a move was acknowledged, IsMoving holds
+        # until a status published after it arrives
+        self._moved_at = -1
+
+    # Alpaca members, GET and PUT
+    GET = ('absolute', 'connected', 'description', 'driverinfo', 'driverversion',
+           'interfaceversion', 'ismoving', 'maxincrement', 'maxstep', 'name', 'position',
+           'stepsize', 'supportedactions', 'tempcomp', 'tempcompavailable', 'temperature')
+    PUT = ('action', 'commandblind', 'commandbool', 'commandstring', 'connected',
+           'halt', 'move', 'tempcomp')
+
+    @property
+    def state(self) -> dict:
+        return self.client.state
+
+    def ready(self) -> dict:
+        """Current status
+        Raises:
+            NotConnectedException if not Connected or the device is not reached
+        """
+        state = self.client.state
+        if not self.connected or not state.get("connected"):
+            raise NotConnectedException()
+        return state
+
+    def request(self, action: str, client_id: int, transaction: int):
+        """Sends ``action`` to the server
+        Raises:
+            FocuserException with the server error code if refused
+        """
+        fields = {}
+        if client_id:
+            fields["clientId"] = client_id
+        if transaction:
+            fields["clientTransactionId"] = transaction
+        try:
+            self.client.check(action.partition('=')[0], self.client.request(action, **fields))
+        except ServerError as e:
+            raise FocuserException(str(e), e.code) from None
+        except TimeoutError:
+            raise DriverException('No reply from the focuser server') from None
+
+    def get(self, member: str, params: dict):
+        if member == 'connected':
+            return self.connected and bool(self.state.get("connected"))
+        if member == 'description':
+            return f'{Config.name} {self.name} focuser (DMX-ETH)'
+        if member == 'driverinfo':
+            return 'Focuser160 ZeroMQ server, Alpaca API'
+        if member == 'driverversion':
+            return self.state.get("version", '1.0.0')
+        if member == 'interfaceversion':
+            return 3
+        if member == 'name':
+            return self.name
+        if member == 'supportedactions':
+            return []
+        state = self.ready()
+        if member == 'absolute':
+            return state["absolute"]
+        if member == 'ismoving':
+            return state["isMoving"] or state["homing"] or self.client.updates <= self._moved_at
+        if member in ('maxincrement', 'maxstep'):
+            return state["maxStep"]
+        if member == 'position':
+            return state["position"]
+        if member == 'stepsize':
+            return 1.0
+        if member == 'tempcomp':
+            return state["tempComp"]
+        if member == 'tempcompavailable':
+            return state["tempCompAvailable"]
+        if member == 'temperature':
+            if not state["tempCompAvailable"]:
+                raise NotImplementedException('Temperature is not available')
+            return state["temperature"]
+
+    def put(self, member: str, params: dict, client_id: int, transaction: int):
+        if member == 'connected':
+            self.connected = parse_bool(params, 'connected')
+            return
+        if member in ('action', 'commandblind', 'commandbool', 'commandstring'):
+            raise ActionNotImplementedException() if member == 'action' else NotImplementedException()
+        if member == 'halt':
+            self.ready()
+            self.request('HALT', client_id, transaction)
+        elif member == 'move':
+            position = parse_int(params, 'position')
+            state = self.ready()
+            if not 0 < position < state["maxStep"]:
+                raise InvalidValueException(f'Position {position} outside 1..{state["maxStep"] - 1}')
+            self.request(f'MOVE={position}', client_id, transaction)
+            self._moved_at = self.client.updates
+        elif member == 'tempcomp':
+            enable = parse_bool(params, 'tempcomp')
+            if not self.ready()["tempCompAvailable"]:
+                raise NotImplementedException('Temperature compensation is not available')
+            self.request(f'TEMPCOMP={int(enable)}', client_id, transaction)
+
+def parse_int(params: dict, name: str, default: int = None) -> int:
+    value = params.get(name)
+    if value is None and default is not None:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f'Invalid or missing {name}') from None
+
+def parse_bool(params: dict, name: str) -> bool:
+    value = str(params.get(name, '')).lower()
+    if value not in ('true', 'false'):
+        raise BadRequest(f'Invalid or missing {name}')
+    return value == 'true'
+
+class AlpacaHandler(BaseHTTPRequestHandler):
+    server_version = 'Focuser160-Alpaca/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.alpaca.handle(self, 'GET')
+
+    def do_PUT(self):
+        self.server.alpaca.handle(self, 'PUT')
+
+    def log_message(self, format, *args):
+        self.server.alpaca.logger.debug(f'Alpaca {self.address_string()} {format % args}')
+
+class AlpacaServer():
+    """ASCOM Alpaca Focuser API of the configured devices (device number =
+    position in the device list), plus the management API and the UDP
+    discovery responder.
+
+    The HTTP server runs in its own threads and talks to the server like
+    any other client (REQ/SUB on the ZeroMQ ports), read endpoints being
+    answered from the last published status: Alpaca clients add no load on
+    the controller and no work to the control loop.
+
+    Args:
+        logger (Logger): Logger.
+        server (str): ZeroMQ server address.
+        port (int): HTTP port.
+        bind (str): HTTP bind address, all interfaces if empty.
+        discovery (bool): Answer the Alpaca discovery on UDP 32227.
+    """
+    def __init__(self, logger: Logger, server: str = '127.0.0.1', port: int = 11111,
+                 bind: str = '', discovery: bool = True):
+        self.logger = logger
+        self.port = port
+        self.bind = bind
+        self.discovery = discovery
+        self._transactions = itertools.count(1)
+        self._stop = Event()
+        self._threads = []
+        self.httpd = None
+
+        multi = len(Config.devices) > 1
+        self.devices = []
+        for number, device in enumerate(Config.devices):
+            client = FocuserClient(server, Config.port_rep, Config.port_pub,
+                                   device=device.device_name if multi else None,
+                                   client_name='Alpaca')
+            self.devices.append(AlpacaFocuser(number, device, client, self.unique_id(device)))
+
+    @staticmethod
+    def unique_id(device: DeviceConfig) -> str:
+        """Stable Alpaca UniqueID of a device"""
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f'focuser160://{Config.name}/{device.device_name}'))
+
+    def start(self) -> 'AlpacaServer':
+        """Starts the HTTP server and the discovery responder"""
+        self.httpd = ThreadingHTTPServer((self.bind, self.port), AlpacaHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.alpaca = self
+        self.port = self.httpd.server_address[1]
+        self._threads = [Thread(target=self.httpd.serve_forever, name='alpaca-http', daemon=True)]
+        if self.discovery:
+            self._threads.append(Thread(target=self.serve_discovery, name='alpaca-discovery', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        self.logger.info(f'Alpaca API on port {self.port}, {len(self.devices)} focuser(s)')
+        return self
+
+    def stop(self):
+        """Stops the HTTP server, the discovery responder and the clients"""
+        self._stop.set()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+        for thread in self._threads:
+            thread.join(1)
+        for device in self.devices:
+            device.client.close()
+
+    def serve_discovery(self):
+        """Answers ``alpacadiscovery1`` broadcasts with the HTTP port"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((self.bind, DISCOVERY_PORT))
+        except OSError as e:
+            self.logger.warning(f'Alpaca discovery not available: {str(e)}')
+            sock.close()
+            return
+        sock.settimeout(.5)
+        reply = json.dumps({"AlpacaPort": self.port}).encode()
+        try:
+            while not self._stop.is_set():
+                try:
+                    data, address = sock.recvfrom(1024)
+                except socket.timeout:
+                    continue
+                if data.startswith(DISCOVERY_MESSAGE):
+                    sock.sendto(reply, address)
+        finally:
+            sock.close()
+
+    def handle(self, request: BaseHTTPRequestHandler, method: str):
+        """Serves one HTTP request"""
+        url = urlsplit(request.path)
+        query = url.query
+        if method == 'PUT':
+            length = int(request.headers.get('Content-Length') or 0)
+            query = request.rfile.read(length).decode(errors='replace')
+        # Alpaca parameter names are case insensitive
+        params = {key.lower(): values[-1] for key, values in parse_qs(query).items()}
+        parts = url.path.strip('/').lower().split('/')
+        try:
+            transaction = parse_int(params, 'clienttransactionid', 0)
+            client_id = parse_int(params, 'clientid', 0)
+        except BadRequest:
+            transaction = client_id = 0
+        try:
+            if parts[0] == 'management':
+                value = self.management(parts[1:], method)
+                self.respond(request, {"Value": value, "ClientTransactionID": transaction,
+                                       "ServerTransactionID": next(self._transactions)})
+                return
+            if len(parts) != 5 or parts[:3] != ['api', 'v1', 'focuser'] or not parts[3].isdigit():
+                raise LookupError
+            device = self.devices[int(parts[3])]
+            member = parts[4]
+            if member not in (device.GET if method == 'GET' else device.PUT):
+                raise LookupError
+            body = {"ClientTransactionID": transaction, "ServerTransactionID": next(self._transactions),
+                    "ErrorNumber": 0, "ErrorMessage": ""}
+            try:
+                if method == 'GET':
+                    body["Value"] = device.get(member, params)
+                else:
+                    device.put(member, params, client_id, transaction)
+            except FocuserException as e:
+                body["ErrorNumber"] = e.Number
+                body["ErrorMessage"] = e.Message
+        except (LookupError, IndexError):
+            self.respond(request, f'Unknown Alpaca endpoint {method} {url.path}', 404)
+            return
+        except BadRequest as e:
+            self.respond(request, str(e), 400)
+            return
+        self.respond(request, body)
+
+    def management(self, parts: list, method: str):
+        """Value of a management API endpoint"""
+        if method != 'GET':
+            raise LookupError
+        if parts == ['apiversions']:
+            return [1]
+        if parts == ['v1', 'description']:
+            return {"ServerName": Config.name, "Manufacturer": "LNA",
+                    "ManufacturerVersion": "1.0.0", "Location": "OPD"}
+        if parts == ['v1', 'configureddevices']:
+            return [{"DeviceName": device.name, "DeviceType": "Focuser",
+                     "DeviceNumber": device.number, "UniqueID": device.unique_id}
+                    for device in self.devices]
+        raise LookupError
+
+    @staticmethod
+    def respond(request: BaseHTTPRequestHandler, body, status: int = 200):
+        """Sends a JSON body (or a text one for HTTP errors)"""
+        if isinstance(body, str):
+            data, kind = body.encode(), 'text/plain; charset=utf-8'
+        else:
+            data, kind = json.dumps(body).encode(), 'application/json'
+        request.send_response(status)
+        request.send_header('Content-Type', kind)
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ASCOM Alpaca Focuser API of a Focuser160 server')
+    parser.add_argument('--server', default=local_address(Config.ip_address), help='ZeroMQ server address')
+    parser.add_argument('--port', type=int, default=Config.alpaca_port, help='HTTP port')
+    parser.add_argument('--no-discovery', action='store_true', help='do not answer the UDP discovery')
+    args = parser.parse_args()
+    logging.basicConfig(level=Config.log_level)
+    alpaca = AlpacaServer(logging.getLogger('alpaca'), args.server, args.port,
+                          discovery=not args.no_discovery).start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        alpaca.stop()
@@ -10,27 +10,45 @@ from logging import Logger
 import time
 import zmq
 import json
-import socket
-from datetime import datetime
-
-from src.core.config import Config
-
-from src.interface.dmx_eth import FocuserDriver as Focuser
-import sys
-import os
-
-def resource_path(relative_path):
-    """ Get absolute path to resource, works for dev and for PyInstaller """
-    base_path = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
-    return os.path.join(base_path, relative_path)
-
-config_path = resource_path('config/config.toml')
+import multiprocessing
+from threading import Thread, Event
+
+from src.core.config import Config, ConfigWatcher, local_address
+from src.core.profiler import Profiler
+from src.core.tracing import Tracer, trace_id
+from src.core.ratelimit import ClientLimiter
+from src.core.exceptions import ErrorCode, nak
+from src.core.worker import FocuserWorker, run_worker_process, EVENT_FRAME
+
+BACKEND_ENDPOINT = "inproc://workers"
+STATUS_ENDPOINT = "inproc://status"
+URGENT_ENDPOINT = "inproc://urgent"
+STOP = b'STOP'  # single frame control message from broker to worker
+PROFILE_MODES = ('ON', 'CPROFILE', 'OFF', 'DUMP')
+# Refusals of the broker itself
+NAK_INVALID = nak(ErrorCode.INVALID_REQUEST).encode()
+NAK_UNKNOWN = nak(ErrorCode.UNKNOWN_DEVICE).encode()
+NAK_LIMITED = nak(ErrorCode.RATE_LIMITED).encode()
+NAK_VALUE = nak(ErrorCode.INVALID_VALUE).encode()
+NAK_UNAVAILABLE = nak(ErrorCode.WORKER_UNAVAILABLE).encode()
+NO_EVENTS = {}  # poll timeout, shared instead of a new empty dict (never modified)
 
 class App():
+    """ZeroMQ broker in front of one ``FocuserWorker`` per configured device.
+
+    Clients keep using REQ on ``port_rep`` and SUB on ``port_pub``. Requests
+    are routed to a worker by their ``device`` (or ``controller``) field, and
+    every worker runs in its own thread, so a slow device does not stall the
+    others. With a single device every request goes to it, as before.
+
+    With ``sharding = "process"`` each worker runs in its own process instead,
+    connected to the broker through local TCP endpoints. The broker restarts
+    workers that die or stop publishing for ``watchdog`` seconds; clients stay
+    connected to the broker and never notice the restart.
+    """
     def __init__(self, logger: Logger):
 
         self.logger = logger
-        self.config_file = config_path
 
         # Network Settings
         self.context = None
@@ -38,94 +56,109 @@ class App():
         self.port_pub = Config.port_pub
         self.port_rep = Config.port_rep
         self.poller = None
-        self.connection_speed = 0
 
         # Control variables
         self.stop_var = False
-        self.previous_is_mov = False
-        self.previous_homing = False
-        self.previous_pos = 0
-        self.last_ping_time = datetime.now()
-        self.last_pub = datetime.now()
-
-        #variables for status request
-        self._is_moving = False
-        self._position = 0
-        self._homing = False
-        self._stopping = False
-        self._client_id = 0
-        self.busy_id = 0
-        self._current_speed = Config.max_speed
-        self.encoder = 0
-
-        # Status Message
-        self.status = {
-            "absolute": Config.absolute,
-            "alarm": 0,
-            "broker": "Focuser160",
-            "cmd": {
-                "clientId": self._client_id,
-                "clientTransactionId": 0,
-                "clientName": "",
-                "action": ""
-            },
-            "connected": False,
-            "controller": Config.name,
-            "device": Config.device_name,
-            "error": "",
-            "homing": False,
-            "initialized": False,
-            "isMoving": False,
-            "maxSpeed": Config.max_speed,
-            "maxStep": Config.max_step,
-            "position": 0,
-            "tempComp": Config.temp_comp,
-            "tempCompAvailable": Config.tempcompavailable,
-            "temperature": 0,
-            "timestamp": datetime.isoformat(datetime.now(), timespec='milliseconds'),
-            "version": "1.0.0"            
-        }
-        
-        self.device = Focuser(self.logger)
-        self.reach_device()
+        self._stopped = Event()
+        self._stopped.set()
+        self.watcher = None
+        self.alpaca = None
+        self.gateway = None
+
+        # One worker per device, status published on per device topics when
+        # more than one device is configured
+        multi = len(Config.devices) > 1
+        self.workers = [
+            FocuserWorker(self.logger, device, device.device_name.encode() if multi else None)
+            for device in Config.devices
+        ]
+        self.routes = {worker.name: worker for worker in self.workers}
+        self.worker_threads = []
+
+        # Process sharding: workers live in child processes and the objects
+        # above only mirror their published status
+        self.sharding = Config.sharding
+        self.processes = {}
+        self.last_seen = {}
+        self._mp = multiprocessing.get_context('spawn')
+        self._last_supervise = 0.0
+        # Requests forwarded and not answered yet, per worker
+        self.pending = {worker.name: [] for worker in self.workers}
+
+        # Last status published by each worker, answers STATUS requests.
+        # Before the first one STATUS is forwarded to the worker, and the
+        # STATUS requests arriving meanwhile wait for the same answer
+        self.snapshots = {}
+        self.status_waiting = {worker.name: [] for worker in self.workers}
+        self.limiter = ClientLimiter(Config.client_rate, Config.client_burst)
+
+        # Opt-in profiling of the broker loop, toggled by the PROFILE command
+        # or by SIGUSR1 (on/off) and SIGUSR2 (dump)
+        self.profiler = Profiler('broker')
+        self.profiler.instrument(self, 'handle_')
+        self._profile_request = None
+
+        # Broker side spans of the requests, from arrival to the reply, kept
+        # by (worker, envelope) while forwarded (trace setting)
+        self.tracer = Tracer('broker', Config.trace)
+        self.spans = {}
+
+        # Startup metrics, seconds since construction until the first status
+        # and the first status of a connected device are published
+        self.t_init = time.monotonic()
+        self.startup = {"first_pub": None, "first_snapshot": None}
+
+        # Sockets are bound right away, the devices are reached in background
+        # by the workers once ``run`` starts them
         self.start_server()
 
-    def reach_device(self):
-        """Ping device and reads the position and initialized variables"""
-        _try = 0
-        self.last_ping_time = datetime.now()
-        print("Trying Reconnect")
-        for _try in range(5):
-            self.reachable = self.ping_server()            
-            if self.reachable:
-                self.router = True
-                break
-            _try += 1
-            self.router = self.ping_router()
-        
-        if self.reachable:
-            try:
-                self.device.connected = True
-                self._position =self.device.position
-                self.status["position"] = self._position
-                self.status["initialized"] = self.device.initialized
-                self.logger.info(f'Device Reached.')
-            except Exception as e:
-                self.logger.error(f'Error reaching device: {str(e)}') 
+    # Single device view of the default worker, used by the GUI
+    @property
+    def default(self) -> FocuserWorker:
+        return self.workers[0]
+
+    @property
+    def device(self):
+        return self.default.device
+
+    @property
+    def status(self) -> dict:
+        return self.default.status
 
-    def start_server(self): 
-        """ Starts Server ZeroMQ, creating context 
-        then binding PUB and REP sockets"""
+    @property
+    def encoder(self) -> int:
+        return self.default.encoder
+
+    @property
+    def busy_id(self) -> int:
+        return self.default.busy_id
+
+    @property
+    def connection_speed(self):
+        return self.default.connection_speed
+
+    @property
+    def reachable(self) -> bool:
+        return self.default.reachable
+
+    @property
+    def router(self) -> bool:
+        return self.default.router
+
+    def start_server(self):
+        """ Starts Server ZeroMQ, creating context
+        then binding PUB (XPUB) and REP (ROUTER) sockets plus the internal
+        endpoints used by the workers"""
+
+        if self.context:
+            return
 
-        if self.context:    
-            return  
-        
         self.context = zmq.Context()
         print('Context Created')
 
         try:
             # Status Publisher
-            self.publisher = self.context.socket(zmq.PUB)
+            self.publisher = self.context.socket(zmq.XPUB)
             self.publisher.bind(f"tcp://{self.ip_address}:{self.port_pub}")
             print(f"Publisher binded to {self.ip_address}:{self.port_pub}")
         except Exception as e:
@@ -133,308 +166,419 @@ class App():
             return
 
         try:
-            # Command REP
-            self.replier = self.context.socket(zmq.REP)
+            # Command REP, a ROUTER is wire compatible with REQ clients
+            self.replier = self.context.socket(zmq.ROUTER)
             self.replier.bind(f"tcp://{self.ip_address}:{self.port_rep}")
             print(f"REP binded to {self.ip_address}:{self.port_rep}")
         except Exception as e:
             self.logger.error(f'Error Binding Replier: {str(e)}')
             return
 
+        # Internal endpoints for the workers
+        self.backend = self.context.socket(zmq.ROUTER)
+        self.backend.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.backend.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.subscriber = self.context.socket(zmq.XSUB)
+        # HALT fast path, served by a dedicated thread of each worker
+        self.urgent = self.context.socket(zmq.ROUTER)
+        self.urgent.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.urgent.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        if self.sharding == 'process':
+            port = self.backend.bind_to_random_port('tcp://127.0.0.1')
+            self.backend_endpoint = f'tcp://127.0.0.1:{port}'
+            port = self.subscriber.bind_to_random_port('tcp://127.0.0.1')
+            self.status_endpoint = f'tcp://127.0.0.1:{port}'
+            port = self.urgent.bind_to_random_port('tcp://127.0.0.1')
+            self.urgent_endpoint = f'tcp://127.0.0.1:{port}'
+        else:
+            self.backend.bind(BACKEND_ENDPOINT)
+            self.subscriber.bind(STATUS_ENDPOINT)
+            self.urgent.bind(URGENT_ENDPOINT)
+            self.backend_endpoint = BACKEND_ENDPOINT
+            self.status_endpoint = STATUS_ENDPOINT
+            self.urgent_endpoint = URGENT_ENDPOINT
+        # Receive every status, even without clients, for the startup
+        # metrics and the status mirror of worker processes
+        self.subscriber.send(b'\x01')
+
         # Poller
         self.poller = zmq.Poller()
-        self.poller.register(self.replier, zmq.POLLIN)        
+        self.poller.register(self.replier, zmq.POLLIN)
+        self.poller.register(self.backend, zmq.POLLIN)
+        self.poller.register(self.urgent, zmq.POLLIN)
+        self.poller.register(self.subscriber, zmq.POLLIN)
+        self.poller.register(self.publisher, zmq.POLLIN)
         self.logger.info(f'Server Started')
-        self.pub_status()
-    
+
     def close_connection(self):
-        """Unbind all sockets and destroy context"""
-        self.device.disconnect()
-        self.status["connected"] = self.device.connected
-        self.pub_status()
-        try:
-            self.publisher.unbind(f"tcp://{self.ip_address}:{self.port_pub}")
-            self.logger.info(f'Disconnecting Publisher')
-        except Exception as e:
-            self.logger.error(f'Error closing Publisher connection: {str(e)}')
-        try:
-            self.replier.unbind(f"tcp://{self.ip_address}:{self.port_rep}")
-            self.logger.info(f'Disconnecting Replier')
-        except Exception as e:
-            self.logger.error(f'Error closing Replier connection: {str(e)}')
-        
+        """Close all sockets and destroy context"""
+        if not self.context:
+            return
+        for sock in (self.publisher, self.replier, self.backend, self.subscriber, self.urgent):
+            try:
+                sock.close(linger=0)
+            except Exception as e:
+                self.logger.error(f'Error closing socket: {str(e)}')
+        self.logger.info(f'Disconnecting Publisher')
+        self.logger.info(f'Disconnecting Replier')
         self.context.destroy()
         self.context = None
 
     def disconnect(self):
         """Stops main loop and close all sockets"""
         self.stop()
+        if not self._stopped.wait(5):
+            self.logger.error('Main loop did not stop')
         self.close_connection()
 
         self.logger.info(f'Server Disconnecting')
-    
-    def pub_status(self):
-        """Publishes status via ZeroMQ"""
-        self.status["timestamp"] = datetime.isoformat(datetime.now(), timespec='milliseconds')
-        json_string = json.dumps(self.status)        
-        self.publisher.send_string(json_string)
-        self.logger.info(f'Status published: {self.status}')
-    
+
     def stop(self):
-        """Stop main loop and unregister zmq.POLL"""
+        """Stop main loop and the device workers"""
         self.stop_var = True
-        if self.poller:
-            self.poller.unregister(self.replier)
-            self.poller = None
-            time.sleep(.2)
-    
-    def ping_server(self):
-        """Check if motor is reachable
-        ::returns:: bool
-        """
+        for worker in self.workers:
+            worker.stop()
+
+    def on_config_change(self, applied: list):
+        """Reflects live config changes on the status of the workers"""
+        for worker in self.workers:
+            worker.refresh_config()
+        self.limiter.rate = Config.client_rate
+        self.limiter.burst = Config.client_burst
+        self.tracer.configure(Config.trace)
+        self.logger.info(f'Config applied: {applied}')
+
+    def route(self, msg: dict) -> FocuserWorker:
+        """Selects the worker addressed by a request, ``None`` if unknown"""
+        for key in ("device", "controller"):
+            worker = self.routes.get(msg.get(key))
+            if worker:
+                return worker
+        if len(self.workers) == 1:
+            return self.default
+        return None
+
+    def handle_frontend(self):
+        """Forwards a client request to its worker, STATUS is answered here"""
+        frames = self.replier.recv_multipart()
+        envelope, payload = frames[:-1], frames[-1]
+        action = None
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(.6)
-            s.connect((Config.device_ip, Config.device_port))
-            s.close()
-            time.sleep(.1)
-            return True
+            msg = json.loads(payload)
+            worker = self.route(msg)
+            action = msg.get("action")
         except Exception as e:
-            return False 
-
-    def ping_router(self):
-        """Check if router is reachable
-        ::returns:: bool
-        """
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(.6)
-            s.connect((Config.router_ip, 80))
-            s.close()
-            time.sleep(.1)
-            return True
-        except Exception as e:
-            return False           
-
-    def handle_home(self):
-        """Executes the INIT routine, which means moving motor axis to the
-        microswitches and then removing the backlash until the encoder return 0"""
+            self.logger.error(f'Invalid request: {str(e)}')
+            worker = None
+        span = None
+        if self.tracer.enabled and action is not None:
+            span = self.tracer.start('broker.request', trace_id(msg.get("clientId"), msg.get("clientTransactionId")),
+                                     action=action, device=worker.name if worker else '')
+        profile = isinstance(action, str) and action.startswith('PROFILE=')
+        if worker is None and not profile:
+            reply = NAK_INVALID if action is None else NAK_UNKNOWN
+            self.replier.send_multipart(envelope + [reply])
+            self.tracer.finish(span, reply=reply.decode())
+            return
+        if action != 'HALT' and not self.limiter.allow(msg.get("clientId") or envelope[0], time.monotonic()):
+            self.replier.send_multipart(envelope + [NAK_LIMITED])
+            self.tracer.finish(span, reply=NAK_LIMITED.decode(), limited=True)
+            return
+        if profile:
+            reply = b'ACK' if self.handle_profile(action[8:], None if len(self.workers) == 1 else msg.get("device")) else NAK_VALUE
+            self.replier.send_multipart(envelope + [reply])
+            self.tracer.finish(span, reply=reply.decode())
+            return
+        if action == 'HALT':
+            try:
+                self.urgent.send_multipart([worker.name.encode()] + frames)
+                self.pending[worker.name].append(envelope)
+                if span is not None:
+                    self.spans[(worker.name, tuple(envelope))] = span
+                return
+            except zmq.ZMQError:
+                # Urgent thread not connected, the worker loop handles it
+                pass
+        if action == 'STATUS':
+            snapshot = self.snapshots.get(worker.name)
+            if snapshot is not None:
+                self.replier.send_multipart(envelope + [snapshot])
+                self.tracer.finish(span, reply='snapshot')
+                return
+            waiting = self.status_waiting[worker.name]
+            waiting.append(envelope)
+            if len(waiting) > 1:
+                # Coalesced with the STATUS already forwarded
+                return
         try:
-            res = self.device.home()
-            time.sleep(.1)
-            if res == "OK":
-                self._homing = True
-                self._is_moving = True
+            self.backend.send_multipart([worker.name.encode()] + frames)
+        except zmq.ZMQError:
+            # Worker not connected (yet), e.g. while its process restarts
+            if action == 'STATUS':
+                self.answer_waiting(worker.name, NAK_UNAVAILABLE)
             else:
-                self.status["alarm"] = self.device.alarm
-            self.logger.info(f'Device Homing {res}')
-        except Exception as e:
-            self.status["alarm"] = self.device.alarm
-            self.status["error"] = str(e)
-            self.logger.error(f'Homing {e}')
-            self.pub_status()
-
-    def handle_halt(self):
-        """Stops the motor"""
-        if self.device.Halt():
-            time.sleep(.1)
-            self._is_moving = True # set _is_moving to true so the main loop can realy check if the motor is moving or not
-            self.logger.info(f'Device Stopped')
-        else:
-            self.status["alarm"] = self.device.alarm
-            self.logger.info(f'Halt Fail')
-
-    def handle_speed(self, vel):
-        """Change the motor's speed"""
-        if vel > Config.max_speed:
-            vel = Config.max_speed
-        elif vel <=0:
-            vel = Config.max_speed
-        try:
-            if self.device.speed(vel):
-                time.sleep(.1)
-                self.logger.info(f'Speed changed')
+                self.replier.send_multipart(envelope + [NAK_UNAVAILABLE])
+            self.tracer.finish(span, reply=NAK_UNAVAILABLE.decode(), forwarded=False)
+            return
+        self.pending[worker.name].append(envelope)
+        if span is not None:
+            self.spans[(worker.name, tuple(envelope))] = span
+
+    def handle_profile(self, mode: str, device: str = None) -> bool:
+        """Starts, stops or dumps the profilers of the broker and of the
+        workers (only ``device`` if given)
+        Args:
+            mode (str): ON, CPROFILE (ON plus cProfile), OFF or DUMP.
+        """
+        if mode not in PROFILE_MODES:
+            return False
+        if device is None:
+            if mode in ('ON', 'CPROFILE'):
+                self.profiler.start(cprofile=mode == 'CPROFILE')
+            elif mode == 'OFF':
+                self.profiler.stop()
             else:
-                self.logger.info(f'Speed change Fail')
-        except Exception as e:
-            self.logger.error(f"Error speed {str(e)}")
-
-    def handle_connect(self):
-        """(Deprecated) - Self explained"""
-        self.logger.info(f'Device Connected')
-        self.device.position
-        self.pub_status()
-
-    def handle_disconnect(self):
-        """(Deprecated) - Self explained"""
-        self.logger.info(f'Device Disconnected')
-    
-    def handle_in_out(self, direction, speed):
-        """Move focuser to a position
-        Args: 
-            direction (int): 1 for IN, 0 for OUT.
-            speed microns/s(integer)
-        """   
+                self.logger.info(f'Profile of the broker dumped to {self.profiler.dump()}')
+        # Workers apply it in their own thread (or process), where cProfile must run
+        for worker in self.workers:
+            if device is None or worker.name == device:
+                try:
+                    self.backend.send_multipart([worker.name.encode(), b'PROFILE:' + mode.encode()])
+                except zmq.ZMQError:
+                    pass
+        return True
+
+    def install_signal_handlers(self):
+        """SIGUSR1 toggles profiling, SIGUSR2 dumps the profiles. Must be
+        called from the main thread, not available on Windows"""
+        import signal
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        def toggle(signum, frame):
+            self._profile_request = 'OFF' if self.profiler.enabled else 'ON'
+        def dump(signum, frame):
+            self._profile_request = 'DUMP'
+        signal.signal(signal.SIGUSR1, toggle)
+        signal.signal(signal.SIGUSR2, dump)
+
+    def answer_waiting(self, name: str, reply: bytes):
+        """Answers every STATUS request waiting for the worker ``name``"""
+        for envelope in self.status_waiting[name]:
+            self.replier.send_multipart(envelope + [reply])
+            self.finish_span(name, envelope, reply)
+        self.status_waiting[name] = []
+
+    def finish_span(self, name: str, envelope: list, reply: bytes):
+        """Ends the span of a forwarded request, if traced"""
+        if self.spans:
+            span = self.spans.pop((name, tuple(envelope)), None)
+            self.tracer.finish(span, reply=reply.decode() if reply.startswith(b'NAK') or reply == b'ACK' else 'status')
+
+    def handle_backend(self):
+        """Forwards a worker reply to its client"""
+        frames = self.backend.recv_multipart()
+        name = frames[0].decode()
+        envelope = frames[1:-1]
+        pending = self.pending.get(name)
+        if pending and envelope in pending:
+            pending.remove(envelope)
+        self.last_seen[name] = time.monotonic()
+        waiting = self.status_waiting.get(name)
+        if waiting and waiting[0] == envelope:
+            self.answer_waiting(name, self.snapshots.get(name, frames[-1]))
+            return
+        # [worker, client, b'', reply] -> [client, b'', reply]
+        self.replier.send_multipart(frames[1:])
+        self.finish_span(name, envelope, frames[-1])
+
+    def handle_urgent(self):
+        """Forwards a HALT reply of the urgent path to its client"""
+        frames = self.urgent.recv_multipart()
+        name = frames[0].decode()
+        envelope = frames[1:-1]
+        pending = self.pending.get(name)
+        if pending and envelope in pending:
+            pending.remove(envelope)
+        self.replier.send_multipart(frames[1:])
+        self.finish_span(name, envelope, frames[-1])
+
+    def handle_status(self):
+        """Forwards a worker status to the subscribers"""
+        frames = self.subscriber.recv_multipart()
+        event = frames[-1] == EVENT_FRAME
+        if event:
+            frames.pop()
+        self.publisher.send_multipart(frames)
+        payload = frames[-1]
+        if not event:
+            # Sequence events are not repeated to STATUS requests
+            name = frames[0].decode() if len(frames) > 1 else self.default.name
+            self.snapshots[name] = payload
+        if self.startup["first_snapshot"] is None:
+            self.measure_startup(frames[-1])
+        if self.sharding == 'process':
+            # Mirror the status of worker processes for the GUI and watchdog
+            try:
+                data = json.loads(frames[-1])
+                worker = self.routes.get(data.get("device"))
+                if worker:
+                    worker.status.update(data)
+                    self.last_seen[worker.name] = time.monotonic()
+            except Exception as e:
+                self.logger.error(f'Invalid status from worker: {str(e)}')
+
+    def measure_startup(self, payload: bytes):
+        """Records the time to the first status and to the first device snapshot"""
+        elapsed = time.monotonic() - self.t_init
+        if self.startup["first_pub"] is None:
+            self.startup["first_pub"] = elapsed
+            self.logger.info(f'Startup: first status published after {elapsed*1000:.1f} ms')
         try:
-            if int(speed) != Config.max_speed:
-                self.handle_speed(int(speed))
-            if direction == 1:
-                # FOCUS IN
-                self.device.focus_in_out(int(direction))
-                self.logger.info(f'Moving FOCUSIN')
-            elif direction == 0:
-                # FOCUS OUT
-                self.device.focus_in_out(int(direction))
-                self.logger.info(f'Moving FOCUSOUT')
-            time.sleep(.1)
-            self._is_moving = True
-        except Exception as e:
-            self.status["alarm"] = self.device.alarm
-            self.status["error"] = str(e)
-            self.logger.error(f'Moving FOCUS IN | OUT')
-            self.pub_status()
-
-    def handle_move(self, pos, speed):
-        """Move focuser to a position
-        Args: 
-            position microns (integer)
-            speed microns/s(integer)
-        """   
+            connected = json.loads(payload).get("connected")
+        except Exception:
+            return
+        if connected:
+            self.startup["first_snapshot"] = elapsed
+            self.logger.info(f'Startup: first device snapshot published after {elapsed*1000:.1f} ms')
+
+    def start_alpaca(self):
+        """Starts the Alpaca API, a client of this server answering from
+        the published status"""
+        from src.core.alpaca import AlpacaServer
+        bind = '' if self.ip_address in ('*', '0.0.0.0') else self.ip_address
+        alpaca = AlpacaServer(self.logger, local_address(self.ip_address), Config.alpaca_port,
+                              bind, Config.alpaca_discovery)
         try:
-            self.device.move(int(pos))
-            self.logger.info(f'Moving to {pos} position')
-            time.sleep(.1)
-            self._is_moving = True
-        except Exception as e:
-            self.status["alarm"] = self.device.alarm
-            self.status["error"] = str(e)
-            self.logger.error(f'Moving {pos}: {str(e)}')
-            self.pub_status()
-
-    def update_status(self):
-        """Verifies if there is a change in state variables, 
-        such as _is_moving, _homing and _position and publishes in ZeroMQ"""
-        if self._position != self.previous_pos:
-            self.status["position"] = self._position
-            self.previous_pos = self._position
-            self.pub_status()
-            self.encoder = int(self._position * Config.enc_2_microns)
-
-        if self._is_moving != self.previous_is_mov:
-            self.status["isMoving"] = self._is_moving
-            self.previous_is_mov = self._is_moving 
-            self.status["initialized"] = self.device.initialized
-            self.pub_status()
-
-        if self._homing != self.previous_homing:
-            self.status["homing"] = self._homing            
-            self.previous_homing = self._homing
-            self.pub_status()
-
-        # if self._is_moving and self._homing:
-        #     self.status["clientId"] = 0
-
-    def reply(self, msg):
-        self.replier.send_string(msg)
+            self.alpaca = alpaca.start()
+        except OSError as e:
+            alpaca.stop()
+            self.logger.error(f'Alpaca API not started: {str(e)}')
+
+    def start_gateway(self):
+        """Starts the WebSocket gateway, one more subscriber of the status
+        stream fanning it out to the browser dashboards"""
+        from src.core.wsgateway import WebSocketGateway
+        bind = '' if self.ip_address in ('*', '0.0.0.0') else self.ip_address
+        try:
+            self.gateway = WebSocketGateway(self.logger, f'tcp://{local_address(self.ip_address)}:{self.port_pub}',
+                                            Config.websocket_port, bind, Config.websocket_max_clients).start()
+        except OSError as e:
+            self.logger.error(f'WebSocket gateway not started: {str(e)}')
+
+    def spawn(self, worker: FocuserWorker):
+        """Starts (or restarts) the process of a worker"""
+        proc = self._mp.Process(target=run_worker_process,
+                                args=(worker.config, worker.topic, self.backend_endpoint,
+                                      self.status_endpoint, self.urgent_endpoint),
+                                name=f'worker-{worker.name}',
+                                daemon=True)
+        proc.start()
+        self.processes[worker.name] = proc
+        self.last_seen[worker.name] = time.monotonic()
+        self.logger.info(f'Worker {worker.name} started, pid {proc.pid}')
+
+    def supervise(self):
+        """Restarts worker processes that died or stopped publishing"""
+        now = time.monotonic()
+        if now - self._last_supervise < 1:
+            return
+        self._last_supervise = now
+        for worker in self.workers:
+            proc = self.processes.get(worker.name)
+            hung = now - self.last_seen.get(worker.name, now) > Config.watchdog
+            if proc.is_alive() and not hung:
+                continue
+            if proc.is_alive():
+                self.logger.error(f'Worker {worker.name} hung, restarting')
+                proc.kill()
+            else:
+                self.logger.error(f'Worker {worker.name} exited ({proc.exitcode}), restarting')
+            proc.join(1)
+            # Requests the dead worker will never answer
+            for envelope in self.pending[worker.name]:
+                if envelope not in self.status_waiting[worker.name]:
+                    self.replier.send_multipart(envelope + [NAK_UNAVAILABLE])
+                    self.finish_span(worker.name, envelope, NAK_UNAVAILABLE)
+            self.pending[worker.name] = []
+            self.answer_waiting(worker.name, NAK_UNAVAILABLE)
+            worker.status["connected"] = False
+            self.spawn(worker)
+
+    def start_workers(self):
+        """Starts one thread (or process) per device worker"""
+        self.worker_threads = []
+        if self.sharding == 'process':
+            for worker in self.workers:
+                self.spawn(worker)
+            return
+        for worker in self.workers:
+            thread = Thread(target=worker.run,
+                            args=(self.context, self.backend_endpoint, self.status_endpoint,
+                                  self.urgent_endpoint),
+                            name=f'worker-{worker.name}',
+                            daemon=True)
+            thread.start()
+            self.worker_threads.append(thread)
 
     def run(self):
         """Main Loop"""
-        self._client_id = 0
         self.start_server()
+        if not self.poller:
+            return
         self.stop_var = False
-        self.status["connected"] = self.device.connected
-        while not self.stop_var:
-            t0 = time.time()
-            current_time = datetime.now()
-            if -1 >= (current_time.second - self.last_pub.second) or (current_time.second - self.last_pub.second) >= 1:  
-                self.device.position              
-                self.pub_status()
-                self.last_pub = current_time                
-            if self.device and self.device.connected and self.poller:
-                socks = dict(self.poller.poll(50))
+        self._stopped.clear()
+        self.watcher = ConfigWatcher(Config, self.logger, on_change=self.on_config_change)
+        self.watcher.start()
+        self.start_workers()
+        if Config.alpaca:
+            self.start_alpaca()
+        if Config.websocket:
+            self.start_gateway()
+        try:
+            while not self.stop_var:
+                events = self.poller.poll(100)
+                socks = dict(events) if events else NO_EVENTS
+                t0 = time.perf_counter()
+                if self._profile_request:
+                    mode, self._profile_request = self._profile_request, None
+                    self.handle_profile(mode)
+                if socks.get(self.urgent) == zmq.POLLIN:
+                    self.handle_urgent()
                 if socks.get(self.replier) == zmq.POLLIN:
-                    msg_rep = self.replier.recv_string()
-                    try:
-                        msg_rep = json.loads(msg_rep)
-                        cmd = msg_rep.get("action") 
-                        if not 'STATUS' in cmd and (msg_rep.get("clientId") == self._client_id or self._client_id == 0):
-                            # Only accept commands (except for status request) if not busy or if it 
-                            # was requested by the same client
-                            self.status["cmd"] = msg_rep
-                            self._client_id = msg_rep.get("clientId") 
-                    except Exception as e:
-                        print(e)
-                        self.reply('NAK')
-                    try:
-                        # Handle all possible commands
-                        self.status["error"] = ""
-                        command_handlers = {
-                            'HOME': self.handle_home,
-                            'HALT': self.handle_halt,
-                            'CONNECT': self.handle_connect,
-                            'DISCONNECT': self.handle_disconnect,
-                            'STATUS': self.pub_status,
-                        }
-
-                        command_processed = False
-
-                        if "MOVE=" in cmd and self.busy_id == 0:
-                            self.handle_move(cmd[5:], Config.max_speed)
-                            self.reply('ACK')
-                            command_processed = True
-
-                        if "FOCUSIN" in cmd and self.busy_id == 0:
-                            self.handle_in_out(1, cmd[8:])
-                            self.reply('ACK')
-                            command_processed = True
-
-                        if "FOCUSOUT" in cmd and self.busy_id == 0:
-                            self.handle_in_out(0, cmd[9:])
-                            self.reply('ACK')
-                            command_processed = True
-
-                        if "HALT" in cmd and (self._client_id == self.busy_id or self.busy_id == 0):
-                            self.handle_halt()
-                            self.reply('ACK')
-                            command_processed = True
-
-                        if cmd in command_handlers and self.busy_id == 0:
-                            command_handlers[cmd]()
-                            self.reply('ACK')
-                            command_processed = True
-
-                        if not command_processed:
-                            self.reply('NAK')
-
-                        self.status["connected"] = self.device.connected
-
-                    except Exception as e:
-                        self.pub_status()
-                        self.logger.error(f'Error: {str(e)}')
-
-                if self._is_moving:
-                    self._is_moving = self.device.is_moving
-                    time.sleep(.05)
-                    self._position = self.device.position
-                if self._homing:
-                    self._homing = self.device.homing 
-                    # self._position = self.device.position 
-                if not self._homing and not self._is_moving:
-                    # this means the device is not busy
-                    self._client_id = 0
-                    self.status["cmd"] =  {
-                                            "clientId": self._client_id,
-                                            "clientTransactionId": 0,
-                                            "clientName": "",
-                                            "action": ""
-                                            }                    
-                
-                self.busy_id = self._client_id
-                self.update_status()                
-                self.status["alarm"] = 0
-            else:
-                if (current_time - self.last_ping_time).total_seconds() >= 7:
-                    self.reach_device()
-                self.status["connected"] = self.device.connected
-            self.connection_speed = f"interval:  {round(time.time()-t0, 3)}"
-
+                    self.handle_frontend()
+                if socks.get(self.backend) == zmq.POLLIN:
+                    self.handle_backend()
+                if socks.get(self.subscriber) == zmq.POLLIN:
+                    self.handle_status()
+                if socks.get(self.publisher) == zmq.POLLIN:
+                    # Forward subscriptions so workers can filter topics
+                    self.subscriber.send_multipart(self.publisher.recv_multipart())
+                if self.processes:
+                    self.supervise()
+                if socks and self.profiler.enabled:
+                    self.profiler.add('run_iteration', time.perf_counter() - t0)
+            for thread in self.worker_threads:
+                thread.join(5)
+            for name in self.processes:
+                try:
+                    self.backend.send_multipart([name.encode(), STOP])
+                except zmq.ZMQError:
+                    pass
+            for proc in self.processes.values():
+                proc.join(5)
+                if proc.is_alive():
+                    proc.kill()
+            self.processes = {}
+            # Forward the last status published by the workers
+            while self.subscriber.poll(50):
+                self.handle_status()
+        finally:
+            if self.alpaca is not None:
+                self.alpaca.stop()
+                self.alpaca = None
+            if self.gateway is not None:
+                self.gateway.stop()
+                self.gateway = None
+            self.watcher.stop()
+            self.tracer.close()
+            self._stopped.set()
@@ -0,0 +1,189 @@
+# calibration.py - Encoder <-> micron calibration
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+from array import array
+from bisect import bisect_left
+import csv
+
+try:
+    import numpy as np
+    NUMPY = True
+except ImportError:
+    NUMPY = False
+
+MODELS = ('linear', 'quadratic', 'interp')
+
+def fit_polynomial(x: list, y: list, degree: int) -> list:
+    """Least squares polynomial fit, returns coefficients from the highest degree"""
+    if NUMPY:
+        return [float(c) for c in np.polyfit(x, y, degree)]
+    # Normal equations, small degree and few points
+    n = degree + 1
+    a = [[sum(xi ** (i + j) for xi in x) for j in range(n)] for i in range(n)]
+    b = [sum(yi * xi ** i for xi, yi in zip(x, y)) for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        a[col], a[pivot] = a[pivot], a[col]
+        b[col], b[pivot] = b[pivot], b[col]
+        for row in range(col + 1, n):
+            f = a[row][col] / a[col][col]
+            for k in range(col, n):
+                a[row][k] -= f * a[col][k]
+            b[row] -= f * b[col]
+    coef = [0.0] * n
+    for row in range(n - 1, -1, -1):
+        coef[row] = (b[row] - sum(a[row][k] * coef[k] for k in range(row + 1, n))) / a[row][row]
+    return coef[::-1]
+
+class Calibration():
+    """Encoder counts <-> microns conversion from a calibration table.
+
+    The table is fitted (``linear`` or ``quadratic``) or linearly
+    interpolated (``interp``) once, and sampled into dense forward and
+    inverse lookup tables. Each conversion is then an index plus a linear
+    interpolation between two table nodes, O(1) in the poll and move paths.
+
+    Args:
+        encoder (list): Encoder counts of the calibration points.
+        microns (list): Measured position, in microns, of each point.
+        max_counts (int): Encoder travel covered by the lookup tables.
+        model (str): ``linear``, ``quadratic`` or ``interp``.
+        resolution (int): Encoder counts between forward table nodes.
+    Raises:
+        ValueError if the table is invalid or the model is not monotonic
+    """
+    def __init__(self, encoder: list, microns: list, max_counts: int,
+                 model: str = 'interp', resolution: int = 16):
+        if model not in MODELS:
+            raise ValueError(f'Calibration model must be one of {MODELS}')
+        if len(encoder) != len(microns) or len(encoder) < 2:
+            raise ValueError('Calibration table needs at least two (encoder, microns) points')
+        points = sorted(zip(encoder, microns))
+        self.encoder = [float(p[0]) for p in points]
+        self.microns = [float(p[1]) for p in points]
+        self.model = model
+        self.max_counts = int(max_counts)
+        self.resolution = int(resolution)
+
+        if model == 'linear':
+            self.coefficients = fit_polynomial(self.encoder, self.microns, 1)
+        elif model == 'quadratic':
+            self.coefficients = fit_polynomial(self.encoder, self.microns, 2)
+        else:
+            self.coefficients = []
+        self._build_tables()
+
+    @classmethod
+    def from_factor(cls, enc_2_microns: float, max_counts: int) -> 'Calibration':
+        """Linear calibration equivalent to the ``encoder2microns`` factor"""
+        return cls([0, max_counts], [0, max_counts / enc_2_microns], max_counts, 'linear')
+
+    @classmethod
+    def load(cls, path: str, max_counts: int, model: str = 'interp') -> 'Calibration':
+        """Loads a CSV table with ``encoder,microns`` rows ('#' comments and
+        a header row are allowed)"""
+        encoder, microns = [], []
+        with open(path, newline='') as file:
+            for row in csv.reader(file):
+                if not row or row[0].strip().startswith('#'):
+                    continue
+                try:
+                    enc, mic = float(row[0]), float(row[1])
+                except (ValueError, IndexError):
+                    continue  # header
+                encoder.append(enc)
+                microns.append(mic)
+        return cls(encoder, microns, max_counts, model)
+
+    @classmethod
+    def for_device(cls, device) -> 'Calibration':
+        """Calibration of a ``DeviceConfig``: its table if configured,
+        otherwise the linear ``encoder2microns`` factor"""
+        if device.calibration:
+            return cls.load(device.calibration, device.max_counts, device.calibration_model)
+        return cls.from_factor(device.enc_2_microns, device.max_counts)
+
+    def model_value(self, counts: float) -> float:
+        """Evaluates the model (not the lookup table) at ``counts``"""
+        if self.coefficients:
+            value = 0.0
+            for c in self.coefficients:
+                value = value * counts + c
+            return value
+        x, y = self.encoder, self.microns
+        i = min(max(bisect_left(x, counts), 1), len(x) - 1)
+        x0, x1 = x[i - 1], x[i]
+        return y[i - 1] + (y[i] - y[i - 1]) * (counts - x0) / (x1 - x0)
+
+    def _build_tables(self):
+        """Samples the model into the forward and inverse lookup tables"""
+        res = self.resolution
+        nodes = self.max_counts // res + 2
+        forward = array('d', (self.model_value(i * res) for i in range(nodes)))
+        for a, b in zip(forward, forward[1:]):
+            if b <= a:
+                raise ValueError('Calibration is not strictly increasing over the encoder range')
+        self._forward = forward
+
+        # Inverse table, same number of nodes over the micron range
+        self._m0 = forward[0]
+        self._mres = (forward[-1] - forward[0]) / (nodes - 1)
+        inverse = array('d')
+        k = 1
+        for j in range(nodes):
+            m = self._m0 + j * self._mres
+            while k < nodes - 1 and forward[k] < m:
+                k += 1
+            m0, m1 = forward[k - 1], forward[k]
+            inverse.append(((k - 1) + (m - m0) / (m1 - m0)) * res)
+        self._inverse = inverse
+
+        if NUMPY:
+            self._forward_np = np.frombuffer(forward, dtype=np.float64)
+            self._inverse_np = np.frombuffer(inverse, dtype=np.float64)
+
+    def to_microns(self, counts: float) -> float:
+        """Encoder counts to microns"""
+        table = self._forward
+        pos = counts / self.resolution
+        i = int(pos)
+        if i < 0:
+            i = 0
+        elif i > len(table) - 2:
+            i = len(table) - 2
+        return table[i] + (table[i + 1] - table[i]) * (pos - i)
+
+    def to_counts(self, microns: float) -> int:
+        """Microns to (rounded) encoder counts"""
+        table = self._inverse
+        pos = (microns - self._m0) / self._mres
+        i = int(pos)
+        if i < 0:
+            i = 0
+        elif i > len(table) - 2:
+            i = len(table) - 2
+        return int(round(table[i] + (table[i + 1] - table[i]) * (pos - i)))
+
+    def to_microns_array(self, counts):
+        """Vectorized ``to_microns`` for telemetry arrays"""
+        if not NUMPY:
+            return [self.to_microns(c) for c in counts]
+        pos = np.asarray(counts, dtype=np.float64) / self.resolution
+        return self._lerp(self._forward_np, pos)
+
+    def to_counts_array(self, microns):
+        """Vectorized ``to_counts`` for telemetry arrays"""
+        if not NUMPY:
+            return [self.to_counts(m) for m in microns]
+        pos = (np.asarray(microns, dtype=np.float64) - self._m0) / self._mres
+        return np.rint(self._lerp(self._inverse_np, pos)).astype(np.int64)
+
+    @staticmethod
+    def _lerp(table, pos):
+        """Array version of the table lookup used by the scalar conversions"""
+        i = np.clip(np.floor(pos).astype(np.int64), 0, len(table) - 2)
+        return table[i] + (table[i + 1] - table[i]) * (pos - i)
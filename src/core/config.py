@@ -5,9 +5,15 @@
 #
 # Python Compatibility: Requires Python 3.10 or later
 
+from dataclasses import dataclass, field
 from pathlib import Path
+from threading import Thread, Event
+import logging
 import toml
 import sys
+import os
+
+from src.core.calibration import MODELS as CALIBRATION_MODELS
 
 def resource_path(relative_path: str) -> Path:
     if hasattr(sys, "_MEIPASS"):
@@ -16,48 +22,384 @@ def resource_path(relative_path: str) -> Path:
 
 config_file = resource_path('config/config.toml')
 
-_dict = {}
-_dict = toml.load(config_file)
-def get_toml(sect: str, item: str):
-    if not _dict is {}:
-        return _dict[sect][item]
-    else:
-        return ''
-
-class Config:
-    """Device configuration in ``config.toml``"""
-    # ---------------
-    # General Section
-    # ---------------
-    startup: str = get_toml('General', 'startup')
-    name: str = get_toml('General', 'name')
-    # ---------------
-    # Network Section
-    # ---------------
-    ip_address: str = get_toml('Network', 'ip_address')
-    port_pub: int = get_toml('Network', 'port_pub')
-    port_rep: int = get_toml('Network', 'port_rep')
-    # --------------
-    # Device Section
-    # --------------
-    device_name: str = get_toml('Device', 'device_name')
-    device_ip: str = get_toml('Device', 'device_ip')
-    router_ip: str = get_toml('Device', 'router_ip')
-    device_port: int = get_toml('Device', 'device_port')
-    absolute: bool = get_toml('Device', 'absolute')
-    max_step: int = get_toml('Device', 'max_step')
-    temp_comp: bool = get_toml('Device', 'temp_comp')
-    stepsize: int = get_toml('Device', 'step_size')
-    max_speed: int = get_toml('Device', 'max_speed')
-    enc_2_microns: float = get_toml('Device', 'encoder2microns')
-    speed_factor: int = get_toml('Device', 'speedFactor')
-    maxincrement: int = get_toml('Device', 'max_increment')
-    speed_security: int = get_toml('Device', 'speed_security')
-    tempcompavailable: bool = get_toml('Device', 'tempcompavailable')
-    # ---------------
-    # Logging Section
-    # ---------------
-    log_level: str = get_toml('Logging', 'log_level')
-    log_to_stdout: bool = get_toml('Logging', 'log_to_stdout')
-    log_max_size_mb: int = get_toml('Logging', 'log_max_size_mb')
-    log_num_keep: int = get_toml('Logging', 'log_num_keep')
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+SHARDING_MODES = ('thread', 'process')
+TRACE_FORMATS = ('', 'jsonl', 'otlp')
+
+def get_toml(data: dict, sect: str, item: str, default=None):
+    """Reads ``[sect] item``, raising ValueError when a required key is missing"""
+    try:
+        return data[sect][item]
+    except (KeyError, TypeError):
+        if default is not None:
+            return default
+        raise ValueError(f"Missing '{item}' in [{sect}] of {config_file}")
+
+def local_address(address: str) -> str:
+    """Address to reach a server bound to ``address`` from this machine"""
+    return '127.0.0.1' if address in ('*', '0.0.0.0', '') else address
+
+def check(condition: bool, message: str):
+    """Raises ValueError with ``message`` if ``condition`` is false"""
+    if not condition:
+        raise ValueError(message)
+
+@dataclass
+class DeviceConfig:
+    """Settings of one DMX-ETH device, a ``[Device]`` or ``[[Devices]]`` table.
+
+    The conversion factors used by the driver hot paths are precomputed
+    from the settings, and recomputed by ``derive`` whenever they change.
+    """
+    device_name: str
+    device_ip: str
+    router_ip: str
+    device_port: int
+    absolute: bool
+    max_step: int
+    temp_comp: bool
+    stepsize: int
+    max_speed: int
+    enc_2_microns: float
+    speed_factor: int
+    maxincrement: int
+    speed_security: int
+    tempcompavailable: bool
+    calibration: str = ''               # encoder,microns CSV table, empty for encoder2microns
+    calibration_model: str = 'interp'   # linear, quadratic or interp
+    temp_source: str = ''               # file:<path> or udp:<host>:<port>, empty for none
+    temp_coefficient: float = 0.0       # microns/°C, 0 to fit it from the focus history
+    temp_hysteresis: float = 5.0        # minimum focus error (microns) to correct
+    temp_interval: float = 60.0         # minimum seconds between corrective moves
+    connections: int = 2                # TCP sessions: 2 polls apart from commands, 1 shares one
+
+    # Derived values
+    microns_2_enc: float = field(init=False, repr=False)  # microns per encoder count
+    max_counts: int = field(init=False, repr=False)       # max_step in encoder counts
+    max_speed_conv: int = field(init=False, repr=False)   # max_speed in motor units
+
+    # Settings applied live by the config watcher
+    SAFE = ('max_speed', 'speed_factor', 'speed_security',
+            'temp_coefficient', 'temp_hysteresis', 'temp_interval')
+
+    def __post_init__(self):
+        self.validate()
+        self.derive()
+
+    def validate(self):
+        name = f"[Device] {self.device_name}"
+        check(isinstance(self.device_name, str) and self.device_name != '', "[Device] device_name must be a non empty string")
+        check(isinstance(self.device_port, int) and 0 < self.device_port < 65536, f"{name}: device_port must be between 1 and 65535")
+        check(self.max_step > 0, f"{name}: max_step must be > 0")
+        check(self.max_speed > 0, f"{name}: max_speed must be > 0")
+        check(self.enc_2_microns > 0, f"{name}: encoder2microns must be > 0")
+        check(self.speed_factor > 0, f"{name}: speedFactor must be > 0")
+        check(self.speed_security > 0, f"{name}: speed_security must be > 0")
+        check(self.calibration_model in CALIBRATION_MODELS, f"{name}: calibration_model must be one of {CALIBRATION_MODELS}")
+        check(not self.calibration or os.path.isfile(self.calibration), f"{name}: calibration file {self.calibration} not found")
+        check(not self.temp_source or self.temp_source.split(':')[0] in ('file', 'udp'), f"{name}: temp_source must be file:<path> or udp:<host>:<port>")
+        check(self.temp_hysteresis > 0, f"{name}: temp_hysteresis must be > 0")
+        check(self.temp_interval >= 0, f"{name}: temp_interval must be >= 0")
+        check(self.connections in (1, 2), f"{name}: connections must be 1 or 2")
+
+    def derive(self):
+        """Precomputes the conversion factors"""
+        self.microns_2_enc = 1 / self.enc_2_microns
+        self.max_counts = int(round(self.max_step * self.enc_2_microns))
+        self.max_speed_conv = min(self.max_speed * self.speed_factor, self.speed_security)
+
+    def clamp_speed(self, vel: int) -> int:
+        """Clamps a speed in microns/s to (0, max_speed], invalid values give max_speed"""
+        if vel > self.max_speed or vel <= 0:
+            return self.max_speed
+        return vel
+
+    def speed_to_motor(self, vel: int) -> int:
+        """Converts a speed in microns/s to motor units, limited by speed_security"""
+        return min(vel * self.speed_factor, self.speed_security)
+
+    def apply(self, new: 'DeviceConfig') -> list[str]:
+        """Copies the safe settings of ``new`` and returns the changed keys
+        that need a restart to take effect"""
+        restart = []
+        for key, value in vars(new).items():
+            if key in ('microns_2_enc', 'max_counts', 'max_speed_conv') or getattr(self, key) == value:
+                continue
+            if key in self.SAFE:
+                setattr(self, key, value)
+            else:
+                restart.append(key)
+        self.derive()
+        return restart
+
+    @classmethod
+    def from_toml(cls, sect: dict) -> 'DeviceConfig':
+        data = {'Device': sect}
+        return cls(
+            device_name=get_toml(data, 'Device', 'device_name'),
+            device_ip=get_toml(data, 'Device', 'device_ip'),
+            router_ip=get_toml(data, 'Device', 'router_ip'),
+            device_port=get_toml(data, 'Device', 'device_port'),
+            absolute=get_toml(data, 'Device', 'absolute'),
+            max_step=get_toml(data, 'Device', 'max_step'),
+            temp_comp=get_toml(data, 'Device', 'temp_comp'),
+            stepsize=get_toml(data, 'Device', 'step_size'),
+            max_speed=get_toml(data, 'Device', 'max_speed'),
+            enc_2_microns=get_toml(data, 'Device', 'encoder2microns'),
+            speed_factor=get_toml(data, 'Device', 'speedFactor'),
+            maxincrement=get_toml(data, 'Device', 'max_increment'),
+            speed_security=get_toml(data, 'Device', 'speed_security'),
+            tempcompavailable=get_toml(data, 'Device', 'tempcompavailable'),
+            calibration=get_toml(data, 'Device', 'calibration', ''),
+            calibration_model=get_toml(data, 'Device', 'calibration_model', 'interp'),
+            temp_source=get_toml(data, 'Device', 'temp_source', ''),
+            temp_coefficient=get_toml(data, 'Device', 'temp_coefficient', 0.0),
+            temp_hysteresis=get_toml(data, 'Device', 'temp_hysteresis', 5.0),
+            temp_interval=get_toml(data, 'Device', 'temp_interval', 60.0),
+            connections=get_toml(data, 'Device', 'connections', 2),
+        )
+
+def get_devices(data: dict) -> list[DeviceConfig]:
+    """Devices driven by this server. Each ``[[Devices]]`` entry inherits the
+    keys it does not define from ``[Device]``; without ``[[Devices]]`` the
+    single ``[Device]`` section is used"""
+    defaults = data.get('Device', {})
+    entries = data.get('Devices', [])
+    if not entries:
+        return [DeviceConfig.from_toml(defaults)]
+    devices = [DeviceConfig.from_toml({**defaults, **entry}) for entry in entries]
+    names = [device.device_name for device in devices]
+    check(len(names) == len(set(names)), f"[[Devices]] device_name must be unique: {names}")
+    return devices
+
+class Settings:
+    """Validated configuration in ``config.toml``.
+
+    ``Config``, the instance loaded at import, is shared by the whole
+    application. ``ConfigWatcher`` reloads the file when it changes and
+    applies the safe settings (speed limits, publish rate, log level) in
+    place, the others are only reported as needing a restart.
+    """
+    # Settings applied live by the config watcher
+    SAFE = ('pub_interval', 'client_rate', 'client_burst', 'log_level', 'trace',
+            'verbose_exceptions')
+
+    def __init__(self, data: dict):
+        # ---------------
+        # General Section
+        # ---------------
+        self.startup: bool = get_toml(data, 'General', 'startup')
+        self.name: str = get_toml(data, 'General', 'name')
+        self.state_dir: str = get_toml(data, 'General', 'state_dir', 'state')
+        # ---------------
+        # Network Section
+        # ---------------
+        self.ip_address: str = get_toml(data, 'Network', 'ip_address')
+        self.port_pub: int = get_toml(data, 'Network', 'port_pub')
+        self.port_rep: int = get_toml(data, 'Network', 'port_rep')
+        self.sharding: str = get_toml(data, 'Network', 'sharding', 'thread')
+        self.watchdog: float = get_toml(data, 'Network', 'watchdog', 30.0)
+        self.pub_interval: float = get_toml(data, 'Network', 'pub_interval', 1.0)
+        self.client_rate: float = get_toml(data, 'Network', 'client_rate', 20.0)
+        self.client_burst: int = get_toml(data, 'Network', 'client_burst', 40)
+        # --------------
+        # Device Section
+        # --------------
+        # Multiple devices may be listed as [[Devices]], the device_*
+        # attributes below always refer to the first (default) one
+        self.devices: list[DeviceConfig] = get_devices(data)
+        # ---------------
+        # Logging Section
+        # ---------------
+        self.log_level: str = get_toml(data, 'Logging', 'log_level')
+        self.log_to_stdout: bool = get_toml(data, 'Logging', 'log_to_stdout')
+        self.log_max_size_mb: int = get_toml(data, 'Logging', 'log_max_size_mb')
+        self.log_num_keep: int = get_toml(data, 'Logging', 'log_num_keep')
+        self.recorder_size: int = get_toml(data, 'Logging', 'recorder_size', 5000)
+        self.trace: str = get_toml(data, 'Logging', 'trace', '')
+        self.verbose_exceptions: bool = get_toml(data, 'Logging', 'verbose_exceptions', False)
+        # --------------
+        # Alpaca Section
+        # --------------
+        self.alpaca: bool = get_toml(data, 'Alpaca', 'enabled', False)
+        self.alpaca_port: int = get_toml(data, 'Alpaca', 'port', 11111)
+        self.alpaca_discovery: bool = get_toml(data, 'Alpaca', 'discovery', True)
+        # -----------------
+        # WebSocket Section
+        # -----------------
+        self.websocket: bool = get_toml(data, 'WebSocket', 'enabled', False)
+        self.websocket_port: int = get_toml(data, 'WebSocket', 'port', 7003)
+        self.websocket_max_clients: int = get_toml(data, 'WebSocket', 'max_clients', 500)
+        self.validate()
+
+    def validate(self):
+        for port in ('port_pub', 'port_rep'):
+            value = getattr(self, port)
+            check(isinstance(value, int) and 0 < value < 65536, f"[Network] {port} must be between 1 and 65535")
+        check(self.port_pub != self.port_rep, "[Network] port_pub and port_rep must differ")
+        check(self.sharding in SHARDING_MODES, f"[Network] sharding must be one of {SHARDING_MODES}")
+        check(self.watchdog > 0, "[Network] watchdog must be > 0")
+        check(self.pub_interval > 0, "[Network] pub_interval must be > 0")
+        # The watchdog restarts a worker process after ``watchdog`` seconds
+        # without a status, leave it at least two periodic publications
+        check(self.pub_interval * 2 <= self.watchdog, "[Network] pub_interval must be at most half of watchdog")
+        check(self.client_rate >= 0, "[Network] client_rate must be >= 0")
+        check(self.client_burst >= 1, "[Network] client_burst must be >= 1")
+        check(self.log_level in LOG_LEVELS, f"[Logging] log_level must be one of {LOG_LEVELS}")
+        check(self.log_max_size_mb > 0, "[Logging] log_max_size_mb must be > 0")
+        check(self.recorder_size > 0, "[Logging] recorder_size must be > 0")
+        check(self.trace in TRACE_FORMATS, f"[Logging] trace must be one of {TRACE_FORMATS}")
+        check(isinstance(self.alpaca_port, int) and 0 < self.alpaca_port < 65536, "[Alpaca] port must be between 1 and 65535")
+        check(isinstance(self.websocket_port, int) and 0 < self.websocket_port < 65536, "[WebSocket] port must be between 1 and 65535")
+        check(self.websocket_max_clients >= 1, "[WebSocket] max_clients must be >= 1")
+
+    @classmethod
+    def load(cls, path=config_file) -> 'Settings':
+        return cls(toml.load(path))
+
+    # Default device, kept for single device code
+    @property
+    def device_name(self) -> str:
+        return self.devices[0].device_name
+
+    @property
+    def device_ip(self) -> str:
+        return self.devices[0].device_ip
+
+    @property
+    def router_ip(self) -> str:
+        return self.devices[0].router_ip
+
+    @property
+    def device_port(self) -> int:
+        return self.devices[0].device_port
+
+    @property
+    def absolute(self) -> bool:
+        return self.devices[0].absolute
+
+    @property
+    def max_step(self) -> int:
+        return self.devices[0].max_step
+
+    @property
+    def temp_comp(self) -> bool:
+        return self.devices[0].temp_comp
+
+    @property
+    def stepsize(self) -> int:
+        return self.devices[0].stepsize
+
+    @property
+    def max_speed(self) -> int:
+        return self.devices[0].max_speed
+
+    @property
+    def enc_2_microns(self) -> float:
+        return self.devices[0].enc_2_microns
+
+    @property
+    def speed_factor(self) -> int:
+        return self.devices[0].speed_factor
+
+    @property
+    def maxincrement(self) -> int:
+        return self.devices[0].maxincrement
+
+    @property
+    def speed_security(self) -> int:
+        return self.devices[0].speed_security
+
+    @property
+    def tempcompavailable(self) -> bool:
+        return self.devices[0].tempcompavailable
+
+    def apply(self, new: 'Settings') -> tuple[list[str], list[str]]:
+        """Applies the safe settings of ``new`` in place
+        Returns:
+            (applied, restart): changed keys applied live and changed keys
+            that need a restart
+        """
+        applied, restart = [], []
+        for key in ('startup', 'name', 'state_dir', 'ip_address', 'port_pub', 'port_rep', 'sharding',
+                    'watchdog', 'log_to_stdout', 'log_max_size_mb', 'log_num_keep',
+                    'recorder_size'):
+            if getattr(self, key) != getattr(new, key):
+                restart.append(key)
+        for key in self.SAFE:
+            if getattr(self, key) != getattr(new, key):
+                setattr(self, key, getattr(new, key))
+                applied.append(key)
+        if 'log_level' in applied:
+            root = logging.getLogger()
+            root.setLevel(self.log_level)
+            for handler in root.handlers:
+                handler.setLevel(self.log_level)
+
+        current = {device.device_name: device for device in self.devices}
+        for device in new.devices:
+            if device.device_name not in current:
+                restart.append(f'{device.device_name}')
+                continue
+            old = current[device.device_name]
+            before = {key: getattr(old, key) for key in DeviceConfig.SAFE}
+            restart += [f'{device.device_name}.{key}' for key in old.apply(device)]
+            applied += [f'{device.device_name}.{key}' for key in DeviceConfig.SAFE
+                        if before[key] != getattr(old, key)]
+        if len(new.devices) != len(self.devices):
+            restart.append('devices')
+        return applied, restart
+
+class ConfigWatcher(Thread):
+    """Watches ``config.toml`` and applies its safe changes to ``settings``
+
+    Args:
+        settings (Settings): Live configuration, usually ``Config``.
+        logger (Logger): Where reloads and errors are reported.
+        path (Path): File to watch.
+        interval (float): Seconds between checks of the file mtime.
+        on_change (callable): Called with the list of applied keys.
+    """
+    def __init__(self, settings: Settings, logger, path=config_file, interval=1.0, on_change=None):
+        super().__init__(name='config-watcher', daemon=True)
+        self.settings = settings
+        self.logger = logger
+        self.path = path
+        self.interval = interval
+        self.on_change = on_change
+        self._stop_event = Event()
+        self._mtime = self._get_mtime()
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def stop(self):
+        self._stop_event.set()
+
+    def check(self):
+        """Reloads the file if it changed since the last check"""
+        mtime = self._get_mtime()
+        if mtime is None or mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            new = Settings.load(self.path)
+        except Exception as e:
+            self.logger.error(f'Config not reloaded, invalid file: {str(e)}')
+            return
+        applied, restart = self.settings.apply(new)
+        if applied:
+            self.logger.warning(f'Config reloaded, applied: {", ".join(applied)}')
+        if restart:
+            self.logger.warning(f'Config changes need a restart: {", ".join(restart)}')
+        if applied and self.on_change:
+            self.on_change(applied)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.check()
+
+Config = Settings.load(config_file)
@@ -1,215 +1,144 @@
+# exceptions.py - Error catalogue
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+from enum import IntEnum
 import traceback
-from src.core.config import Config
-
-class ActionNotImplementedException:
-    """Requested ``Action()`` is not implemented"""
-    def __init__(
-            self,
-            message: str = 'The requested action is not implemented in this driver.'
-        ):
-        """Initialize the ``ActionNotImplementedException`` object
-
-        Args:
-            number (int):   0x040C (1036)
-            message (str):  'The requested action is not implemented in this driver.'
-
-        * Logs ``ActionNotImplementedException: {message}``
-        """
-        self.number = 0x40C
-        self.message = message
-        cname = self.__class__.__name__
 
-    @property
-    def Number(self) -> int:
-        return self.number
-
-    @property
-    def Message(self) -> str:
-        return self.message
-
-class DriverException:
+class ErrorCode(IntEnum):
+    """Error codes returned in ``NAK=<code>`` replies and in the ``errorCode``
+    field of the status. 0x400-0x4FF are the ASCOM Alpaca codes, 0x500-0xFFF
+    the driver specific ones (the range Alpaca reserves for drivers)."""
+    OK = 0
+    NOT_IMPLEMENTED = 0x400         # Property or method not implemented
+    INVALID_VALUE = 0x401           # Target, speed, sequence... out of range
+    VALUE_NOT_SET = 0x402
+    NOT_CONNECTED = 0x407           # Device not connected (yet)
+    INVALID_OPERATION = 0x40B       # Not possible in the current state
+    ACTION_NOT_IMPLEMENTED = 0x40C  # Unknown action
+    DRIVER_ERROR = 0x500            # Error reply of the controller
+    BUSY = 0x501                    # Moving, or in use by another client
+    HALTED = 0x502                  # Motion dropped by a HALT
+    TEMP_COMP = 0x503               # Temperature compensation on or not available
+    INVALID_REQUEST = 0x504         # Request is not JSON or lacks the action
+    RATE_LIMITED = 0x505            # Client above client_rate
+    UNKNOWN_DEVICE = 0x506          # No device with the requested name
+    WORKER_UNAVAILABLE = 0x507      # Device worker (process) not running
+
+class FocuserException(RuntimeError):
+    """Base of the catalogue exceptions, a ``RuntimeError`` as the driver
+    raised before. Constructing or raising one formats nothing: ``str()``
+    is the stored message and the traceback is only formatted by
+    ``format`` (``describe``), when someone asks for it.
+
+    Always raise a new instance: the traceback and context are stored in
+    the exception, an instance shared between the device threads would
+    carry those of whichever thread raised it last.
+
+    Args:
+        message (str): Error message, the class default if None.
+        code (int): Error code, the class default if None.
     """
-    **Exception Class for Driver Internal Errors**
-        This exception is used for device errors and other internal exceptions.
-        It can be instantiated with a captured exception object, and if so format
-        the Alpaca error message to include line number/module or optionally a
-        complete traceback of the exception (a config option).
-    """
-    def __init__(
-            self,
-            number: int = 0x500,
-            message: str = 'Internal driver error - this should be more specific.',
-            exc = None  # Python exception info
-        ):
-        """Initialize the DeviceException object
-
-        Args:
-            number (int):   Alpaca error number between 0x500 and 0xFFF, your choice
-                            defaults to 0x500 (1280)
-            message (str):  Specific error message or generic if left blank. Defaults
-                            to 'Internal driver error - this should be more specific.'
-            exc:            Contents 'ex' of 'except Exception as ex:' If not included
-                            then only message is included. If supplied, then a detailed
-                            error message with traceback is created (see full parameter)
-
-        Notes:
-            * Checks error number within legal range and if not, logs this error and substitutes
-              0x500 number.
-            * If the Python exception object is included as the 3rd argument, it constructs
-              a message containing the name of the underlying Python exception and its basic
-              context. If :py:attr:`~config.Config.verbose_driver_exceptions` is ``true``, a complete
-              Python traceback is included.
-            * Logs the constructed ``DriverException`` message
-        """
-        if number <= 0x500 and number >= 0xFFF:
-            number = 0x500
-        self.number = number
-        cname = self.__class__.__name__
-        if not exc is None:
-            if Config.verbose_driver_exceptions:
-                self.fullmsg = f'{cname}: {message}\n{traceback.format_exc()}'  # TODO Safe if not explicitly using exc?
-            else:
-                self.fullmsg = f'{cname}: {message}\n{type(exc).__name__}: {str(exc)}'
-        else:
-            self.fullmsg = f'{cname}: {message}'
-
-    @property
-    def Number(self) -> int:
-        return self.number
+    code: int = ErrorCode.DRIVER_ERROR
+    message: str = 'Internal driver error'
 
-    @property
-    def Message(self) -> str:
-        return self.fullmsg
+    def __init__(self, message: str = None, code: int = None):
+        super().__init__()
+        if message is not None:
+            self.message = message
+        if code is not None:
+            self.code = code
 
-
-class InvalidOperationException:
-    """The client asked for something that can't be done"""
-    def __init__(
-            self,
-            message: str = 'The requested operation cannot be undertaken at this time.'
-        ):
-        """Initialize the ``InvalidOperationException`` object
-
-        Args:
-            number (int):   0x040B (1035)
-            message (str):  'The requested operation cannot be undertaken at this time.'
-
-        * Logs ``InvalidOperationException: {message}``
-        """
-        self.number = 0x40B
-        self.message = message
-        cname = self.__class__.__name__
-
-    @property
-    def Number(self) -> int:
-        return self.number
-
-    @property
-    def Message(self) -> str:
+    def __str__(self) -> str:
         return self.message
 
-
-class InvalidValueException:
-    """A value given is invalid or out of range"""
-    def __init__(
-            self,
-            message: str = 'Invalid value given.'
-        ):
-        """Initialize the ``InvalidValueException`` object
-
-        Args:
-            number (int):   0x401 (1025)
-            message (str):  'Invalid value given.'
-
-        * Logs ``InvalidValueException: {message}``
-        """
-        self.number = 0x401
-        self.message = message
-        cname = self.__class__.__name__
-
     @property
     def Number(self) -> int:
-        return self.number
+        return int(self.code)
 
     @property
     def Message(self) -> str:
         return self.message
 
+    def format(self, verbose: bool = False) -> str:
+        """``<class>: <message>``, plus the traceback if ``verbose``"""
+        text = f'{self.__class__.__name__}: {self.message}'
+        if verbose and self.__traceback__ is not None:
+            text += '\n' + ''.join(traceback.format_tb(self.__traceback__))
+        return text
 
-class NotConnectedException:
-    """The device must be connected and is not at this time"""
-    def __init__(
-            self,
-            message: str = 'The device is not connected.'
-        ):
-        """Initialize the ``NotConnectedException`` object
-
-        Args:
-            number (int):   0x407 (1031)
-            message (str):  'The device is not connected.'
-
-        * Logs ``NotConnectedException: {message}``
-        """
-        self.number = 0x407
-        self.message = message
-        cname = self.__class__.__name__
-
-    @property
-    def Number(self) -> int:
-        return self.number
-
-    @property
-    def Message(self) -> str:
-        return self.message
-
-class NotImplementedException:
+class NotImplementedException(FocuserException):
     """The requested property or method is not implemented"""
-    def __init__(
-            self,
-            message: str = 'Property or method not implemented.'
-        ):
-        """Initialize the ``NotImplementedException`` object
-
-        Args:
-            number (int):   0x400 (1024)
-            message (str):  'Property or method not implemented.'
-
-        * Logs ``NotImplementedException: {message}``
-        """
-        self.number = 0x400
-        self.message = message
-        cname = self.__class__.__name__
-
-    @property
-    def Number(self) -> int:
-        return self.number
+    code = ErrorCode.NOT_IMPLEMENTED
+    message = 'Property or method not implemented.'
 
-    @property
-    def Message(self) -> str:
-        return self.message
-
-class ValueNotSetException:
-    """The requested vzalue has not yet een set"""
-    def __init__(
-            self,
-            message: str = 'The value has not yet been set.'
-        ):
-        """Initialize the ``ValueNotSetException`` object
-
-        Args:
-            number (int):   0x402 (1026)
-            message (str):  'The value has not yet been set.'
+class InvalidValueException(FocuserException):
+    """A value given is invalid or out of range"""
+    code = ErrorCode.INVALID_VALUE
+    message = 'Invalid value given.'
 
-        * Logs ``ValueNotSetException: {message}``
-        """
-        self.number = 0x402
-        self.message = message
-        cname = self.__class__.__name__
+class ValueNotSetException(FocuserException):
+    """The requested value has not yet been set"""
+    code = ErrorCode.VALUE_NOT_SET
+    message = 'The value has not yet been set.'
 
-    @property
-    def Number(self) -> int:
-        return self.number
+class NotConnectedException(FocuserException):
+    """The device must be connected and is not at this time"""
+    code = ErrorCode.NOT_CONNECTED
+    message = 'The device is not connected.'
 
-    @property
-    def Message(self) -> str:
-        return self.message
+class InvalidOperationException(FocuserException):
+    """The client asked for something that can't be done"""
+    code = ErrorCode.INVALID_OPERATION
+    message = 'The requested operation cannot be undertaken at this time.'
+
+class ActionNotImplementedException(FocuserException):
+    """Requested action is not implemented"""
+    code = ErrorCode.ACTION_NOT_IMPLEMENTED
+    message = 'The requested action is not implemented in this driver.'
+
+class DriverException(FocuserException):
+    """Device errors (error reply of the controller) and other internal errors"""
+    code = ErrorCode.DRIVER_ERROR
+    message = 'Internal driver error'
+
+class BusyException(InvalidOperationException):
+    """The focuser is moving, or in use by another client"""
+    code = ErrorCode.BUSY
+    message = 'Cannot start a move while the focuser is moving'
+
+class HaltedException(FocuserException):
+    """A motion command was dropped by a HALT before being sent"""
+    code = ErrorCode.HALTED
+    message = 'Halted'
+
+class TempCompException(InvalidOperationException):
+    """Not possible with the temperature compensation state"""
+    code = ErrorCode.TEMP_COMP
+    message = 'Invalid TempComp'
+
+_NAK = {code: f'NAK={int(code)}' for code in ErrorCode}
+
+def nak(code: int) -> str:
+    """Reply refusing a request with ``code``"""
+    return _NAK.get(code) or f'NAK={int(code)}'
+
+def error_code(exc: BaseException) -> int:
+    """Catalogue code of an exception, DRIVER_ERROR if not a catalogue one"""
+    return getattr(exc, 'code', ErrorCode.DRIVER_ERROR)
+
+def describe(exc: BaseException, verbose: bool = False) -> str:
+    """Log line of an exception, formatted only when called
+    Args:
+        exc: Any exception.
+        verbose (bool): Include the traceback.
+    """
+    if isinstance(exc, FocuserException):
+        return exc.format(verbose)
+    text = f'{type(exc).__name__}: {str(exc)}'
+    if verbose and exc.__traceback__ is not None:
+        text += '\n' + ''.join(traceback.format_tb(exc.__traceback__))
+    return text
@@ -15,11 +15,9 @@ try:
 except:
     CONFIG_FILE = False
 
-def init_logging():
+def init_logging(log_path: str = r"logs/focuser.log"):
     if not CONFIG_FILE:
         return
-    
-    log_path = r"logs/focuser.log"
 
     logging.basicConfig(level=Config.log_level)
     logger = logging.getLogger()                # Root logger, see above
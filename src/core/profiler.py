@@ -0,0 +1,161 @@
+# profiler.py - Opt-in runtime profiling
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+from datetime import datetime, timezone
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+
+class Profiler():
+    """Wall time of the ``handle_*`` methods of the instrumented objects and
+    of the driver I/O, toggled at runtime.
+
+    While stopped nothing is wrapped, so there is no overhead. ``start``
+    replaces the handlers (instance attributes) by timing wrappers, ``stop``
+    removes them. The time spent in driver I/O during each handler is
+    accounted separately, telling our code apart from waiting for the
+    controller. Optionally a cProfile of the calling thread is also taken.
+
+    Args:
+        name (str): Used in the dump file name.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.enabled = False
+        self.targets = []
+        self.io_targets = []
+        self._wrapped = []
+        self._cprofile = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {}         # name: [calls, total, max, io]
+        self.io = [0, 0.0, 0.0]  # calls, total, max
+        self.since = time.time()
+
+    def add(self, name: str, elapsed: float, io_time: float = 0.0):
+        entry = self.stats.get(name)
+        if entry is None:
+            entry = self.stats[name] = [0, 0.0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[3] += io_time
+        if elapsed > entry[2]:
+            entry[2] = elapsed
+
+    def _timed(self, name, method):
+        def wrapper(*args, **kwargs):
+            io0 = self.io[1]
+            t0 = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - t0, self.io[1] - io0)
+        return wrapper
+
+    def _timed_io(self, method):
+        io = self.io
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                dt = time.perf_counter() - t0
+                io[0] += 1
+                io[1] += dt
+                if dt > io[2]:
+                    io[2] = dt
+        return wrapper
+
+    def instrument(self, obj, prefix: str = 'handle_'):
+        """Registers the ``prefix*`` methods of ``obj`` to be timed"""
+        self.targets.append((obj, prefix))
+
+    def instrument_io(self, obj, method: str = '_write'):
+        """Registers ``obj.method`` as driver I/O"""
+        self.io_targets.append((obj, method))
+
+    def start(self, cprofile: bool = False):
+        """Starts timing, with a cProfile of the calling thread if asked"""
+        if not self.enabled:
+            self.reset()
+            # The cProfile of the previous session is only kept for a DUMP
+            # after OFF, a new session takes a new one
+            self._cprofile = None
+            for obj, prefix in self.targets:
+                for name in dir(type(obj)):
+                    if name.startswith(prefix) and callable(getattr(obj, name)):
+                        setattr(obj, name, self._timed(name, getattr(obj, name)))
+                        self._wrapped.append((obj, name))
+            for obj, name in self.io_targets:
+                setattr(obj, name, self._timed_io(getattr(obj, name)))
+                self._wrapped.append((obj, name))
+            self.enabled = True
+        if cprofile and self._cprofile is None:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        """Stops timing and removes the wrappers"""
+        for obj, name in self._wrapped:
+            try:
+                delattr(obj, name)
+            except AttributeError:
+                pass
+        self._wrapped = []
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        self.enabled = False
+
+    def report(self) -> dict:
+        """Statistics in milliseconds"""
+        handlers = {
+            name: {
+                "calls": n,
+                "total_ms": round(total * 1000, 3),
+                "mean_ms": round(total * 1000 / n, 3),
+                "max_ms": round(peak * 1000, 3),
+                "io_ms": round(io_time * 1000, 3),
+                "own_ms": round((total - io_time) * 1000, 3),
+            }
+            for name, (n, total, peak, io_time) in sorted(self.stats.items(), key=lambda kv: -kv[1][1])
+        }
+        n, total, peak = self.io
+        return {
+            "name": self.name,
+            "enabled": self.enabled,
+            "seconds": round(time.time() - self.since, 3),
+            "handlers": handlers,
+            "driver_io": {"calls": n, "total_ms": round(total * 1000, 3), "max_ms": round(peak * 1000, 3)},
+        }
+
+    def dump(self, directory: str = 'logs') -> str:
+        """Writes the report (and the cProfile, if taken) to
+        ``<directory>/profile-<name>-<utc>.json``/``.txt``
+        Returns:
+            Path of the JSON report
+        """
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        base = os.path.join(directory, f"profile-{self.name}-{stamp}")
+        os.makedirs(directory, exist_ok=True)
+        with open(base + '.json', 'w') as file:
+            json.dump(self.report(), file, indent=2)
+        if self._cprofile is not None:
+            running = self.enabled
+            self._cprofile.disable()
+            text = io.StringIO()
+            pstats.Stats(self._cprofile, stream=text).sort_stats('cumulative').print_stats(40)
+            with open(base + '.txt', 'w') as file:
+                file.write(text.getvalue())
+            if running:
+                self._cprofile.enable()
+            else:
+                self._cprofile = None
+        return base + '.json'
@@ -0,0 +1,59 @@
+# ratelimit.py - Per client request rate limiting
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+class TokenBucket():
+    """Allows ``burst`` requests at once and ``rate`` requests/s on average"""
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, rate: float, burst: float, now: float) -> bool:
+        """Takes one token, False if the bucket is empty"""
+        self.tokens = min(burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class ClientLimiter():
+    """One token bucket per client, ``rate`` <= 0 disables the limit
+
+    Args:
+        rate (float): Requests per second allowed to each client.
+        burst (float): Requests a client may send at once.
+        max_clients (int): Buckets kept before the idle ones are dropped.
+    """
+    def __init__(self, rate: float, burst: float, max_clients: int = 1024):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = {}
+        self.limited = 0
+
+    def allow(self, client, now: float) -> bool:
+        """True if ``client`` may send a request at ``now`` (monotonic)"""
+        if self.rate <= 0:
+            return True
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            if len(self.buckets) >= self.max_clients:
+                self.prune(now)
+            bucket = self.buckets[client] = TokenBucket(self.burst, now)
+        if bucket.take(self.rate, self.burst, now):
+            return True
+        self.limited += 1
+        return False
+
+    def prune(self, now: float):
+        """Drops the buckets that refilled, their clients are idle"""
+        self.buckets = {
+            client: bucket for client, bucket in self.buckets.items()
+            if bucket.tokens + (now - bucket.stamp) * self.rate < self.burst
+        }
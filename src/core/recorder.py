@@ -0,0 +1,67 @@
+# recorder.py - In-memory flight recorder
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+from collections import deque
+from datetime import datetime, timezone
+import json
+import os
+import time
+
+class FlightRecorder():
+    """Ring of the last ``size`` events of a device, at full detail.
+
+    Recording only appends a tuple to a bounded deque; nothing is formatted
+    or written until ``dump``, called on errors, alarms or on request, which
+    writes the events as JSON lines to ``<directory>/flight-<name>-<utc>.jsonl``.
+
+    Args:
+        name (str): Device name, used in the dump file name.
+        size (int): Number of events kept.
+        directory (str): Where the dumps are written.
+        min_interval (float): Minimum seconds between automatic dumps, so a
+            burst of errors does not flood the disk.
+    """
+    def __init__(self, name: str, size: int = 5000, directory: str = 'logs', min_interval: float = 10.0):
+        self.name = name
+        self.events = deque(maxlen=size)
+        self.directory = directory
+        self.min_interval = min_interval
+        self._last_dump = float('-inf')
+
+    def record(self, kind: str, **data):
+        """Records an event with JSON serializable ``data``"""
+        self.events.append((time.time(), kind, data, None))
+
+    def record_json(self, kind: str, payload: str):
+        """Records an event whose data is an already serialized JSON object"""
+        self.events.append((time.time(), kind, None, payload))
+
+    def dump(self, reason: str, force: bool = False) -> str:
+        """Writes the recorded events to a new file
+        Args:
+            reason (str): Why the dump was taken (error, alarm, request...).
+            force (bool): Ignore ``min_interval``.
+        Returns:
+            Path of the dump, None if skipped
+        """
+        now = time.monotonic()
+        if not force and now - self._last_dump < self.min_interval:
+            return None
+        self._last_dump = now
+        events = self.events.copy()
+        stamp = datetime.now(timezone.utc)
+        path = os.path.join(self.directory, f"flight-{self.name}-{stamp.strftime('%Y%m%dT%H%M%S.%fZ')}.jsonl")
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path + '.tmp', 'w') as file:
+            file.write(json.dumps({"kind": "dump", "device": self.name, "reason": reason,
+                                   "t": stamp.isoformat(timespec='milliseconds'),
+                                   "events": len(events)}) + '\n')
+            for t, kind, data, payload in events:
+                head = f'{{"t": "{datetime.fromtimestamp(t, timezone.utc).isoformat(timespec="milliseconds")}", "kind": "{kind}", "data": '
+                file.write(head + (payload if payload is not None else json.dumps(data, default=str)) + '}\n')
+        os.replace(path + '.tmp', path)
+        return path
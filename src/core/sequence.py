@@ -0,0 +1,138 @@
+# sequence.py - Server side waypoint sequences
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+import math
+import time
+
+class MotionSequence():
+    """List of targets executed back-to-back by a ``FocuserWorker``.
+
+    The worker starts the move to ``target`` and calls ``reached`` when the
+    motion completes; the sequence then dwells (``ready`` becomes true once
+    the dwell time is over) and ``advance`` moves on to the next target.
+
+    Args:
+        targets (list): [(position microns, dwell seconds), ...]
+        client_id (int): Client that requested the sequence.
+        kind (str): Name used in the published events.
+    """
+    MOVING = 'moving'
+    DWELL = 'dwell'
+
+    def __init__(self, targets: list, client_id: int, kind: str = 'sequence'):
+        self.targets = targets
+        self.client_id = client_id
+        self.kind = kind
+        self.index = 0
+        self.state = self.MOVING
+        self.dwell_until = 0.0
+
+    @property
+    def total(self) -> int:
+        return len(self.targets)
+
+    @property
+    def target(self) -> int:
+        return self.targets[self.index][0]
+
+    @property
+    def done(self) -> bool:
+        return self.index >= len(self.targets)
+
+    def reached(self, now: float):
+        """Motion to the current target completed at ``now`` (monotonic)"""
+        self.state = self.DWELL
+        self.dwell_until = now + self.targets[self.index][1]
+
+    def ready(self, now: float) -> bool:
+        """True when the dwell at the current target is over"""
+        return self.state == self.DWELL and now >= self.dwell_until
+
+    def advance(self):
+        """Moves on to the next target"""
+        self.index += 1
+        self.state = self.MOVING
+
+    def event(self, state: str, position: int, **extra) -> dict:
+        """Progress event published by the worker"""
+        event = {
+            "name": self.kind,
+            "state": state,
+            "index": self.index,
+            "total": self.total,
+            "target": self.target if not self.done else None,
+            "position": position,
+        }
+        event.update(extra)
+        return event
+
+def parse_targets(cmd: str, msg: dict, max_step: int, max_points: int = 10000) -> list:
+    """Reads the targets of a SEQUENCE request, either from the action
+    (``SEQUENCE=1000:0.5,2000,3000:1``, position[:dwell]) or from a
+    ``targets`` list of ``{"position": p, "dwell": s}`` objects or numbers.
+    Returns:
+        [(position, dwell), ...]
+    Raises:
+        ValueError if the request has no valid target, an invalid one or
+        more than ``max_points``
+    """
+    raw = msg.get("targets")
+    if raw is None:
+        raw = []
+        for item in cmd.partition('=')[2].split(','):
+            if not item.strip():
+                continue
+            pos, _, dwell = item.partition(':')
+            raw.append({"position": pos, "dwell": dwell or 0})
+    if len(raw) > max_points:
+        raise ValueError(f'Sequence has more than {max_points} targets')
+    targets = []
+    for item in raw:
+        if isinstance(item, dict):
+            pos, dwell = int(item["position"]), float(item.get("dwell", 0))
+        else:
+            pos, dwell = int(item), 0.0
+        if not 0 < pos < max_step:
+            raise ValueError(f'Invalid Target {pos}')
+        # A nan dwell would never end, keeping the device busy
+        if not math.isfinite(dwell) or dwell < 0:
+            raise ValueError(f'Invalid dwell {dwell}')
+        targets.append((pos, dwell))
+    if not targets:
+        raise ValueError('Empty sequence')
+    return targets
+
+def parse_sweep(cmd: str, msg: dict, max_step: int, max_points: int = 10000) -> list:
+    """Reads a SWEEP request, either from the action
+    (``SWEEP=start,stop,step[,dwell]``) or from ``start``, ``stop``, ``step``
+    and ``dwell`` fields. ``stop`` is included when it falls on a step.
+    Returns:
+        [(position, dwell), ...]
+    Raises:
+        ValueError if the sweep is invalid
+    """
+    if "start" in msg:
+        start, stop, step = int(msg["start"]), int(msg["stop"]), int(msg["step"])
+        dwell = float(msg.get("dwell", 0))
+    else:
+        args = cmd.partition('=')[2].split(',')
+        if len(args) not in (3, 4):
+            raise ValueError('SWEEP=start,stop,step[,dwell]')
+        start, stop, step = int(args[0]), int(args[1]), int(args[2])
+        dwell = float(args[3]) if len(args) == 4 else 0.0
+    if step <= 0:
+        raise ValueError(f'Invalid step {step}')
+    if not math.isfinite(dwell) or dwell < 0:
+        raise ValueError(f'Invalid dwell {dwell}')
+    for pos in (start, stop):
+        if not 0 < pos < max_step:
+            raise ValueError(f'Invalid Target {pos}')
+    direction = 1 if stop >= start else -1
+    count = abs(stop - start) // step + 1
+    if count > max_points:
+        raise ValueError(f'Sweep has more than {max_points} points')
+    return [(start + direction * i * step, dwell) for i in range(count)]
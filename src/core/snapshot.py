@@ -0,0 +1,72 @@
+# snapshot.py - Persisted device state for warm restarts
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+from datetime import datetime, timezone
+import json
+import os
+import time
+
+class StateSnapshot():
+    """Last known state of a device (position, initialized, busy owner and
+    shadow registers) kept in ``<directory>/state-<name>.json``.
+
+    The file is replaced atomically (written to a temporary file, synced and
+    renamed), so a crash or power loss leaves either the previous or the new
+    snapshot, never a partial one. Saves of an unchanged state are skipped and,
+    unless forced, changes are written at most every ``min_interval`` seconds.
+
+    Args:
+        name (str): Device name.
+        directory (str): Where the snapshot is kept.
+        min_interval (float): Minimum seconds between unforced saves.
+    """
+    def __init__(self, name: str, directory: str = 'state', min_interval: float = 1.0):
+        self.name = name
+        self.path = os.path.join(directory, f'state-{name}.json')
+        self.min_interval = min_interval
+        self._saved = None
+        self._last_save = float('-inf')
+
+    def load(self) -> dict:
+        """The saved state, None if missing, invalid or of another device"""
+        try:
+            with open(self.path) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(state, dict) or state.get("device") != self.name:
+            return None
+        return state
+
+    def save(self, state: dict, force: bool = False) -> bool:
+        """Writes ``state`` if it changed
+        Args:
+            state (dict): JSON serializable state.
+            force (bool): Ignore ``min_interval``.
+        Returns:
+            True if the file was written
+        """
+        if state == self._saved:
+            return False
+        now = time.monotonic()
+        if not force and now - self._last_save < self.min_interval:
+            return False
+        data = dict(state, device=self.name,
+                    saved=datetime.now(timezone.utc).isoformat(timespec='milliseconds'))
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as file:
+                json.dump(data, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(self.path + '.tmp', self.path)
+        except OSError:
+            return False
+        self._saved = {key: dict(value) if isinstance(value, dict) else value
+                       for key, value in state.items()}
+        self._last_save = now
+        return True
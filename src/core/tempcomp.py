@@ -0,0 +1,140 @@
+# tempcomp.py - Temperature compensation
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+from collections import deque
+import socket
+
+from src.core.calibration import fit_polynomial
+
+class TemperatureSource():
+    """Pluggable temperature reader, ``read`` returns °C or None"""
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class FileTemperatureSource(TemperatureSource):
+    """Reads the last number written to a text file, e.g. by a sensor logger"""
+    def __init__(self, path: str):
+        self.path = path
+
+    def read(self):
+        try:
+            with open(self.path, 'rb') as file:
+                file.seek(0, 2)
+                file.seek(max(0, file.tell() - 64))
+                lines = file.read().split()
+            return float(lines[-1]) if lines else None
+        except (OSError, ValueError):
+            return None
+
+class UDPTemperatureSource(TemperatureSource):
+    """Keeps the last temperature received as a UDP datagram (ASCII number)"""
+    def __init__(self, host: str, port: int):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.setblocking(False)
+        self.value = None
+
+    def read(self):
+        while True:
+            try:
+                data = self.socket.recv(64)
+            except (BlockingIOError, OSError):
+                break
+            try:
+                self.value = float(data.decode().strip())
+            except ValueError:
+                pass
+        return self.value
+
+    def close(self):
+        self.socket.close()
+
+def make_source(spec: str) -> TemperatureSource:
+    """Builds a source from ``file:<path>`` or ``udp:<host>:<port>``,
+    returns None for an empty spec"""
+    if not spec:
+        return None
+    kind, _, arg = spec.partition(':')
+    if kind == 'file':
+        return FileTemperatureSource(arg)
+    if kind == 'udp':
+        host, _, port = arg.rpartition(':')
+        return UDPTemperatureSource(host or '0.0.0.0', int(port))
+    raise ValueError(f'Unknown temperature source {spec}')
+
+class TempCompensator():
+    """Focus vs temperature model and corrective move decisions.
+
+    Focus positions chosen by the operator are recorded with the temperature
+    at that time; a linear regression over this history gives the focus
+    drift in microns/°C, unless a fixed ``coefficient`` is configured.
+    While compensation is on, the focus expected at the current temperature
+    is computed from the reference taken when it was enabled, and a move is
+    requested only when the error exceeds ``hysteresis`` and at most once
+    every ``min_interval`` seconds.
+
+    Args:
+        coefficient (float): Fixed microns/°C, 0 to fit it from history.
+        hysteresis (float): Minimum focus error, in microns, to move.
+        min_interval (float): Minimum seconds between corrective moves.
+        history (int): Number of (temperature, focus) samples kept.
+        min_span (float): Minimum temperature span, °C, to fit the model.
+    """
+    def __init__(self, coefficient: float = 0.0, hysteresis: float = 5.0,
+                 min_interval: float = 60.0, history: int = 500, min_span: float = 1.0):
+        self.coefficient = coefficient
+        self.hysteresis = hysteresis
+        self.min_interval = min_interval
+        self.min_span = min_span
+        self.samples = deque(maxlen=history)
+        self.reference = None
+        self.last_move = float('-inf')
+        self._fitted = None
+
+    def record(self, temperature: float, position: int):
+        """Records a focus position chosen (by the operator) at a temperature"""
+        self.samples.append((temperature, position))
+        self._fitted = None
+
+    def slope(self):
+        """Focus drift in microns/°C, None if it cannot be fitted yet"""
+        if self.coefficient:
+            return self.coefficient
+        if self._fitted is None and len(self.samples) >= 2:
+            temps = [s[0] for s in self.samples]
+            if max(temps) - min(temps) >= self.min_span:
+                self._fitted = fit_polynomial(temps, [s[1] for s in self.samples], 1)[0]
+        return self._fitted
+
+    def start(self, temperature: float, position: int):
+        """Compensation enabled, current state is the reference"""
+        self.reference = (temperature, position)
+
+    def stop(self):
+        self.reference = None
+
+    def correction(self, now: float, temperature: float, position: int):
+        """Target position to move to, or None when no move is needed
+        Args:
+            now (float): Monotonic time.
+            temperature (float): Current temperature.
+            position (int): Current focus position in microns.
+        """
+        if self.reference is None or temperature is None:
+            return None
+        slope = self.slope()
+        if slope is None or now - self.last_move < self.min_interval:
+            return None
+        t_ref, p_ref = self.reference
+        target = int(round(p_ref + slope * (temperature - t_ref)))
+        if abs(target - position) < self.hysteresis:
+            return None
+        self.last_move = now
+        return target
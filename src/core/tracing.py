@@ -0,0 +1,207 @@
+# tracing.py - Request tracing
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+import json
+import os
+import random
+import threading
+import time
+import zlib
+
+def trace_id(client_id, transaction) -> str:
+    """Trace id of a request, derived from its ``clientId`` and
+    ``clientTransactionId`` so the broker and the worker (possibly another
+    process) tag their spans with the same id without exchanging it"""
+    def part(value):
+        try:
+            return int(value) & 0xFFFFFFFFFFFFFFFF
+        except (TypeError, ValueError):
+            return zlib.crc32(str(value).encode())
+    return f'{part(client_id):016x}{part(transaction):016x}'
+
+class Span():
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start', 'end', 'attributes')
+
+    def __init__(self, name: str, trace: str, parent: str = None, start: int = None, **attributes):
+        self.name = name
+        self.trace_id = trace
+        self.span_id = f'{random.getrandbits(64):016x}'
+        self.parent_id = parent
+        self.start = start or time.time_ns()
+        self.end = None
+        self.attributes = attributes
+
+class Tracer():
+    """Spans of the requests handled by one device (or the broker), written
+    as JSON lines or as OTLP/JSON (one ``ExportTraceServiceRequest`` per line,
+    the format of the OpenTelemetry collector file exporter).
+
+    Nothing is done while ``fmt`` is empty. A worker opens the trace of each
+    request with ``begin_trace`` and nests spans with ``push``/``pop``; the
+    driver adds its I/O spans below the open one, if any, from the thread
+    that opened the trace. The broker, with many requests in flight, uses
+    ``start``/``finish`` on explicit spans.
+
+    Args:
+        name (str): Service name, used in the file name
+            ``<directory>/trace-<name>.jsonl`` (``.otlp.jsonl``).
+        fmt (str): '', 'jsonl' or 'otlp'.
+        directory (str): Where the traces are written.
+        max_bytes (int): Size at which the file is rotated (one backup kept).
+
+    ``configure`` may be called from another thread (config reload): the
+    export and the format change hold ``_lock``.
+    """
+    def __init__(self, name: str, fmt: str = '', directory: str = 'logs', max_bytes: int = 10 * 1024 * 1024):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fmt = ''
+        self.stack = []
+        self._owner = None
+        self._buffer = []
+        self._file = None
+        self._lock = threading.RLock()
+        self.configure(fmt)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.fmt)
+
+    @property
+    def path(self) -> str:
+        suffix = '.otlp.jsonl' if self.fmt == 'otlp' else '.jsonl'
+        return os.path.join(self.directory, f'trace-{self.name}{suffix}')
+
+    def configure(self, fmt: str):
+        """Changes the output format, '' stops tracing"""
+        with self._lock:
+            if fmt == self.fmt:
+                return
+            self.close()
+            self.fmt = fmt
+
+    # Explicit spans
+    def start(self, name: str, trace: str, parent: str = None, start: int = None, **attributes) -> Span:
+        """New span, None while disabled"""
+        if not self.fmt:
+            return None
+        return Span(name, trace, parent, start, **attributes)
+
+    def finish(self, span: Span, **attributes):
+        """Ends ``span`` and queues it for export, flushed when a root span ends"""
+        if span is None:
+            return
+        span.end = time.time_ns()
+        span.attributes.update(attributes)
+        self._buffer.append(span)
+        if span.parent_id is None or len(self._buffer) >= 256:
+            self.flush()
+
+    def add(self, name: str, start: int, end: int, **attributes):
+        """Records an already finished span below the open one"""
+        if not self.stack:
+            return
+        parent = self.stack[-1]
+        span = Span(name, parent.trace_id, parent.span_id, start, **attributes)
+        span.end = end
+        self._buffer.append(span)
+
+    # Nested spans of the request being handled by the calling thread
+    def begin_trace(self, client_id, transaction, name: str, start: int = None, **attributes) -> bool:
+        """Opens the root span of a request, False while disabled"""
+        if not self.fmt:
+            return False
+        self.stack = [Span(name, trace_id(client_id, transaction), None, start,
+                           clientId=client_id, clientTransactionId=transaction, **attributes)]
+        self._owner = threading.get_ident()
+        return True
+
+    @property
+    def active(self) -> bool:
+        """True if a trace is open by the calling thread"""
+        return bool(self.stack) and self._owner == threading.get_ident()
+
+    def push(self, name: str, **attributes):
+        parent = self.stack[-1]
+        self.stack.append(Span(name, parent.trace_id, parent.span_id, **attributes))
+
+    def pop(self, **attributes):
+        self.finish(self.stack.pop(), **attributes)
+
+    def end_trace(self, **attributes):
+        """Ends the open spans, the root last"""
+        while self.stack:
+            self.pop(**(attributes if len(self.stack) == 1 else {}))
+        self._owner = None
+
+    # Export
+    def flush(self):
+        with self._lock:
+            spans, self._buffer = self._buffer, []
+            if not spans or not self.fmt:
+                return
+            try:
+                if self._file is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._file = open(self.path, 'a')
+                if self.fmt == 'otlp':
+                    self._file.write(json.dumps(self.otlp(spans), default=str) + '\n')
+                else:
+                    for span in spans:
+                        self._file.write(json.dumps({
+                            "service": self.name,
+                            "traceId": span.trace_id,
+                            "spanId": span.span_id,
+                            "parentSpanId": span.parent_id or "",
+                            "name": span.name,
+                            "startTimeUnixNano": span.start,
+                            "endTimeUnixNano": span.end,
+                            "durationMs": round((span.end - span.start) / 1e6, 3),
+                            "attributes": span.attributes,
+                        }, default=str) + '\n')
+                self._file.flush()
+                if self._file.tell() > self.max_bytes:
+                    self._file.close()
+                    self._file = None
+                    os.replace(self.path, self.path + '.1')
+            except OSError:
+                self.close()
+
+    def otlp(self, spans: list) -> dict:
+        """OTLP/JSON ``ExportTraceServiceRequest`` with ``spans``"""
+        def value(v):
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": f"focuser160-{self.name}"}}]},
+            "scopeSpans": [{
+                "scope": {"name": "focuser160"},
+                "spans": [{
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    "parentSpanId": span.parent_id or "",
+                    "name": span.name,
+                    "kind": 2 if span.parent_id is None else 1,  # SERVER, INTERNAL
+                    "startTimeUnixNano": str(span.start),
+                    "endTimeUnixNano": str(span.end),
+                    "attributes": [{"key": k, "value": value(v)} for k, v in span.attributes.items()],
+                } for span in spans],
+            }],
+        }]}
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,952 @@
+# worker.py - Per device control loop
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+from logging import Logger
+
+import time
+import zmq
+import json
+import socket
+from datetime import datetime, timezone
+from threading import Thread
+
+from src.core.config import Config, DeviceConfig
+from src.core.sequence import MotionSequence, parse_targets, parse_sweep
+from src.core.tempcomp import TempCompensator, make_source
+from src.core.recorder import FlightRecorder
+from src.core.profiler import Profiler
+from src.core.tracing import Tracer
+from src.core.snapshot import StateSnapshot
+from src.core.exceptions import (ErrorCode, DriverException, TempCompException,
+                                 nak, error_code, describe)
+
+from src.interface.dmx_eth import FocuserDriver as Focuser
+
+# Trailing frame of a status carrying an event (sequence progress), removed
+# by the broker before the status reaches the subscribers
+EVENT_FRAME = b'EVENT'
+
+class FocuserWorker():
+    """Drives one DMX-ETH device: polls its state, executes the commands
+    routed to it by the ``App`` broker and publishes its status.
+
+    Each worker owns a DEALER socket, connected to the broker backend, where
+    it receives ``[client, b'', request]`` and answers ``[client, b'', reply]``,
+    and a PUB socket connected to the broker XSUB. When ``topic`` is set the
+    status is published as ``[topic, json]``, otherwise as a single frame;
+    a status carrying an event is followed by ``EVENT_FRAME``.
+    """
+    # Actions without argument and their handlers, looked up by name so the
+    # profiler wrappers are used while profiling (HALT has its own branch)
+    COMMANDS = {
+        'HOME': 'handle_home',
+        'CONNECT': 'handle_connect',
+        'DISCONNECT': 'handle_disconnect',
+        'STATUS': 'pub_status',
+    }
+
+    def __init__(self, logger: Logger, device: DeviceConfig, topic: bytes = None):
+
+        self.logger = logger
+        self.config = device
+        self.name = device.device_name
+        self.topic = topic
+        # Full detail of requests, replies, publications and device I/O,
+        # written to disk only on errors, alarms or a DUMP request
+        self.recorder = FlightRecorder(self.name, Config.recorder_size)
+
+        # Sockets, created by the thread (or process) running the worker
+        self.backend = None
+        self.publisher = None
+        self.poller = None
+        self._envelope = None
+        self.loop_interval = 0.0
+
+        # Control variables
+        self.stop_var = False
+        self.previous_is_mov = False
+        self.previous_homing = False
+        self.previous_pos = 0
+        self.last_ping_time = None
+        self.last_pub = None
+        self._reach_thread = None
+        self.reachable = False
+        self.router = False
+
+        # Allocated once: the idle loop publishes and compares these
+        # instead of creating them on every iteration
+        self._idle_cmd = {
+            "clientId": 0,
+            "clientTransactionId": 0,
+            "clientName": "",
+            "action": ""
+        }
+        self._stamp_second = None
+        self._stamp_prefix = ''
+
+        #variables for status request
+        self._is_moving = False
+        self._position = 0
+        self._homing = False
+        self._stopping = False
+        self._client_id = 0
+        self.busy_id = 0
+        self._current_speed = device.max_speed
+        self.encoder = 0
+        self.sequence: MotionSequence = None
+        self._settled = (0.0, 0.0)  # (monotonic, wall) time the last motion ended
+        self._client_move = False   # motion requested by a client (focus set by the operator)
+        self._halting = False       # HALT being sent by the urgent thread
+        self._halted = None         # (request, ok) of a HALT served by the urgent thread
+        self._reconfigure = False   # config reloaded, applied by the loop
+        self.temperature = None
+
+        # Temperature compensation. The source is opened by ``run``, in the
+        # process driving the device: a UDP source binds its port, and the
+        # broker of ``sharding = "process"`` builds mirror workers too
+        self.temp_source = None
+        self.compensator = TempCompensator(device.temp_coefficient, device.temp_hysteresis,
+                                           device.temp_interval)
+
+        # Status Message
+        self.status = {
+            "absolute": device.absolute,
+            "alarm": 0,
+            "broker": "Focuser160",
+            "cmd": self._idle_cmd,
+            "connected": False,
+            "controller": Config.name,
+            "device": device.device_name,
+            "error": "",
+            "errorCode": ErrorCode.OK,
+            "homing": False,
+            "initialized": False,
+            "isMoving": False,
+            "maxSpeed": device.max_speed,
+            "maxStep": device.max_step,
+            "position": 0,
+            "stale": False,
+            "tempComp": device.temp_comp and device.tempcompavailable and bool(device.temp_source),
+            "tempCompAvailable": device.tempcompavailable and bool(device.temp_source),
+            "temperature": 0,
+            "timestamp": self.timestamp(),
+            "version": "1.0.0"
+        }
+
+        self.device = Focuser(self.logger, device)
+        self.device.recorder = self.recorder
+        self.device.temp_comp = self.status["tempComp"]
+
+        # Opt-in timing of the handlers and of the driver I/O (PROFILE command)
+        self.profiler = Profiler(self.name)
+        self.profiler.instrument(self, 'handle_')
+        self.profiler.instrument(self, 'pub_status')
+        self.profiler.instrument(self, 'update_status')
+        self.profiler.instrument_io(self.device, '_write')
+
+        # Spans of each request, from parsing to the reply (trace setting)
+        self.tracer = Tracer(self.name, Config.trace)
+        self.device.tracer = self.tracer
+
+        # Warm restart: the last known state is published as stale right
+        # away and reconciled once the device is reached
+        self.snapshot = StateSnapshot(self.name, Config.state_dir) if Config.state_dir else None
+        self._saved_state = self.snapshot.load() if self.snapshot else None
+        if self._saved_state:
+            self.load_state(self._saved_state)
+
+    def load_state(self, state: dict):
+        """Shows a saved state in the status, flagged as stale"""
+        try:
+            self._position = self.previous_pos = int(state["position"])
+            self.status["position"] = self._position
+            self.status["initialized"] = bool(state.get("initialized"))
+            if state.get("busyId"):
+                self.status["cmd"] = state.get("cmd", self.status["cmd"])
+            self.encoder = self.device.calibration.to_counts(self._position)
+        except (KeyError, TypeError, ValueError) as e:
+            self.logger.error(f'Invalid state snapshot of {self.name}: {str(e)}')
+            self._saved_state = None
+            return
+        self.status["stale"] = True
+        self.logger.info(f'{self.name} last known state loaded (saved {state.get("saved")}), position {self._position}')
+
+    def save_state(self, force: bool = False):
+        """Persists the current state, while it comes from the device"""
+        if self.snapshot is None or self.status["stale"] or not self.status["connected"]:
+            return
+        self.snapshot.save({
+            "position": self._position,
+            "initialized": self.status["initialized"],
+            "busyId": self.busy_id,
+            "cmd": self.status["cmd"],
+            "registers": self.device.registers,
+        }, force)
+
+    def reconcile_state(self, position: int, initialized: bool):
+        """Compares the device, just reached, with the saved state. The
+        shadow registers are kept only if the controller was not reset
+        meanwhile (still initialized and at the saved position), and the busy
+        owner only if the device is still moving"""
+        saved, self._saved_state = self._saved_state, None
+        kept = bool(saved.get("initialized")) and initialized and position == saved.get("position")
+        if kept:
+            self.device.restore_registers(saved.get("registers", {}))
+        if saved.get("busyId") and self.device.is_moving:
+            self._client_id = saved["busyId"]
+            self.status["cmd"] = saved.get("cmd", self.status["cmd"])
+            self._is_moving = self.previous_is_mov = self.status["isMoving"] = True
+        self.logger.info(f'{self.name} reconciled: position saved {saved.get("position")}, '
+                         f'device {position}, registers {"kept" if kept else "dropped"}')
+
+    def reach_device(self):
+        """Ping device and reads the position and initialized variables"""
+        _try = 0
+        self.last_ping_time = time.monotonic()
+        print(f"Trying Reconnect {self.name}")
+        for _try in range(5):
+            self.reachable = self.ping_server()
+            if self.reachable:
+                self.router = True
+                break
+            _try += 1
+            self.router = self.ping_router()
+
+        if self.reachable:
+            try:
+                self.device.connected = True
+                self._position =self.device.position
+                self.status["position"] = self._position
+                self.status["initialized"] = self.device.initialized
+                if self._saved_state:
+                    self.reconcile_state(self._position, self.status["initialized"])
+                self.status["stale"] = False
+                self.logger.info(f'Device {self.name} Reached.')
+            except Exception as e:
+                self.error(f'Error reaching device {self.name}: {str(e)}', e)
+
+    def reach_device_background(self):
+        """Runs ``reach_device`` in a thread, so the loop keeps serving
+        clients (with ``connected`` false) while the device is reached"""
+        if self._reach_thread and self._reach_thread.is_alive():
+            return
+        self.last_ping_time = time.monotonic()
+        self._reach_thread = Thread(target=self.reach_device, name=f'reach-{self.name}', daemon=True)
+        self._reach_thread.start()
+
+    def connect_sockets(self, context: zmq.Context, backend_endpoint: str, status_endpoint: str):
+        """Connects the DEALER (commands) and PUB (status) sockets to the broker"""
+        self.backend = context.socket(zmq.DEALER)
+        self.backend.setsockopt(zmq.IDENTITY, self.name.encode())
+        self.backend.setsockopt(zmq.LINGER, 0)
+        self.backend.connect(backend_endpoint)
+
+        # XPUB instead of PUB to see the broker subscription arrive: a status
+        # published before it (the first one, possibly a warm restart
+        # snapshot) would be dropped
+        self.publisher = context.socket(zmq.XPUB)
+        self.publisher.setsockopt(zmq.LINGER, 0)
+        self.publisher.connect(status_endpoint)
+        if self.publisher.poll(1000):
+            self.publisher.recv()
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.backend, zmq.POLLIN)
+
+    def close_sockets(self):
+        """Closes the worker sockets"""
+        self.poller = None
+        for sock in (self.backend, self.publisher):
+            if sock is not None:
+                sock.close()
+        self.backend = None
+        self.publisher = None
+
+    def pub_status(self, event: dict = None):
+        """Publishes status via ZeroMQ
+        Args:
+            event (dict): Optional event (sequence progress...) published
+                along with the status under the ``event`` key
+        """
+        if self.publisher is None:
+            return
+        self.status["timestamp"] = self.timestamp()
+        if event:
+            json_string = json.dumps(dict(self.status, event=event))
+        else:
+            json_string = json.dumps(self.status)
+        frames = [self.topic, json_string.encode()] if self.topic else [json_string.encode()]
+        if event:
+            frames.append(EVENT_FRAME)
+        self.publisher.send_multipart(frames)
+        self.recorder.record_json('pub', json_string)
+        # Written when the state changes, right away once the motion stops
+        self.save_state(force=not self._is_moving)
+
+    def set_error(self, exc: Exception):
+        """Shows an error, with its catalogue code, in the status"""
+        self.status["error"] = str(exc)
+        self.status["errorCode"] = int(error_code(exc))
+
+    def timestamp(self) -> str:
+        """Local time with milliseconds, as ``datetime.isoformat``; the
+        date and time up to the second is only formatted when it changes"""
+        now = time.time()
+        second = int(now)
+        if second != self._stamp_second:
+            self._stamp_second = second
+            self._stamp_prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(second))
+        return f'{self._stamp_prefix}.{int((now - second) * 1000):03d}'
+
+    @property
+    def connection_speed(self) -> str:
+        """Duration of the last loop iteration, as shown by the GUI"""
+        return f"interval:  {round(self.loop_interval, 3)}"
+
+    def error(self, message, exc: Exception = None):
+        """Logs an error and dumps the flight recorder
+        Args:
+            message (str): Log message.
+            exc: Exception, its traceback is logged if verbose_exceptions is set.
+        """
+        if exc is not None and Config.verbose_exceptions:
+            message = f'{message}\n{describe(exc, verbose=True)}'
+        self.logger.error(message)
+        self.recorder.record('error', message=message)
+        path = self.recorder.dump('error')
+        if path:
+            self.logger.error(f'Flight recorder dumped to {path}')
+
+    def update_alarm(self):
+        """Reads the alarm flag, dumping the flight recorder when it is up"""
+        self.status["alarm"] = self.device.alarm
+        if self.status["alarm"]:
+            self.recorder.record('alarm', alarm=self.status["alarm"])
+            path = self.recorder.dump('alarm')
+            if path:
+                self.logger.warning(f'Alarm {self.status["alarm"]}, flight recorder dumped to {path}')
+
+    def stop(self):
+        """Stop main loop"""
+        self.stop_var = True
+
+    def refresh_config(self):
+        """Config reload notification, from the watcher thread: the loop
+        applies the new settings with ``apply_config`` on its own thread"""
+        self._reconfigure = True
+
+    def apply_config(self):
+        """Updates the status with settings changed by a config reload"""
+        self._reconfigure = False
+        self.status["maxSpeed"] = self.config.max_speed
+        self.compensator.coefficient = self.config.temp_coefficient
+        self.compensator.hysteresis = self.config.temp_hysteresis
+        self.compensator.min_interval = self.config.temp_interval
+        self.tracer.configure(Config.trace)
+
+    def open_temp_source(self):
+        """Opens the configured temperature source, turns the temperature
+        compensation off (and unavailable) if it cannot be opened"""
+        if not self.status["tempCompAvailable"]:
+            return
+        try:
+            self.temp_source = make_source(self.config.temp_source)
+        except (ValueError, OSError) as e:
+            self.temp_source = None
+            self.logger.error(f'Temperature source {self.config.temp_source}: {str(e)}')
+            self.status["tempCompAvailable"] = False
+            self.status["tempComp"] = False
+            self.device.temp_comp = False
+
+    def read_temperature(self):
+        """Reads the temperature source, if any, into the status"""
+        if self.temp_source is None:
+            return
+        temp = self.temp_source.read()
+        if temp is not None:
+            self.temperature = temp
+            self.device.temp = temp
+            self.status["temperature"] = round(temp, 2)
+
+    def handle_temp_comp(self, cmd):
+        """Turns the temperature compensation on or off (TEMPCOMP=1|0)
+        Returns:
+            True if the request was valid
+        """
+        enable = cmd.partition('=')[2].strip() in ('1', 'true', 'True', 'ON', 'on')
+        if enable and not self.status["tempCompAvailable"]:
+            self.set_error(TempCompException('Temperature compensation not available'))
+            return False
+        self.device.temp_comp = enable
+        # The reference is taken on the next compensation step
+        self.compensator.stop()
+        self.status["tempComp"] = self.device.temp_comp
+        self.logger.info(f'Temperature compensation {"on" if enable else "off"}')
+        self.pub_status()
+        return True
+
+    def compensate(self, now):
+        """Corrective move of the temperature compensation, only while the
+        device is idle and not in use by a client"""
+        if not self.device.temp_comp or self.temperature is None:
+            return
+        if self._is_moving or self._homing or self.sequence or self.busy_id:
+            return
+        if self.compensator.reference is None:
+            self.compensator.start(self.temperature, self._position)
+            self.logger.info(f'Temperature compensation reference {self.temperature} °C at {self._position}')
+            return
+        target = self.compensator.correction(now, self.temperature, self._position)
+        if target is None:
+            return
+        try:
+            self.device.move(target, compensate=True)
+            self._is_moving = True
+            self.logger.info(f'Temperature compensation: {self.temperature} °C, moving to {target}')
+        except Exception as e:
+            self.set_error(e)
+            self.error(f'Temperature compensation move to {target}: {str(e)}', e)
+
+    def ping_server(self):
+        """Check if motor is reachable
+        ::returns:: bool
+        """
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.settimeout(.6)
+            s.connect((self.config.device_ip, self.config.device_port))
+            s.close()
+            time.sleep(.1)
+            return True
+        except Exception as e:
+            return False
+
+    def ping_router(self):
+        """Check if router is reachable
+        ::returns:: bool
+        """
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.settimeout(.6)
+            s.connect((self.config.router_ip, 80))
+            s.close()
+            time.sleep(.1)
+            return True
+        except Exception as e:
+            return False
+
+    def handle_home(self):
+        """Executes the INIT routine, which means moving motor axis to the
+        microswitches and then removing the backlash until the encoder return 0"""
+        try:
+            res = self.device.home()
+            time.sleep(.1)
+            if res == "OK":
+                self._homing = True
+                self._is_moving = True
+            else:
+                self.set_error(DriverException(f'[Device] Error: {res}'))
+                self.update_alarm()
+            self.logger.info(f'Device Homing {res}')
+        except Exception as e:
+            self.update_alarm()
+            self.set_error(e)
+            self.error(f'Homing {e}', e)
+            self.pub_status()
+
+    def handle_halt(self):
+        """Stops the motor"""
+        if self.sequence:
+            self.end_sequence('aborted')
+        if self.device.Halt():
+            time.sleep(.1)
+            self._is_moving = True # set _is_moving to true so the main loop can realy check if the motor is moving or not
+            self.logger.info(f'Device Stopped')
+        else:
+            self.set_error(DriverException('Halt failed'))
+            self.update_alarm()
+            self.logger.info(f'Halt Fail')
+
+    def serve_urgent(self, context: zmq.Context, endpoint: str):
+        """HALT fast path: a thread answering the HALT requests the broker
+        routes to ``endpoint``, stopping the device right away instead of
+        after the request (and device polling) in progress in the loop"""
+        sock = context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.IDENTITY, self.name.encode())
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(endpoint)
+        try:
+            while not self.stop_var:
+                if sock.poll(100):
+                    frames = sock.recv_multipart()
+                    code = self.urgent_halt(frames[-1])
+                    sock.send_multipart(frames[:-1] + [nak(code).encode() if code else b'ACK'])
+        finally:
+            sock.close()
+
+    def urgent_halt(self, payload: bytes) -> int:
+        """Stops the device from the urgent thread, the loop completes the
+        HALT (sequence, status) with ``after_halt``
+        Returns:
+            ErrorCode, OK if the device was stopped
+        """
+        self.recorder.record('request', msg=payload.decode(errors='replace'), urgent=True)
+        try:
+            msg = json.loads(payload)
+            if msg.get("action") != 'HALT':
+                return ErrorCode.INVALID_REQUEST
+        except Exception:
+            return ErrorCode.INVALID_REQUEST
+        # Flagged first: the loop does not start sequence moves meanwhile
+        self._halting = True
+        ok = self.device.halt_now()
+        self._halted = (msg, ok)
+        self._halting = False
+        code = ErrorCode.OK if ok else ErrorCode.DRIVER_ERROR
+        self.recorder.record('reply', reply=nak(code) if code else 'ACK', urgent=True)
+        return code
+
+    def after_halt(self):
+        """Loop side of a HALT served by the urgent thread"""
+        msg, ok = self._halted
+        self._halted = None
+        self.status["cmd"] = msg
+        if self.sequence:
+            self.end_sequence('aborted')
+        if ok:
+            self._is_moving = True # the loop checks if the motor really stopped
+            self.logger.info(f'Device Stopped')
+        else:
+            self.set_error(DriverException('Halt failed'))
+            self.update_alarm()
+            self.logger.info(f'Halt Fail')
+
+    def handle_speed(self, vel):
+        """Change the motor's speed"""
+        vel = self.config.clamp_speed(vel)
+        try:
+            if self.device.speed(vel):
+                time.sleep(.1)
+                self.logger.info(f'Speed changed')
+            else:
+                self.logger.info(f'Speed change Fail')
+        except Exception as e:
+            self.error(f"Error speed {str(e)}", e)
+
+    def handle_connect(self):
+        """(Deprecated) - Self explained"""
+        self.logger.info(f'Device Connected')
+        self.device.position
+        self.pub_status()
+
+    def handle_disconnect(self):
+        """(Deprecated) - Self explained"""
+        self.logger.info(f'Device Disconnected')
+
+    def handle_in_out(self, direction, speed):
+        """Move focuser to a position
+        Args:
+            direction (int): 1 for IN, 0 for OUT.
+            speed microns/s(integer)
+        """
+        try:
+            if int(speed) != self.config.max_speed:
+                self.handle_speed(int(speed))
+            if direction == 1:
+                # FOCUS IN
+                self.device.focus_in_out(int(direction))
+                self.logger.info(f'Moving FOCUSIN')
+            elif direction == 0:
+                # FOCUS OUT
+                self.device.focus_in_out(int(direction))
+                self.logger.info(f'Moving FOCUSOUT')
+            time.sleep(.1)
+            self._is_moving = True
+            self._client_move = True
+        except Exception as e:
+            self.update_alarm()
+            self.set_error(e)
+            self.error(f'Moving FOCUS IN | OUT: {str(e)}', e)
+            self.pub_status()
+
+    def handle_move(self, pos, speed):
+        """Move focuser to a position
+        Args:
+            position microns (integer)
+            speed microns/s(integer)
+        """
+        try:
+            self.device.move(int(pos))
+            self.logger.info(f'Moving to {pos} position')
+            time.sleep(.1)
+            self._is_moving = True
+            self._client_move = True
+        except Exception as e:
+            self.update_alarm()
+            self.set_error(e)
+            self.error(f'Moving {pos}: {str(e)}', e)
+            self.pub_status()
+
+    def handle_sequence(self, cmd, msg, kind='sequence'):
+        """Starts a server side sequence of moves
+        Args:
+            cmd (str): SEQUENCE=position[:dwell],... or
+                SWEEP=start,stop,step[,dwell] action
+            msg (dict): Request, may carry the targets in a ``targets`` list
+                or the sweep in ``start``, ``stop``, ``step`` and ``dwell``
+            kind (str): ``sequence`` or ``sweep``
+        Returns:
+            True if the sequence started
+        """
+        try:
+            if kind == 'sweep':
+                targets = parse_sweep(cmd, msg, self.config.max_step)
+            else:
+                targets = parse_targets(cmd, msg, self.config.max_step)
+        except (ValueError, KeyError, TypeError) as e:
+            self.status["error"] = str(e)
+            self.status["errorCode"] = ErrorCode.INVALID_VALUE
+            self.error(f'{kind.capitalize()}: {str(e)}')
+            self.pub_status()
+            return False
+        self.sequence = MotionSequence(targets, self._client_id, kind)
+        self.logger.info(f'{kind.capitalize()} started: {len(targets)} targets')
+        self.pub_status(self.sequence.event('started', self._position))
+        return self.start_sequence_move()
+
+    def start_sequence_move(self):
+        """Starts the move to the current target of the sequence"""
+        try:
+            self.device.move(self.sequence.target)
+            time.sleep(.1)
+            self._is_moving = True
+            return True
+        except Exception as e:
+            self.update_alarm()
+            self.set_error(e)
+            self.error(f'Sequence move to {self.sequence.target}: {str(e)}', e)
+            self.end_sequence('error', error=str(e))
+            return False
+
+    def end_sequence(self, state, **extra):
+        """Publishes the final event of the sequence and clears it"""
+        self.pub_status(self.sequence.event(state, self._position, **extra))
+        self.logger.info(f'Sequence {state}')
+        self.sequence = None
+
+    def step_sequence(self, now):
+        """Advances the sequence once the current motion completed"""
+        seq = self.sequence
+        if seq is None or self._is_moving or self._homing:
+            return
+        if seq.state == MotionSequence.MOVING:
+            seq.reached(now)
+            # When the motion ended and the encoder read right after it
+            mono, wall = self._settled
+            self.pub_status(seq.event('reached', self._position,
+                                      monotonic=round(mono, 6),
+                                      utc=datetime.fromtimestamp(wall, timezone.utc).isoformat(timespec='microseconds'),
+                                      encoder=self.device.counts))
+        if seq.ready(now):
+            seq.advance()
+            if seq.done:
+                self.end_sequence('completed')
+            else:
+                self.start_sequence_move()
+
+    def update_status(self):
+        """Verifies if there is a change in state variables,
+        such as _is_moving, _homing and _position and publishes in ZeroMQ.
+        Simultaneous changes are published together, so a status never
+        shows the new position with a stale isMoving"""
+        changed = False
+        if self._position != self.previous_pos:
+            self.status["position"] = self._position
+            self.previous_pos = self._position
+            self.encoder = self.device.calibration.to_counts(self._position)
+            changed = True
+
+        if self._is_moving != self.previous_is_mov:
+            self.status["isMoving"] = self._is_moving
+            self.previous_is_mov = self._is_moving
+            self.status["initialized"] = self.device.initialized
+            self.logger.info(f'{self.name} {"moving" if self._is_moving else "stopped"} at {self._position}')
+            changed = True
+
+        if self._homing != self.previous_homing:
+            self.status["homing"] = self._homing
+            self.previous_homing = self._homing
+            self.logger.info(f'{self.name} homing {"started" if self._homing else "finished"}')
+            changed = True
+
+        if changed:
+            self.pub_status()
+
+    def reply(self, msg):
+        """Answers the request being handled"""
+        if self.tracer.active:
+            self.tracer.push('reply', reply=msg)
+            self.backend.send_multipart(self._envelope + [msg.encode()])
+            self.tracer.pop()
+        else:
+            self.backend.send_multipart(self._envelope + [msg.encode()])
+        self.recorder.record('reply', reply=msg)
+
+    def acknowledge(self):
+        """ACK, or NAK=<errorCode> if the handler failed"""
+        code = self.status["errorCode"]
+        self.reply(nak(code) if code else 'ACK')
+
+    def handle_request(self, frames):
+        """Parses and executes one request routed by the broker
+        Args:
+            frames (list): [client identity, b'', json request] or a
+                single frame control message, ``STOP`` or ``PROFILE:<mode>``
+        """
+        if len(frames) == 1:
+            if frames[0] == b'STOP':
+                self.stop()
+            elif frames[0].startswith(b'PROFILE:'):
+                self.handle_profile(frames[0][8:].decode())
+            return
+        self._envelope = frames[:-1]
+        self.recorder.record('request', msg=frames[-1].decode(errors='replace'))
+        t_recv = time.time_ns()
+        try:
+            msg_rep = json.loads(frames[-1])
+            cmd = msg_rep.get("action")
+            if self.tracer.begin_trace(msg_rep.get("clientId"), msg_rep.get("clientTransactionId"),
+                                       'request', t_recv, action=cmd, device=self.name):
+                self.tracer.add('parse', t_recv, time.time_ns())
+            if not 'STATUS' in cmd and (msg_rep.get("clientId") == self._client_id or self._client_id == 0):
+                # Only accept commands (except for status request) if not busy or if it
+                # was requested by the same client
+                self.status["cmd"] = msg_rep
+                self._client_id = msg_rep.get("clientId")
+        except Exception as e:
+            print(e)
+            self.reply(nak(ErrorCode.INVALID_REQUEST))
+            self.tracer.end_trace(error=str(e))
+            return
+        if self.tracer.active:
+            self.tracer.push('handler', action=cmd, busy=self.busy_id != 0)
+        try:
+            # Handle all possible commands
+            self.status["error"] = ""
+            self.status["errorCode"] = ErrorCode.OK
+            # One branch only: each one replies to the request
+            if cmd == "DUMP":
+                self.handle_dump()
+                self.reply('ACK')
+
+            elif "MOVE=" in cmd and self.busy_id == 0:
+                self.handle_move(cmd[5:], self.config.max_speed)
+                self.acknowledge()
+
+            elif "FOCUSIN" in cmd and self.busy_id == 0:
+                self.handle_in_out(1, cmd[8:])
+                self.acknowledge()
+
+            elif "FOCUSOUT" in cmd and self.busy_id == 0:
+                self.handle_in_out(0, cmd[9:])
+                self.acknowledge()
+
+            elif cmd.startswith("SEQUENCE") and self.busy_id == 0:
+                self.handle_sequence(cmd, msg_rep)
+                self.acknowledge()
+
+            elif cmd.startswith("SWEEP") and self.busy_id == 0:
+                self.handle_sequence(cmd, msg_rep, 'sweep')
+                self.acknowledge()
+
+            elif cmd.startswith("TEMPCOMP") and self.busy_id == 0:
+                self.handle_temp_comp(cmd)
+                self.acknowledge()
+
+            elif "HALT" in cmd and (self._client_id == self.busy_id or self.busy_id == 0):
+                self.handle_halt()
+                self.acknowledge()
+
+            elif cmd in self.COMMANDS and self.busy_id == 0:
+                getattr(self, self.COMMANDS[cmd])()
+                self.acknowledge()
+
+            else:
+                self.reply(nak(ErrorCode.BUSY if self.busy_id else ErrorCode.ACTION_NOT_IMPLEMENTED))
+
+            self.status["connected"] = self.device.connected
+
+        except Exception as e:
+            self.set_error(e)
+            self.pub_status()
+            self.error(f'Error: {str(e)}', e)
+        finally:
+            self.tracer.end_trace()
+
+    def handle_dump(self):
+        """Dumps the flight recorder on request"""
+        path = self.recorder.dump('request', force=True)
+        self.logger.info(f'Flight recorder dumped to {path}')
+
+    def handle_profile(self, mode: str) -> bool:
+        """Profiler control sent by the broker
+        Args:
+            mode (str): ON, CPROFILE (ON plus a cProfile of this thread), OFF or DUMP.
+        """
+        if mode in ('ON', 'CPROFILE'):
+            self.profiler.start(cprofile=mode == 'CPROFILE')
+            self.logger.info(f'Profiling {self.name} started')
+        elif mode == 'OFF':
+            self.profiler.stop()
+            self.logger.info(f'Profiling {self.name} stopped')
+        elif mode == 'DUMP':
+            self.logger.info(f'Profile of {self.name} dumped to {self.profiler.dump()}')
+        else:
+            return False
+        return True
+
+    def handle_offline(self, frames):
+        """Serves a request while the device is not connected: STATUS is
+        answered with the current (``connected`` false) state, other
+        commands are refused instead of leaving clients waiting"""
+        if len(frames) == 1:
+            self.handle_request(frames)
+            return
+        self._envelope = frames[:-1]
+        try:
+            cmd = json.loads(frames[-1]).get("action")
+        except Exception:
+            cmd = None
+        if cmd == 'STATUS':
+            self.pub_status()
+            self.reply('ACK')
+        elif cmd == 'DUMP':
+            self.handle_dump()
+            self.reply('ACK')
+        else:
+            self.reply(nak(ErrorCode.NOT_CONNECTED))
+
+    def run(self, context: zmq.Context, backend_endpoint: str, status_endpoint: str,
+            urgent_endpoint: str = None):
+        """Device loop, runs until ``stop`` is called"""
+        self.connect_sockets(context, backend_endpoint, status_endpoint)
+        self.open_temp_source()
+        self._client_id = 0
+        self.stop_var = False
+        urgent = None
+        if urgent_endpoint:
+            urgent = Thread(target=self.serve_urgent, args=(context, urgent_endpoint),
+                            name=f'urgent-{self.name}', daemon=True)
+            urgent.start()
+        self.status["connected"] = self.device.connected
+        while not self.stop_var:
+            t0 = time.monotonic()
+            io0 = self.profiler.io[1]
+            if self._reconfigure:
+                self.apply_config()
+            if self.last_pub is None or t0 - self.last_pub >= Config.pub_interval:
+                if self.status["connected"]:
+                    self.device.position
+                self.read_temperature()
+                self.pub_status()
+                self.last_pub = t0
+                if self.status["connected"]:
+                    self.compensate(t0)
+            reaching = self._reach_thread is not None and self._reach_thread.is_alive()
+            if self.device and self.device.connected and not reaching:
+                if not self.status["connected"]:
+                    # Device just reached, publish the first snapshot
+                    self.status["connected"] = True
+                    self.pub_status()
+                # The backend is the only socket of the poller
+                if self.poller.poll(50):
+                    self.handle_request(self.backend.recv_multipart())
+                if self._halted:
+                    self.after_halt()
+
+                if self._is_moving:
+                    self._is_moving = self.device.is_moving
+                    if not self._is_moving:
+                        self._settled = (time.monotonic(), time.time())
+                    time.sleep(.05)
+                    self._position = self.device.position
+                    if not self._is_moving and self._client_move:
+                        # Focus set by the operator, a sample of the focus vs temperature model
+                        self._client_move = False
+                        if self.temperature is not None and not self.device.temp_comp:
+                            self.compensator.record(self.temperature, self._position)
+                if self._homing:
+                    self._homing = self.device.homing
+                if self.sequence and not (self._halting or self._halted):
+                    self.step_sequence(time.monotonic())
+                if not self._homing and not self._is_moving and self.sequence is None:
+                    # this means the device is not busy
+                    self._client_id = 0
+                    self.status["cmd"] = self._idle_cmd
+
+                self.busy_id = self._client_id
+                self.update_status()
+                self.status["alarm"] = 0
+            else:
+                if not reaching and (self.last_ping_time is None or t0 - self.last_ping_time >= 7):
+                    self.reach_device_background()
+                if self.status["connected"]:
+                    self.status["connected"] = False
+                    if self.sequence:
+                        self.end_sequence('aborted', error='Device disconnected')
+                    self.pub_status()
+                if self.backend.poll(50):
+                    self.handle_offline(self.backend.recv_multipart())
+            self.loop_interval = time.monotonic() - t0
+            if self.profiler.enabled:
+                self.profiler.add('run_iteration', self.loop_interval, self.profiler.io[1] - io0)
+
+        self.logger.info(f'Register writes {self.name}: {self.device.register_stats}')
+        self.save_state(force=True)
+        # Publish the final state before leaving
+        try:
+            self.device.disconnect()
+        except Exception as e:
+            self.error(f'Error disconnecting {self.name}: {str(e)}')
+        self.status["connected"] = self.device.connected
+        self.pub_status()
+        if urgent is not None:
+            urgent.join(1)
+        self.close_sockets()
+        self.tracer.close()
+        if self.temp_source is not None:
+            self.temp_source.close()
+            self.temp_source = None
+
+def run_worker_process(device: DeviceConfig, topic: bytes, backend_endpoint: str,
+                       status_endpoint: str, urgent_endpoint: str = None):
+    """Entry point of a worker process (``sharding = "process"``)
+    Args:
+        device (DeviceConfig): Device driven by this process.
+        topic (bytes): Status topic, None for single frame status.
+        backend_endpoint (str): Broker ROUTER endpoint for commands.
+        status_endpoint (str): Broker XSUB endpoint for status.
+        urgent_endpoint (str): Broker ROUTER endpoint for HALT.
+
+    The broker stops the worker sending a single ``STOP`` frame.
+    """
+    from src.core.config import ConfigWatcher
+    from src.core.log import init_logging
+
+    logger = init_logging(f"logs/focuser-{device.device_name}.log")
+    # Live config changes are applied to the device object of this process
+    Config.devices = [device if d.device_name == device.device_name else d for d in Config.devices]
+    worker = FocuserWorker(logger, device, topic)
+    watcher = ConfigWatcher(Config, logger, on_change=lambda applied: worker.refresh_config())
+    watcher.start()
+
+    context = zmq.Context()
+    try:
+        worker.run(context, backend_endpoint, status_endpoint, urgent_endpoint)
+    finally:
+        watcher.stop()
+        context.term()
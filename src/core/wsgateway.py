@@ -0,0 +1,323 @@
+# wsgateway.py - WebSocket fan-out of the status stream
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+#
+# Usage, standalone (another machine, or a server started without it):
+#   python -m src.core.wsgateway [--server 192.168.0.10] [--port 7003]
+
+from logging import Logger
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import logging
+import socket
+import struct
+import time
+from threading import Thread, Event
+from urllib.parse import urlsplit, parse_qs
+
+import zmq
+import zmq.asyncio
+
+from src.core.config import Config, local_address
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OP_TEXT, OP_CLOSE, OP_PING, OP_PONG = 0x1, 0x8, 0x9, 0xA
+MAX_FRAME = 4096  # largest frame accepted from a browser (close, ping...)
+
+def encode_frame(payload: bytes, opcode: int = OP_TEXT) -> bytes:
+    """Unmasked (server to client) RFC 6455 frame"""
+    size = len(payload)
+    if size < 126:
+        header = struct.pack('!BB', 0x80 | opcode, size)
+    elif size < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, size)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, size)
+    return header + payload
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    """Reads a masked (client to server) frame
+    Returns:
+        (opcode, payload)
+    Raises:
+        ValueError if the frame is not masked or larger than MAX_FRAME
+    """
+    first, second = await reader.readexactly(2)
+    size = second & 0x7F
+    if size == 126:
+        size = struct.unpack('!H', await reader.readexactly(2))[0]
+    elif size == 127:
+        size = struct.unpack('!Q', await reader.readexactly(8))[0]
+    if not second & 0x80 or size > MAX_FRAME:
+        raise ValueError('Unmasked or oversized frame')
+    mask = await reader.readexactly(4)
+    data = await reader.readexactly(size)
+    if size:
+        key = int.from_bytes((mask * (size // 4 + 1))[:size], 'big')
+        data = (int.from_bytes(data, 'big') ^ key).to_bytes(size, 'big')
+    return first & 0x0F, data
+
+class Viewer():
+    """A browser connection. ``pending`` holds the frame to send per device:
+    a status arriving before the previous one was sent replaces it
+    (conflation), so a slow viewer only ever gets the latest state."""
+    __slots__ = ('writer', 'device', 'pending', 'wake', 'conflated')
+
+    def __init__(self, writer: asyncio.StreamWriter, device: str):
+        self.writer = writer
+        self.device = device
+        self.pending = {}
+        self.wake = asyncio.Event()
+        self.conflated = 0
+
+    def offer(self, key: str, frame: bytes):
+        if self.device and key and key != self.device:
+            return
+        if key in self.pending:
+            self.conflated += 1
+        self.pending[key] = frame
+        self.wake.set()
+
+class WebSocketGateway():
+    """Fans the status stream out to browser dashboards over WebSocket.
+
+    One SUB socket receives every status published by the server, the
+    frame of each status is encoded once and offered to every viewer;
+    each viewer has its own sender task that writes the latest status of
+    each device once its connection can take it. A viewer whose connection
+    stays blocked (browser tab frozen, network gone) for ``send_timeout``
+    seconds is dropped. All of it runs in the asyncio loop of one thread
+    (or process), outside the control loop: viewers add nothing to the
+    server but this one subscriber.
+
+    Viewers connect to ``ws://<host>:<port>/``, optionally with
+    ``?device=<device_name>`` for a single device, and receive the status
+    JSON as text messages, starting with the last known one.
+
+    Args:
+        logger (Logger): Logger.
+        pub_endpoint (str): Status PUB endpoint of the server.
+        port (int): WebSocket port.
+        bind (str): Bind address, all interfaces if empty.
+        max_clients (int): Viewers accepted at the same time.
+        send_timeout (float): Seconds a viewer may stay blocked.
+        buffer (int): Bytes buffered per viewer before it is considered
+            busy (backpressure).
+    """
+    def __init__(self, logger: Logger, pub_endpoint: str, port: int = 7003, bind: str = '',
+                 max_clients: int = 500, send_timeout: float = 10.0, buffer: int = 64 * 1024):
+        self.logger = logger
+        self.pub_endpoint = pub_endpoint
+        self.port = port
+        self.bind = bind
+        self.max_clients = max_clients
+        self.send_timeout = send_timeout
+        self.buffer = buffer
+        self.viewers = set()
+        self.latest = {}    # device -> frame of its last status
+        self.stats = {"accepted": 0, "refused": 0, "dropped": 0, "published": 0}
+        self._loop = None
+        self._stop = None
+        self._thread = None
+        self._handlers = set()
+
+    # Thread control
+    def start(self) -> 'WebSocketGateway':
+        """Runs the gateway in a thread
+        Raises:
+            OSError if the port cannot be bound
+        """
+        loop = asyncio.new_event_loop()
+        self._loop = loop
+        errors = []
+        started = Event()
+        def run():
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.serve(started, errors))
+            finally:
+                loop.close()
+        self._thread = Thread(target=run, name='ws-gateway', daemon=True)
+        self._thread.start()
+        started.wait(5)
+        if errors:
+            self._thread.join(1)
+            raise errors[0]
+        return self
+
+    def stop(self):
+        """Closes every viewer and stops the thread"""
+        if self._thread is None:
+            return
+        if self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join(5)
+        self._thread = None
+
+    # asyncio side
+    async def serve(self, started=None, errors=None):
+        """Accepts viewers and forwards the status stream until stopped"""
+        self._stop = asyncio.Event()
+        try:
+            server = await asyncio.start_server(self.handle_viewer, self.bind or None, self.port)
+        except OSError as e:
+            if errors is not None:
+                errors.append(e)
+            if started is not None:
+                started.set()
+            return
+        self.port = server.sockets[0].getsockname()[1]
+        context = zmq.asyncio.Context()
+        sub = context.socket(zmq.SUB)
+        sub.setsockopt(zmq.LINGER, 0)
+        sub.setsockopt(zmq.SUBSCRIBE, b'')
+        sub.connect(self.pub_endpoint)
+        forward = asyncio.create_task(self.forward(sub))
+        self.logger.info(f'WebSocket gateway on port {self.port}')
+        if started is not None:
+            started.set()
+        try:
+            await self._stop.wait()
+        finally:
+            forward.cancel()
+            await asyncio.gather(forward, return_exceptions=True)
+            server.close()
+            # Aborted, not closed: a blocked viewer would keep its buffer
+            for viewer in list(self.viewers):
+                viewer.writer.transport.abort()
+            if self._handlers:
+                await asyncio.wait(list(self._handlers), timeout=6)
+            await server.wait_closed()
+            sub.close()
+            context.term()
+            self.logger.info(f'WebSocket gateway stopped: {self.stats}')
+
+    async def forward(self, sub):
+        """Offers each published status to the viewers"""
+        while True:
+            frames = await sub.recv_multipart()
+            key = frames[0].decode() if len(frames) > 1 else ''
+            frame = encode_frame(frames[-1])
+            self.latest[key] = frame
+            self.stats["published"] += 1
+            for viewer in self.viewers:
+                viewer.offer(key, frame)
+
+    async def handle_viewer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        try:
+            await self.serve_viewer(reader, writer)
+        finally:
+            self._handlers.discard(handler)
+
+    async def serve_viewer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Handshake, then the viewer lifetime"""
+        try:
+            device = await asyncio.wait_for(self.handshake(reader, writer), 5)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError, ValueError):
+            device = None
+        if device is None:
+            writer.close()
+            return
+        # Bounded buffers, in the kernel as well: a stalled viewer blocks
+        # after ``buffer`` bytes instead of queueing megabytes
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.buffer)
+        writer.transport.set_write_buffer_limits(high=self.buffer)
+        viewer = Viewer(writer, device)
+        for key, frame in self.latest.items():
+            viewer.offer(key, frame)
+        self.viewers.add(viewer)
+        self.stats["accepted"] += 1
+        sender = asyncio.create_task(self.send(viewer))
+        try:
+            await self.receive(viewer, reader)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.viewers.discard(viewer)
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            writer.close()
+
+    async def handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> str:
+        """Answers the opening handshake
+        Returns:
+            The device filter ('' for all), None if refused
+        """
+        head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        method, _, rest = head[0].partition(' ')
+        target = rest.rpartition(' ')[0]
+        headers = {}
+        for line in head[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        key = headers.get('sec-websocket-key')
+        if method != 'GET' or 'websocket' not in headers.get('upgrade', '').lower() or not key:
+            await self.refuse(writer, '426 Upgrade Required', 'WebSocket only')
+            return None
+        if len(self.viewers) >= self.max_clients:
+            self.stats["refused"] += 1
+            await self.refuse(writer, '503 Service Unavailable', 'Too many viewers')
+            return None
+        accept = base64.b64encode(hashlib.sha1(key.encode() + WS_GUID).digest()).decode()
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\n'
+                      'Upgrade: websocket\r\n'
+                      'Connection: Upgrade\r\n'
+                      f'Sec-WebSocket-Accept: {accept}\r\n\r\n').encode())
+        await writer.drain()
+        return parse_qs(urlsplit(target).query).get('device', [''])[-1]
+
+    @staticmethod
+    async def refuse(writer: asyncio.StreamWriter, status: str, text: str):
+        writer.write((f'HTTP/1.1 {status}\r\nContent-Type: text/plain\r\n'
+                      f'Content-Length: {len(text)}\r\nConnection: close\r\n\r\n{text}').encode())
+        await writer.drain()
+
+    async def send(self, viewer: Viewer):
+        """Writes the pending statuses of a viewer as its connection drains"""
+        try:
+            while True:
+                await viewer.wake.wait()
+                viewer.wake.clear()
+                pending, viewer.pending = viewer.pending, {}
+                for frame in pending.values():
+                    viewer.writer.write(frame)
+                # Waits only while above the buffer limit; meanwhile newer
+                # statuses replace the pending ones
+                await asyncio.wait_for(viewer.writer.drain(), self.send_timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.stats["dropped"] += 1
+            viewer.writer.transport.abort()
+
+    async def receive(self, viewer: Viewer, reader: asyncio.StreamReader):
+        """Serves the control frames of a viewer until it closes"""
+        while True:
+            opcode, data = await read_frame(reader)
+            if opcode == OP_CLOSE:
+                viewer.writer.write(encode_frame(data[:2], OP_CLOSE))
+                return
+            if opcode == OP_PING:
+                viewer.writer.write(encode_frame(data, OP_PONG))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='WebSocket status stream of a Focuser160 server')
+    parser.add_argument('--server', default=local_address(Config.ip_address), help='ZeroMQ server address')
+    parser.add_argument('--port', type=int, default=Config.websocket_port, help='WebSocket port')
+    parser.add_argument('--max-clients', type=int, default=Config.websocket_max_clients)
+    args = parser.parse_args()
+    logging.basicConfig(level=Config.log_level)
+    gateway = WebSocketGateway(logging.getLogger('wsgateway'), f'tcp://{args.server}:{Config.port_pub}',
+                               args.port, max_clients=args.max_clients).start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        gateway.stop()
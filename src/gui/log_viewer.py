@@ -0,0 +1,137 @@
+# log_viewer.py - Tail-follow log viewer widget
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+from collections import deque
+import os
+
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from src.core.config import LOG_LEVELS
+
+class LogTail(QThread):
+    """Follows a log file from a background thread, emitting the new lines.
+
+    Only the last ``backlog`` bytes are read when starting, then the file is
+    polled for appended data every ``interval`` seconds. A rotated (replaced
+    or truncated) file is read again from its beginning. The file is only
+    open while reading: on Windows an open file cannot be renamed, and the
+    rotation of the log handler would fail.
+    """
+    lines = pyqtSignal(list)
+
+    def __init__(self, path: str, backlog: int = 256 * 1024, interval: float = .25, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.backlog = backlog
+        self.interval = interval
+
+    def run(self):
+        offset, inode, partial = None, None, b''
+        while not self.isInterruptionRequested():
+            data = b''
+            try:
+                stat = os.stat(self.path)
+                skip_line = False
+                if offset is None:
+                    offset = max(stat.st_size - self.backlog, 0)
+                    # Skip the (partial) first line of the backlog
+                    skip_line = offset > 0
+                elif stat.st_ino != inode or stat.st_size < offset:
+                    offset, partial = 0, b''
+                inode = stat.st_ino
+                if stat.st_size > offset:
+                    with open(self.path, 'rb') as file:
+                        file.seek(offset)
+                        if skip_line:
+                            file.readline()
+                        data = file.read()
+                        offset = file.tell()
+            except OSError:
+                pass
+            if data:
+                chunks = (partial + data).split(b'\n')
+                partial = chunks.pop()
+                if chunks:
+                    self.lines.emit([c.decode('utf-8', 'replace').rstrip('\r') for c in chunks])
+            self.msleep(int(self.interval * 1000))
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
+
+class LogViewer(QtWidgets.QWidget):
+    """Read only view of the last ``max_lines`` log lines, with a level filter.
+
+    Lines are appended as ``LogTail`` reads them, the widget never holds
+    more than ``max_lines`` blocks, so the GUI thread only handles the
+    new lines whatever the size of the log file.
+    """
+    def __init__(self, path: str, max_lines: int = 5000, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.lines = deque(maxlen=max_lines)
+        self.tail = None
+
+        self.level = QtWidgets.QComboBox()
+        self.level.addItems(('ALL',) + LOG_LEVELS)
+        self.level.currentTextChanged.connect(self.refilter)
+        self.text = QtWidgets.QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setMaximumBlockCount(max_lines)
+        self.text.setStyleSheet("color: lightgrey")
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.level)
+        layout.addWidget(self.text)
+        self.setLayout(layout)
+
+    def start(self):
+        """Starts following the log file"""
+        if self.tail and self.tail.isRunning():
+            return
+        self.lines.clear()
+        self.text.clear()
+        self.tail = LogTail(self.path, parent=self)
+        self.tail.lines.connect(self.append_lines)
+        self.tail.start()
+
+    def stop(self):
+        if self.tail:
+            self.tail.stop()
+            self.tail = None
+
+    def accepts(self, line: str) -> bool:
+        """True if ``line`` passes the level filter. Lines are formatted as
+        ``<time> <LEVEL> <message>``; continuation lines (tracebacks) pass"""
+        level = self.level.currentText()
+        if level == 'ALL':
+            return True
+        fields = line.split(' ', 2)
+        if len(fields) < 2 or fields[1] not in LOG_LEVELS:
+            return True
+        return LOG_LEVELS.index(fields[1]) >= LOG_LEVELS.index(level)
+
+    def append_lines(self, lines: list):
+        """Appends new lines from the reader, keeping the view at the end
+        if it was already there"""
+        self.lines.extend(lines)
+        shown = [line for line in lines if self.accepts(line)]
+        if not shown:
+            return
+        bar = self.text.verticalScrollBar()
+        at_end = bar.value() == bar.maximum()
+        self.text.appendPlainText('\n'.join(shown))
+        if at_end:
+            bar.setValue(bar.maximum())
+
+    def refilter(self):
+        """Shows the kept lines again with the selected level"""
+        self.text.setPlainText('\n'.join(line for line in self.lines if self.accepts(line)))
+        bar = self.text.verticalScrollBar()
+        bar.setValue(bar.maximum())
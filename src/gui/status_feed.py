@@ -0,0 +1,53 @@
+# status_feed.py - Status stream for the Qt GUI
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+import json
+
+import zmq
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from src.core.config import local_address
+
+class StatusFeed(QThread):
+    """Subscribes to the server PUB socket and emits every status as a Qt
+    signal, delivered in the GUI thread.
+
+    Args:
+        host (str): Server address, ``*``, ``0.0.0.0`` or empty means this machine.
+        port (int): PUB port.
+        topic (str): Device topic, empty when a single device is served.
+    """
+    status = pyqtSignal(dict)
+
+    def __init__(self, host: str, port: int, topic: str = '', parent=None):
+        super().__init__(parent)
+        self.endpoint = f"tcp://{local_address(host)}:{port}"
+        self.topic = topic
+
+    def run(self):
+        context = zmq.Context.instance()
+        subscriber = context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.LINGER, 0)
+        subscriber.setsockopt_string(zmq.SUBSCRIBE, self.topic)
+        subscriber.connect(self.endpoint)
+        try:
+            while not self.isInterruptionRequested():
+                if not subscriber.poll(200):
+                    continue
+                frames = subscriber.recv_multipart()
+                if self.topic and frames[0].decode() != self.topic:
+                    continue  # Prefix match of another device topic
+                try:
+                    self.status.emit(json.loads(frames[-1]))
+                except ValueError:
+                    pass
+        finally:
+            subscriber.close()
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
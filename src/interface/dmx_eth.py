@@ -3,36 +3,56 @@ from logging import Logger
 from threading import Lock
 from threading import Timer
 
-from src.core.config import Config
+from src.core.config import Config, DeviceConfig
+from src.core.calibration import Calibration
+from src.core.exceptions import (DriverException, NotConnectedException, BusyException,
+                                 HaltedException, InvalidValueException, TempCompException)
 
 import socket
 import time
 
 class FocuserDriver():
-    def __init__(self, logger: Logger):  
+    POLL_RETRY = 30.0  # seconds between attempts to open the polling session
+    def __init__(self, logger: Logger, device: DeviceConfig = None):  
         self._lock = Lock()
+        # Held only for one command/reply exchange on the socket, so the HALT
+        # fast path can interleave with the (slow, paced) commands of the loop
+        self._io_lock = Lock()
+        # Incremented by every HALT, motion commands started before it and
+        # not sent yet are dropped
+        self._halt_seq = 0
         self.name: str = 'LNA Focuser'
         self.logger = logger
+        self.config = device or Config.devices[0]
+        # Encoder <-> micron conversion, precomputed lookup tables
+        self.calibration = Calibration.for_device(self.config)
 
         self.motor_socket = None
+        # Second session, for status polling (EX, V46, V44, ALM), when the
+        # controller accepts it; otherwise polls share motor_socket
+        self.poll_socket = None
+        self._poll_lock = Lock()
+        self._poll_retry = 0.0
+        self._single_session = False
         
         self._step_size: float = 1.0
         
         self._reverse = False
         self._absolute = True
-        self._max_step = Config.max_step
+        self._max_step = self.config.max_step
         self._max_increment = 100
         self._is_moving = False
         self._connected = False
         self._status = ""
         
-        self._temp_comp = False 
-        self._temp_comp_available = False
+        self._temp_comp_available = self.config.tempcompavailable
+        self._temp_comp = self.config.temp_comp and self._temp_comp_available
         self._temp = 0.0 
         self._steps_per_sec = 1
 
         self._position = 0
         self._last_pos = 0
+        self._counts = 0
         self._tgt_position = 0
         self._stopped = True
         self._homing = False
@@ -45,6 +65,17 @@ class FocuserDriver():
         self._timer: Timer = None
         self._interval: float = .15
 
+        # Shadow of the controller registers written (V20, V21...), writes
+        # of the value already in the register are skipped
+        self._registers = {}
+        self.writes_sent = 0
+        self.writes_saved = 0
+
+        # Optional FlightRecorder, every command and reply is recorded
+        self.recorder = None
+        # Optional Tracer, commands sent while a request is traced become spans
+        self.tracer = None
+
     @property
     def connected(self):
         self._lock.acquire()
@@ -61,8 +92,10 @@ class FocuserDriver():
         """
         self._lock.acquire()
         self._connected = connected
+        self._registers.clear()
         if connected:
             self._lock.release()
+            self._close_poll()
             retries = 0
             connected_successfully = False
 
@@ -70,9 +103,11 @@ class FocuserDriver():
                 try:
                     self.motor_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                     self.motor_socket.settimeout(.6)
-                    self.motor_socket.connect((Config.device_ip, Config.device_port))                    
+                    self.motor_socket.connect((self.config.device_ip, self.config.device_port))                    
                     time.sleep(delay)
                     connected_successfully = True
+                    if self.config.connections > 1:
+                        self._open_poll()
                 except Exception as e:
                     self.logger.error(f'Connection attempt {retries + 1} failed: {e}')
                     retries += 1                    
@@ -87,7 +122,7 @@ class FocuserDriver():
                 self._connected = False
                 self._lock.release()
                 self.logger.error('Failed to establish a connection after retries')
-                raise RuntimeError('Cannot Connect')
+                raise NotConnectedException('Cannot Connect')
 
         else:
             self._connected = False
@@ -101,21 +136,95 @@ class FocuserDriver():
     
     def disconnect(self):
         """Disconnects device and close socket"""
+        self._close_poll()
         self._lock.acquire()
         if self._connected:
             try:
                 self.motor_socket.close()
                 self._connected = False
             except:
-                raise RuntimeError('Cannot disconnect')
+                raise DriverException('Cannot disconnect')
         self._lock.release()
         
+    def _open_poll(self) -> bool:
+        """Opens the polling session, kept only if it answers an encoder read.
+        Controllers taking a single session refuse or drop it, and polling
+        falls back to the command session, tried again every POLL_RETRY
+        seconds. A controller that drops the first session instead is
+        detected by checking the command session afterwards; it is then
+        reopened and polling shares it from then on
+        Returns:
+            True if polling has its own session
+        """
+        if self._single_session:
+            return False
+        self._poll_retry = time.monotonic() + self.POLL_RETRY
+        address = (self.config.device_ip, self.config.device_port)
+        sock = None
+        try:
+            sock = socket.create_connection(address, timeout=.6)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            int(self._exchange(sock, "EX"))
+        except (OSError, ValueError) as e:
+            if sock is not None:
+                sock.close()
+            self.logger.warning(f'[Device] Polling shares the command connection: {str(e) or "session refused"}')
+            return False
+        # Held through the reopen: a HALT from the urgent thread waits for
+        # the new command session instead of writing to the closed one
+        with self._io_lock:
+            try:
+                int(self._exchange(self.motor_socket, "EX"))
+            except (OSError, ValueError):
+                sock.close()
+                self._single_session = True
+                self.logger.warning('[Device] Controller keeps a single session, polling shares the command connection')
+                try:
+                    self.motor_socket.close()
+                    self.motor_socket = socket.create_connection(address, timeout=.6)
+                except OSError as e:
+                    # Left to the worker reconnection, as any lost session
+                    self._connected = False
+                    self._registers.clear()
+                    self.logger.error(f'[Device] Cannot reopen the command connection: {str(e)}')
+                return False
+        self.poll_socket = sock
+        self.logger.info('[Device] Polling on a second connection')
+        return True
+
+    def _close_poll(self):
+        with self._poll_lock:
+            if self.poll_socket is not None:
+                try:
+                    self.poll_socket.close()
+                except OSError:
+                    pass
+                self.poll_socket = None
+
+    @staticmethod
+    def _exchange(sock, cmd: str) -> str:
+        """Sends ``cmd`` and returns the reply
+        Raises:
+            OSError if the session failed or was closed by the controller
+        """
+        sock.sendall(bytes(f'{cmd}\x00', 'utf-8'))
+        response = sock.recv(1024)
+        if not response:
+            raise ConnectionResetError('Connection closed by the controller')
+        return response.decode('utf-8').replace("\x00", "")
+
     @property
     def temp(self):
         self._lock.acquire()
         res = self._temp
         self._lock.release()
         return res
+    @temp.setter
+    def temp(self, temp: float):
+        """Last temperature read by the worker temperature source"""
+        self._lock.acquire()
+        self._temp = temp
+        self._lock.release()
     
     @property
     def temp_comp_available(self):
@@ -144,9 +253,10 @@ class FocuserDriver():
         """Device enconders position"""      
         try:
             self._lock.acquire()
-            step = int(self._write("EX", max_retries=5)) 
-            
-            self._position = int(round(step/Config.enc_2_microns))
+            step = int(self._write("EX", max_retries=5, poll=True)) 
+            self._counts = step
+
+            self._position = int(round(self.calibration.to_microns(step)))
             self._last_pos = self._position
             self._lock.release()
             return self._position
@@ -155,11 +265,16 @@ class FocuserDriver():
             self._lock.release()  
         return self._last_pos        
     
+    @property
+    def counts(self) -> int:
+        """Raw encoder counts of the last position read"""
+        return self._counts
+
     @property
     def is_moving(self) -> bool:
         """Checks if device is moving"""
         self._lock.acquire()
-        x = self._write("V46", max_retries=5)
+        x = self._write("V46", max_retries=5, poll=True)
         if x == "1":
             self._is_moving = True
             self._lock.release()
@@ -175,7 +290,7 @@ class FocuserDriver():
     def homing(self) -> bool:
         """Check if INIT routine is being executed"""
         self._lock.acquire()
-        x = self._write("V44", max_retries=5)
+        x = self._write("V44", max_retries=5, poll=True)
         if "0" in x:
             self._homing = True
         else:
@@ -187,7 +302,7 @@ class FocuserDriver():
     def initialized(self) -> bool:
         """Checks if initialization was previously executed"""
         self._lock.acquire()
-        x = self._write("V44", max_retries=5)
+        x = self._write("V44", max_retries=5, poll=True)
         if "64" in x:
             self._initialized = True
         else:
@@ -230,11 +345,53 @@ class FocuserDriver():
         self._lock.release()
         return res
     
+    @property
+    def register_stats(self) -> dict:
+        """Register writes sent to the controller and skipped by the cache"""
+        return {"sent": self.writes_sent, "saved": self.writes_saved}
+
+    @property
+    def registers(self) -> dict:
+        """Shadow values of the controller registers"""
+        return dict(self._registers)
+
+    def restore_registers(self, registers: dict):
+        """Restores shadow values saved before a restart, only to be used
+        once the controller is known to have kept its registers"""
+        self._registers.update({reg: int(value) for reg, value in registers.items()})
+
+    def invalidate_registers(self, *registers):
+        """Forgets the shadow value of ``registers``, all of them if none given"""
+        if registers:
+            for reg in registers:
+                self._registers.pop(reg, None)
+        else:
+            self._registers.clear()
+
+    def _set_register(self, register: str, value: int) -> str:
+        """Writes ``register=value`` unless the register already holds it
+        Returns:
+            Device response, 'OK' for a skipped write
+        """
+        if self._registers.get(register) == value:
+            self.writes_saved += 1
+            return 'OK'
+        resp = self._write(f"{register}={value}", max_retries=5)
+        self.writes_sent += 1
+        if "OK" in resp:
+            self._registers[register] = value
+        else:
+            self._registers.pop(register, None)
+        return resp
+
     @property
     def alarm(self) -> int:
-        res = self._write("ALM", max_retries=5)
+        res = self._write("ALM", max_retries=5, poll=True)
         try:
             self._alarm = int(res)
+            if self._alarm:
+                # The controller program may have reset its registers
+                self.invalidate_registers()
             if self._alarm == '1':
                 self.logger.info('[Device] Temperature Alarm ON')
         except Exception as e: 
@@ -248,14 +405,16 @@ class FocuserDriver():
         Returns: 
             Device response or Error message
         Raises:
-            RuntimeError if device is busy
+            BusyException if device is busy
         """      
         if self._is_moving:
-            raise RuntimeError('Cannot start a move while the focuser is moving')
+            raise BusyException()
 
+        # The INIT routine rewrites the motion registers
+        self.invalidate_registers()
         res = self._write("GS30", max_retries=5)
         if res == 'OK':
-            self.logger.info('[Device] home: Success')
+            self.logger.debug('[Device] home: Success')
             return res  
         else:
             alarm = self.alarm
@@ -265,78 +424,84 @@ class FocuserDriver():
         self.logger.error('[Device] home: Failed after retries')
         return res      
 
-    def move(self, position: int):  
+    def move(self, position: int, compensate: bool = False):  
         """Moves device position to the given position
         Args:  
             position (int): Value in microns.
+            compensate (bool): Corrective move of the temperature
+                compensation, allowed while temp_comp is on.
         Returns: 
             Device response or Error message
         Raises:
-            RuntimeError if Invalid input or if device is busy
+            InvalidValueException, TempCompException, BusyException,
+            HaltedException or DriverException (error reply)
         """      
-        pos_conv = int(round((Config.enc_2_microns * position), 0))
+        pos_conv = self.calibration.to_counts(position)
         if self._is_moving:
-            raise RuntimeError('Cannot start a move while the focuser is moving')
+            raise BusyException()
         if 0 >= position or position >= self._max_step:
-            raise RuntimeError('Invalid Target')
-        if self._temp_comp:
-            raise RuntimeError('Invalid TempComp')        
-        resp = self._write(f"V20={pos_conv}", max_retries=5)
+            raise InvalidValueException('Invalid Target')
+        if self._temp_comp and not compensate:
+            raise TempCompException()
+        halt_seq = self._halt_seq
+        resp = self._set_register("V20", pos_conv)
         if "OK" in resp:            
-            resp = self._write(f"GS29", max_retries=5)
+            resp = self._write(f"GS29", max_retries=5, halt_seq=halt_seq)
+            if resp == 'Halted':
+                raise HaltedException()
             if "OK" in resp:
-                self.logger.info(f'[Device] move={str(position)}')
+                self.logger.debug(f'[Device] move={str(position)}')
                 return
             else:
                 alarm = self.alarm
                 if alarm == 1:
                     self.logger.error('[Device] Move Failed and Alarm flag is up')
-                raise RuntimeError(f'[Device] Error: {resp}')
+                raise DriverException(f'[Device] Error: {resp}')
         else:
-            raise RuntimeError(f'[Device] Error: {resp}') 
+            raise DriverException(f'[Device] Error: {resp}') 
 
     def speed(self, vel: int):  
         """Sets the speed of the motor
         Args:  
             vel (int): speed value in microns/s.
         Raises:
-            RuntimeError if Invalid input or if device is busy
+            BusyException or DriverException (error reply)
         """      
-        vel_conv = vel*Config.speed_factor
+        vel_conv = self.config.speed_to_motor(vel)
         if self._is_moving:
-            raise RuntimeError('Cannot set speed while the focuser is moving')
-        # if 0 > vel >= self._max_speed:
-        #     raise RuntimeError('Invalid Steps') 
-        if vel_conv > Config.speed_security:
-            vel_conv = Config.speed_security       
-        resp = self._write(f"V21={vel_conv}", max_retries=5)
+            raise BusyException()
+        resp = self._set_register("V21", vel_conv)
         if "OK" in resp: 
-            self.logger.info(f'[Device] speed={str(vel)}')
+            self.logger.debug(f'[Device] speed={str(vel)}')
             return True           
         else:
-            raise RuntimeError(f'[device] {resp}')    
+            raise DriverException(f'[device] {resp}')    
 
     def focus_in_out(self, direction: int):  
         """Sets the speed of the motor
         Args:  
             direction (int): 1 for IN, 0 for OUT.
         Raises:
-            RuntimeError if Invalid input or if device is busy
+            BusyException, HaltedException or DriverException (error reply)
         """      
         if self._is_moving:
-            raise RuntimeError('Cannot set speed while the focuser is moving')
+            raise BusyException()
         if direction != 1 and direction != 0:
             return
         else:
-            resp = self._write(f"GS2{str(direction)}", max_retries=5)
+            # The jog subroutines drive the target register
+            self.invalidate_registers("V20")
+            resp = self._write(f"GS2{str(direction)}", max_retries=5, halt_seq=self._halt_seq)
+        if resp == 'Halted':
+            raise HaltedException()
         if "OK" in resp: 
             if direction == 1:                
-                self.logger.info(f'[Device] moving FOCUSIN')
+                self.logger.debug(f'[Device] moving FOCUSIN')
             elif direction == 0:
-                self.logger.info(f'[Device] moving FOCUSOUT')
+                self.logger.debug(f'[Device] moving FOCUSOUT')
             return True           
         else:
-            raise RuntimeError(f'[device] {resp}')         
+            raise DriverException(f'[device] {resp}')         
 
     def stop(self) -> None:
         """Complements the HALT method"""
@@ -350,33 +515,89 @@ class FocuserDriver():
     
     def Halt(self) -> None:   
         """Send command STOP and stops main program with GS0=0 subroutine"""     
-        resp_stop = self._write("V42=1", 5)
-        if resp_stop == 'OK':                 
-            self.logger.info('[Device] halt')
+        if self.halt_now():                 
+            self.logger.debug('[Device] halt')
             self.stop()
             return True  # Command executed successfully 
         return False        
+
+    def halt_now(self) -> bool:
+        """HALT fast path, safe to call from another thread while the loop
+        is using the device: skips the 200 ms pacing sleep and the shared
+        lock, waiting only for the socket exchange in progress, if any
+        Returns:
+            True if the controller acknowledged the stop
+        """
+        self._halt_seq += 1
+        self.invalidate_registers("V20")
+        if self._write("V42=1", max_retries=2, urgent=True) == 'OK':
+            self._is_moving = False
+            self._stopped = True
+            return True
+        return False
     
-    def _write(self, cmd, max_retries = 5):
+    def _write(self, cmd, max_retries = 5, urgent = False, halt_seq = None, poll = False):
         """Send commands to device socket.
         Args:  
             cmd (str): Command.
             max_retries (int): Number of retries if first one fails
+            urgent (bool): Send without the pacing sleep (HALT).
+            poll (bool): Status read, sent on the polling session if open.
+            halt_seq (int): Motion command, not sent ('Halted' returned)
+                if a HALT came after ``halt_seq`` was read.
         Returns: 
             Device response or Error message
         """
         retries = 0
         if self._connected:  
-            time.sleep(.2)            
+            if (poll and self.poll_socket is None and self.config.connections > 1
+                    and not self._single_session and time.monotonic() >= self._poll_retry):
+                self._open_poll()
+                if not self._connected:
+                    return "Not Connected"
+            sock, lock = self.motor_socket, self._io_lock
+            if poll and self.poll_socket is not None:
+                sock, lock = self.poll_socket, self._poll_lock
+            traced = self.tracer is not None and self.tracer.active
+            if traced:
+                t_start = time.time_ns()
+            if not urgent:
+                time.sleep(.2)            
+            if traced:
+                sleep_ms = round((time.time_ns() - t_start) / 1e6, 3)
             while retries < max_retries:  
                 try:   
-                    self.motor_socket.sendall(bytes(f'{cmd}\x00', 'utf-8'))
-                    response = self.motor_socket.recv(1024)
-                    return response.decode('utf-8').replace("\x00", "")                    
+                    with lock:
+                        if halt_seq is not None and halt_seq != self._halt_seq:
+                            return 'Halted'
+                        if lock is self._io_lock:
+                            # The command session may have been reopened meanwhile
+                            sock = self.motor_socket
+                        if traced:
+                            t_sent = time.time_ns()
+                        response = self._exchange(sock, cmd)
+                    if self.recorder is not None:
+                        self.recorder.record('io', cmd=cmd, reply=response)
+                    if traced:
+                        t_end = time.time_ns()
+                        self.tracer.add('driver.write', t_start, t_end, cmd=cmd, retries=retries, sleep_ms=sleep_ms,
+                                        rtt_ms=round((t_end - t_sent) / 1e6, 3), reply=response)
+                    return response
                 except Exception as e:
                     err = e
                 retries += 1
+            if sock is not self.motor_socket:
+                # Polling session lost, the command session takes over
+                self.logger.warning(f'[Device] Polling connection failed ({str(err)}), sharing the command connection')
+                self._close_poll()
+                self._poll_retry = time.monotonic() + self.POLL_RETRY
+                return self._write(cmd, max_retries, urgent=True)
             self._connected = False
+            self._registers.clear()
+            if self.recorder is not None:
+                self.recorder.record('io', cmd=cmd, error=str(err))
+            if traced:
+                self.tracer.add('driver.write', t_start, time.time_ns(), cmd=cmd, retries=retries, error=str(err))
             self.logger.error(f"[Device] Error writing {cmd}: {str(err)}")
             if "WinError" in str(err):
                 # If many retries were unsucessful, says the device is not connected
@@ -0,0 +1,232 @@
+# dmx_sim.py - Simulated DMX-ETH controller
+# Part of the Focus160MQ template device interface and communication
+#
+# Author:   Ramon C. Gargalhone <rgargalhone@lna.br> (RCG)
+#
+# Python Compatibility: Requires Python 3.10 or later
+
+import argparse
+import socket
+import threading
+import time
+
+class DMXSimulator():
+    """Local stand-in for the DMX-ETH motor controller.
+
+    Speaks the same null terminated ASCII protocol used by ``FocuserDriver``
+    (``EX``, ``V20=``, ``V21=``, ``GS29``, ``V42=1``...), simulating the
+    motion in time so benchmarks and tests can run without hardware.
+
+    Args:
+        host (str): Interface to bind.
+        port (int): TCP port, 0 picks a free one.
+        latency (float): Extra delay, in seconds, before each reply.
+        max_counts (int): Upper travel limit in encoder counts.
+        homing_time (float): Duration of the INIT routine in seconds.
+        max_sessions (int): Simultaneous TCP sessions accepted, extra ones
+            are closed right away (None for no limit).
+    """
+    SPEED_SCALE = .1   # V21 units to encoder counts/s
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 max_counts=2140000, homing_time=.5, max_sessions=None):
+        self.latency = latency
+        self.max_sessions = max_sessions
+        self.sessions = 0
+        self.refused = 0
+        self.max_counts = max_counts
+        self.homing_time = homing_time
+
+        self._lock = threading.Lock()
+        self._encoder = 0.0
+        self._target = 0
+        self._speed = 214000
+        self._direction = 0
+        self._t_start = 0.0
+        self._start_pos = 0.0
+        self._homing_until = 0.0
+        self._initialized = False
+        self.alarm = 0
+
+        # Benchmark hooks: monotonic time of the last motion end and of
+        # every received command (cmd, time)
+        self.motion_end = 0.0
+        self.history = []
+        self.record_history = False
+
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(8)
+        self.host, self.port = self._server.getsockname()
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        """Starts accepting connections in a background thread"""
+        self._running = True
+        thread = threading.Thread(target=self._accept_loop, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """Stops the simulator and closes the listening socket"""
+        self._running = False
+        try:
+            self._server.close()
+        except Exception:
+            pass
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            with self._lock:
+                refuse = self.max_sessions is not None and self.sessions >= self.max_sessions
+                if not refuse:
+                    self.sessions += 1
+            if refuse:
+                self.refused += 1
+                conn.close()
+                continue
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self._session, args=(conn,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _session(self, conn):
+        try:
+            self._serve(conn)
+        finally:
+            with self._lock:
+                self.sessions -= 1
+
+    def _serve(self, conn):
+        buffer = b''
+        with conn:
+            while self._running:
+                try:
+                    data = conn.recv(1024)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buffer += data
+                while b'\x00' in buffer:
+                    raw, buffer = buffer.split(b'\x00', 1)
+                    cmd = raw.decode('utf-8')
+                    if self.record_history:
+                        self.history.append((cmd, time.monotonic()))
+                    resp = self.execute(cmd)
+                    if self.latency:
+                        time.sleep(self.latency)
+                    try:
+                        conn.sendall(bytes(f'{resp}\x00', 'utf-8'))
+                    except OSError:
+                        return
+
+    # --------------
+    # Motion model
+    # --------------
+    def _update(self, now):
+        """Advances the simulated axis up to ``now``. Lock must be held"""
+        if self._homing_until and now >= self._homing_until:
+            self._homing_until = 0.0
+            self._encoder = 0.0
+            self._direction = 0
+            self._initialized = True
+            self.motion_end = now
+        if self._direction:
+            travelled = (now - self._t_start) * self._speed * self.SPEED_SCALE
+            pos = self._start_pos + self._direction * travelled
+            if self._direction > 0 and pos >= self._target:
+                pos = self._target
+                self._direction = 0
+                self.motion_end = self._t_start + abs(self._target - self._start_pos) / (self._speed * self.SPEED_SCALE)
+            elif self._direction < 0 and pos <= self._target:
+                pos = self._target
+                self._direction = 0
+                self.motion_end = self._t_start + abs(self._target - self._start_pos) / (self._speed * self.SPEED_SCALE)
+            self._encoder = pos
+
+    def _start_motion(self, target, now):
+        self._start_pos = self._encoder
+        self._target = max(0, min(self.max_counts, target))
+        self._t_start = now
+        if self._target > self._encoder:
+            self._direction = 1
+        elif self._target < self._encoder:
+            self._direction = -1
+        else:
+            self._direction = 0
+            self.motion_end = now
+
+    @property
+    def moving(self):
+        with self._lock:
+            self._update(time.monotonic())
+            return bool(self._direction or self._homing_until)
+
+    def execute(self, cmd):
+        """Executes one controller command and returns its reply"""
+        now = time.monotonic()
+        with self._lock:
+            self._update(now)
+            if cmd == 'EX':
+                return str(int(round(self._encoder)))
+            if cmd == 'V46':
+                return '1' if (self._direction or self._homing_until) else '0'
+            if cmd == 'V44':
+                if self._homing_until:
+                    return '0'
+                return '64' if self._initialized else '1'
+            if cmd == 'ALM':
+                return str(self.alarm)
+            if cmd == 'GS0':
+                return 'OK'
+            if cmd.startswith('V20='):
+                self._target = int(cmd[4:])
+                return 'OK'
+            if cmd.startswith('V21='):
+                self._speed = max(1, int(cmd[4:]))
+                return 'OK'
+            if cmd == 'GS29':
+                self._start_motion(self._target, now)
+                return 'OK'
+            if cmd == 'GS21':
+                self._start_motion(0, now)
+                return 'OK'
+            if cmd == 'GS20':
+                self._start_motion(self.max_counts, now)
+                return 'OK'
+            if cmd == 'GS30':
+                self._direction = 0
+                self._initialized = False
+                self._homing_until = now + self.homing_time
+                return 'OK'
+            if cmd == 'V42=1':
+                if self._direction or self._homing_until:
+                    self.motion_end = now
+                self._direction = 0
+                self._homing_until = 0.0
+                return 'OK'
+        return 'ERR'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulated DMX-ETH controller')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--max-sessions', type=int, default=None,
+                        help='simultaneous sessions accepted (1 like single session firmware)')
+    args = parser.parse_args()
+    sim = DMXSimulator(args.host, args.port, args.latency, max_sessions=args.max_sessions).start()
+    print(f"DMX-ETH simulator listening on {sim.host}:{sim.port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()